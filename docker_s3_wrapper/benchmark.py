@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the s3_wrapper upload/download paths against a local S3 stand-in, e.g.
+#   moto_server -p 5000
+#   ./benchmark.py --endpoint-url http://localhost:5000 --size-mb 256 --workers 1 4 16
+#   ./benchmark.py --mode small --runs 200
+
+from botocore.config import Config
+from boto3 import client
+from s3_transfer import MB, TransferEngine
+from s3_wrapper import *
+import argparse
+import datetime
+import os
+import statistics
+import tempfile
+import time
+
+
+def timed(label, size, function):
+	start = time.perf_counter()
+	result = function()
+	elapsed = time.perf_counter() - start
+	print(f'{label:<40} {elapsed:8.2f}s {size / MB / elapsed:10.1f} MB/s')
+	return result
+
+
+def benchmark_transfer(s3_client, s3_bucket, args, work_dir):
+	size = args.size_mb * MB
+	upload_file_path = os.path.join(work_dir, 'payload')
+	save_to_path = os.path.join(work_dir, 'payload.downloaded')
+	with open(upload_file_path, 'wb') as f:
+		for _ in range(args.size_mb):
+			f.write(os.urandom(MB))
+
+	s3_key = 'benchmark/payload'
+	print(f'--- transfer: {args.size_mb} MB, part size {args.part_size_mb} MB')
+
+	timed('upload_file (boto3 defaults)', size, lambda: save_file(s3_client, s3_bucket, s3_key, upload_file_path=upload_file_path))
+	timed('download_file (boto3 defaults)', size, lambda: load_file(s3_client, s3_bucket, s3_key, save_to_path=save_to_path))
+
+	for workers in args.workers:
+		transfer_engine = TransferEngine(
+			s3_client,
+			part_size=args.part_size_mb * MB,
+			max_workers=workers,
+			max_bandwidth=args.max_bandwidth_mb * MB if args.max_bandwidth_mb else None
+			)
+		timed(f'TransferEngine upload ({workers} workers)', size, lambda: save_file(s3_client, s3_bucket, s3_key, upload_file_path=upload_file_path, transfer_engine=transfer_engine))
+		timed(f'TransferEngine download ({workers} workers)', size, lambda: load_file(s3_client, s3_bucket, s3_key, save_to_path=save_to_path, transfer_engine=transfer_engine))
+
+
+def benchmark_small_upload(s3_client, s3_bucket, args, work_dir):
+	# The per-run cost of publishing a few bytes: the old touch/echo/upload_file path vs. an in-memory put
+	s3_key = 'benchmark/timestamp'
+
+	def via_temp_file():
+		timestamp_now_epoch = int(datetime.datetime.now().timestamp())
+		timestamp_filename = os.path.join(work_dir, 'timestamp')
+		os.system(f'touch {timestamp_filename}')
+		os.system(f'echo {timestamp_now_epoch} > {timestamp_filename}')
+		return save_file(s3_client, s3_bucket, s3_key, upload_file_path=timestamp_filename)
+
+	def in_memory():
+		timestamp_now_epoch = int(datetime.datetime.now().timestamp())
+		return save_file(s3_client, s3_bucket, s3_key, file_body=f'{timestamp_now_epoch}\n')
+
+	print(f'--- small upload: {args.runs} runs')
+	for label, function in (('os.system + upload_file', via_temp_file), ('in-memory save_file', in_memory)):
+		timings = []
+		for _ in range(args.runs):
+			start = time.perf_counter()
+			function()
+			timings.append((time.perf_counter() - start) * 1000)
+		print(f'{label:<40} median {statistics.median(timings):7.2f}ms  p95 {statistics.quantiles(timings, n=20)[-1]:7.2f}ms')
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark s3_wrapper against a local S3 stand-in (moto server or MinIO)')
+	parser.add_argument('--mode', choices=['transfer', 'small', 'all'], default='all')
+	parser.add_argument('--endpoint-url', default='http://localhost:5000')
+	parser.add_argument('--bucket', default='s3-wrapper-benchmark')
+	parser.add_argument('--size-mb', type=int, default=128)
+	parser.add_argument('--part-size-mb', type=int, default=8)
+	parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+	parser.add_argument('--max-bandwidth-mb', type=int, default=None)
+	parser.add_argument('--runs', type=int, default=100)
+	args = parser.parse_args()
+
+	s3_client = client(
+		's3',
+		endpoint_url=args.endpoint_url,
+		aws_access_key_id='testing',
+		aws_secret_access_key='testing',
+		region_name='us-east-1',
+		config=Config(max_pool_connections=max(args.workers))
+		)
+	s3_client.create_bucket(Bucket=args.bucket)
+
+	with tempfile.TemporaryDirectory() as work_dir:
+		if args.mode in ('transfer', 'all'):
+			benchmark_transfer(s3_client, args.bucket, args, work_dir)
+		if args.mode in ('small', 'all'):
+			benchmark_small_upload(s3_client, args.bucket, args, work_dir)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# Batch versions of save_file/load_file/file_exists. Every call fans out over one bounded thread pool
+# that shares a single boto3 client (and therefore its connection pool), and results are yielded as
+# soon as each item completes, in completion order rather than input order.
+
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from boto3 import client
+from s3_wrapper import NOT_FOUND_ERROR_CODES, _body_size, _notify_saved, observed_call, put_body
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Optional
+import itertools
+import os
+import threading
+
+DEFAULT_MAX_WORKERS = 16
+
+_shared_executor = None
+_shared_executor_lock = threading.Lock()
+
+
+@dataclass
+class BatchResult:
+	s3_key: str
+	ok: bool
+	value: Any = None
+	error: Optional[BaseException] = None
+
+
+def create_client(max_workers=DEFAULT_MAX_WORKERS, **client_kwargs):
+	# botocore keeps 10 pooled connections by default, size the pool to the number of workers sharing the client
+	return client('s3', config=Config(max_pool_connections=max_workers), **client_kwargs)
+
+
+def shared_executor():
+	global _shared_executor
+	with _shared_executor_lock:
+		if _shared_executor is None:
+			_shared_executor = ThreadPoolExecutor(max_workers=DEFAULT_MAX_WORKERS, thread_name_prefix='s3-batch')
+		return _shared_executor
+
+
+def _run_batch(items, work, executor=None, max_in_flight=None):
+	executor = executor or shared_executor()
+	# Sized for the shared executor, callers with a bigger executor of their own pass max_in_flight
+	max_in_flight = max_in_flight or DEFAULT_MAX_WORKERS * 2
+	items = iter(items)
+	in_flight = {}
+
+	def submit(count):
+		for s3_key, argument in itertools.islice(items, count):
+			in_flight[executor.submit(work, s3_key, argument)] = s3_key
+
+	# Keep a bounded window of submitted work so huge key lists are never materialised in the pool queue
+	submit(max_in_flight)
+	while in_flight:
+		done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+		for future in done:
+			s3_key = in_flight.pop(future)
+			error = future.exception()
+			if error is None:
+				yield BatchResult(s3_key=s3_key, ok=True, value=future.result())
+			else:
+				yield BatchResult(s3_key=s3_key, ok=False, error=error)
+		submit(len(done))
+
+
+def save_many(s3_client, s3_bucket, file_bodies=None, upload_file_paths=None, executor=None, max_in_flight=None):
+	# file_bodies and upload_file_paths are iterables of (s3_key, file_body) / (s3_key, upload_file_path) pairs.
+	# The value of each result is the ETag S3 assigned to the new object.
+	def save(s3_key, source):
+		kind, value = source
+		with observed_call('save_many', s3_bucket, s3_key) as call:
+			if kind == 'path':
+				# Streamed through put_body rather than upload_file, which does not return the new object's ETag
+				with open(value, 'rb') as f:
+					result = put_body(s3_client, s3_bucket, s3_key, f)['ETag']
+				call.bytes_moved = os.path.getsize(value)
+			else:
+				result = put_body(s3_client, s3_bucket, s3_key, value)['ETag']
+				call.bytes_moved = _body_size(value)
+		# Same as save_file, so an ExistenceIndex re-checks the key instead of answering from its listing
+		_notify_saved(s3_bucket, s3_key)
+		return result
+
+	items = itertools.chain(
+		((s3_key, ('body', file_body)) for s3_key, file_body in (file_bodies or [])),
+		((s3_key, ('path', upload_file_path)) for s3_key, upload_file_path in (upload_file_paths or []))
+		)
+	return _run_batch(items, save, executor=executor, max_in_flight=max_in_flight)
+
+
+def load_many(s3_client, s3_bucket, s3_keys, executor=None, max_in_flight=None, cache=None):
+	# s3_keys yields either plain keys, whose bodies are read into memory and returned as bytes,
+	# or (s3_key, save_to_path) pairs, which are downloaded to disk and return the path.
+	# With a DiskCache, plain keys are read through it and cost a 304 when unchanged.
+	def load(s3_key, save_to_path):
+		with observed_call('load_many', s3_bucket, s3_key) as call:
+			if save_to_path is not None:
+				s3_client.download_file(Bucket=s3_bucket, Key=s3_key, Filename=save_to_path)
+				call.bytes_moved = os.path.getsize(save_to_path)
+				return save_to_path
+			if cache is not None:
+				with cache.open(s3_client, s3_bucket, s3_key) as f:
+					body = f.read()
+			else:
+				body = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)['Body'].read()
+			call.bytes_moved = len(body)
+			return body
+
+	items = ((item, None) if isinstance(item, str) else tuple(item) for item in s3_keys)
+	return _run_batch(items, load, executor=executor, max_in_flight=max_in_flight)
+
+
+def exists_many(s3_client, s3_bucket, s3_keys, executor=None, max_in_flight=None):
+	# A missing key is a successful check with value False; only real failures (permissions, throttling, ...) are errors
+	def exists(s3_key, _):
+		with observed_call('exists_many', s3_bucket, s3_key):
+			try:
+				s3_client.head_object(Bucket=s3_bucket, Key=s3_key)
+				return True
+			except ClientError as e:
+				if e.response.get('Error', {}).get('Code') in NOT_FOUND_ERROR_CODES:
+					return False
+				raise
+
+	items = ((s3_key, None) for s3_key in s3_keys)
+	return _run_batch(items, exists, executor=executor, max_in_flight=max_in_flight)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# Read-through disk cache for load_file. Bodies are stored per bucket/key together with their ETag and
+# revalidated with a conditional GET (If-None-Match), so an unchanged object costs a 304 round trip and
+# no body transfer. Entries are evicted least-recently-used first to stay within max_bytes.
+
+from botocore.exceptions import ClientError
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+class DiskCache:
+
+	def __init__(self, cache_dir, max_bytes=64 * 1024 * 1024):
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		self.index_path = os.path.join(cache_dir, 'index.json')
+		self.lock = threading.Lock()
+		os.makedirs(cache_dir, exist_ok=True)
+		self.entries = self._read_index()
+
+	def _read_index(self):
+		try:
+			with open(self.index_path) as f:
+				entries = json.load(f)
+		except (OSError, ValueError):
+			return {}
+		# Drop entries whose body went missing, e.g. after someone cleaned the directory by hand
+		return {entry_id: entry for entry_id, entry in entries.items() if os.path.exists(self._body_path(entry_id))}
+
+	def _write_index(self):
+		fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+		with os.fdopen(fd, 'w') as f:
+			json.dump(self.entries, f)
+		os.replace(tmp_path, self.index_path)
+
+	def _entry_id(self, s3_bucket, s3_key):
+		return hashlib.sha256(f'{s3_bucket}/{s3_key}'.encode()).hexdigest()
+
+	def _body_path(self, entry_id):
+		return os.path.join(self.cache_dir, entry_id)
+
+	def _evict(self):
+		total = sum(entry['size'] for entry in self.entries.values())
+		for entry_id, entry in sorted(self.entries.items(), key=lambda item: item[1]['last_used']):
+			if total <= self.max_bytes:
+				break
+			total -= entry['size']
+			del self.entries[entry_id]
+			try:
+				os.remove(self._body_path(entry_id))
+			except FileNotFoundError:
+				pass
+
+	def _download(self, body):
+		# Runs without the lock, so one slow transfer never holds up the other loads
+		fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				shutil.copyfileobj(body, f)
+		except BaseException:
+			os.remove(tmp_path)
+			raise
+		return tmp_path
+
+	def _store(self, entry_id, s3_bucket, s3_key, etag, tmp_path):
+		os.replace(tmp_path, self._body_path(entry_id))
+		self.entries[entry_id] = {
+			'bucket': s3_bucket,
+			'key': s3_key,
+			'etag': etag,
+			'size': os.path.getsize(self._body_path(entry_id)),
+			'last_used': time.time()
+			}
+
+	def _open_cached(self, entry_id, etag):
+		with self.lock:
+			entry = self.entries.get(entry_id)
+			# Another thread may have replaced or evicted the entry while the request was in flight
+			if entry is None or entry['etag'] != etag:
+				return None
+			entry['last_used'] = time.time()
+			self._write_index()
+			return open(self._body_path(entry_id), 'rb')
+
+	def open(self, s3_client, s3_bucket, s3_key):
+		"""Return a binary file-like object with the current body of the key, revalidating any cached copy"""
+		entry_id = self._entry_id(s3_bucket, s3_key)
+		with self.lock:
+			entry = self.entries.get(entry_id)
+			cached_etag = entry['etag'] if entry is not None else None
+
+		arguments = {'Bucket': s3_bucket, 'Key': s3_key}
+		if cached_etag is not None:
+			arguments['IfNoneMatch'] = cached_etag
+
+		try:
+			response = s3_client.get_object(**arguments)
+
+		except ClientError as e:
+			if cached_etag is None or e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') != 304:
+				raise
+			cached = self._open_cached(entry_id, cached_etag)
+			if cached is not None:
+				logging.info(f'{s3_key} not modified since it was cached, serving it from {self.cache_dir}')
+				return cached
+			response = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
+
+		# Objects bigger than the whole budget would only evict everything else, so hand them straight through
+		if response['ContentLength'] > self.max_bytes:
+			with self.lock:
+				self.entries.pop(entry_id, None)
+			return response['Body']
+
+		tmp_path = self._download(response['Body'])
+		with self.lock:
+			self._store(entry_id, s3_bucket, s3_key, response['ETag'], tmp_path)
+			self._evict()
+			self._write_index()
+			return open(self._body_path(entry_id), 'rb')
+
+	def invalidate(self, s3_bucket, s3_key):
+		entry_id = self._entry_id(s3_bucket, s3_key)
+		with self.lock:
+			if self.entries.pop(entry_id, None) is not None:
+				try:
+					os.remove(self._body_path(entry_id))
+				except FileNotFoundError:
+					pass
+				self._write_index()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# An in-memory existence index for one bucket/prefix. The prefix is listed once with list_objects_v2
+# (1000 keys per page) and existence/metadata queries are then answered locally until the TTL runs out.
+# Keys written through save_file are invalidated straight away and re-checked with a single HEAD.
+
+from botocore.exceptions import ClientError
+from dataclasses import dataclass
+from s3_wrapper import NOT_FOUND_ERROR_CODES, add_save_listener, observed_call, remove_save_listener
+import datetime
+import logging
+import threading
+import time
+
+
+@dataclass
+class ObjectInfo:
+	s3_key: str
+	etag: str
+	size: int
+	last_modified: datetime.datetime
+
+
+class ExistenceIndex:
+
+	def __init__(self, s3_client, s3_bucket, prefix='', ttl_seconds=60):
+		self.s3_client = s3_client
+		self.s3_bucket = s3_bucket
+		self.prefix = prefix
+		self.ttl_seconds = ttl_seconds
+		self.objects = {}
+		# Invalidations are numbered, so a listing or HEAD that was already in flight when one arrived
+		# never clears it: {key: number of its latest invalidation}
+		self.invalidations = 0
+		self.stale_keys = {}
+		self.invalidated_all = 0
+		self.loaded_at = None
+		self.lock = threading.RLock()
+		add_save_listener(self._on_save)
+
+	def close(self):
+		remove_save_listener(self._on_save)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def covers(self, s3_bucket, s3_key):
+		return s3_bucket == self.s3_bucket and s3_key.startswith(self.prefix)
+
+	def refresh(self):
+		with self.lock:
+			started = self.invalidations
+		objects = {}
+		paginator = self.s3_client.get_paginator('list_objects_v2')
+		with observed_call('index_refresh', self.s3_bucket, self.prefix):
+			for page in paginator.paginate(Bucket=self.s3_bucket, Prefix=self.prefix):
+				for item in page.get('Contents', []):
+					objects[item['Key']] = ObjectInfo(
+						s3_key=item['Key'],
+						etag=item['ETag'],
+						size=item['Size'],
+						last_modified=item['LastModified']
+						)
+		with self.lock:
+			self.objects = objects
+			# Keys saved while the listing was running may be listed with their old ETag/size, or not at all
+			self.stale_keys = {s3_key: number for s3_key, number in self.stale_keys.items() if number > started}
+			if self.invalidated_all <= started:
+				self.loaded_at = time.monotonic()
+		logging.info(f'Indexed {len(objects)} objects under s3://{self.s3_bucket}/{self.prefix}')
+
+	def invalidate(self, s3_key=None):
+		with self.lock:
+			self.invalidations += 1
+			if s3_key is None:
+				self.invalidated_all = self.invalidations
+				self.loaded_at = None
+			else:
+				self.stale_keys[s3_key] = self.invalidations
+
+	def _on_save(self, s3_bucket, s3_key):
+		if self.covers(s3_bucket, s3_key):
+			self.invalidate(s3_key)
+
+	def _expired(self):
+		return self.loaded_at is None or (time.monotonic() - self.loaded_at) > self.ttl_seconds
+
+	def _recheck(self, s3_key):
+		# A key written since the last listing: one HEAD brings its entry up to date again
+		with self.lock:
+			mark = self.stale_keys.get(s3_key)
+		with observed_call('index_recheck', self.s3_bucket, s3_key):
+			try:
+				response = self.s3_client.head_object(Bucket=self.s3_bucket, Key=s3_key)
+				info = ObjectInfo(
+					s3_key=s3_key,
+					etag=response['ETag'],
+					size=response['ContentLength'],
+					last_modified=response['LastModified']
+					)
+			except ClientError as e:
+				if e.response.get('Error', {}).get('Code') not in NOT_FOUND_ERROR_CODES:
+					raise
+				info = None
+
+		with self.lock:
+			if info is None:
+				self.objects.pop(s3_key, None)
+			else:
+				self.objects[s3_key] = info
+			# Saved again while the HEAD was in flight: leave it stale for the next lookup
+			if self.stale_keys.get(s3_key) == mark:
+				self.stale_keys.pop(s3_key, None)
+		return info
+
+	def metadata(self, s3_key):
+		if not s3_key.startswith(self.prefix):
+			raise KeyError(f'{s3_key} is outside of the indexed prefix {self.prefix}')
+		if self._expired():
+			self.refresh()
+		with self.lock:
+			stale = s3_key in self.stale_keys
+			info = self.objects.get(s3_key)
+		if stale:
+			info = self._recheck(s3_key)
+		return info
+
+	def exists(self, s3_key):
+		return self.metadata(s3_key) is not None
+
+	def keys(self):
+		if self._expired():
+			self.refresh()
+		with self.lock:
+			stale_keys = list(self.stale_keys)
+		for s3_key in stale_keys:
+			self._recheck(s3_key)
+		with self.lock:
+			return sorted(self.objects)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+# Instrumentation for s3_wrapper. save_file/load_file/file_exists, every item of save_many/load_many/
+# exists_many and every ExistenceIndex listing or re-check report a call (timing, bytes moved, outcome)
+# and, once a client is instrumented, botocore reports retries and SlowDown throttling per API request.
+# The default is a no-op; Prometheus text exposition and StatsD emitters are provided.
+
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import socket
+import threading
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+THROTTLING_ERROR_CODES = ('SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', '503')
+
+
+def _escape(value):
+	# Label values are quoted in the exposition format, so backslashes, quotes and newlines need escaping
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def key_prefix(s3_key):
+	# Label calls by "directory" rather than key, so slow prefixes stand out without a series per key
+	return s3_key.rpartition('/')[0] + '/' if '/' in s3_key else ''
+
+
+class NullInstrumentation:
+
+	def observe_call(self, operation, s3_bucket, s3_key, seconds, bytes_moved, ok):
+		pass
+
+	def observe_request(self, api_operation, retries, throttled):
+		pass
+
+
+class PrometheusInstrumentation(NullInstrumentation):
+
+	def __init__(self, buckets=DURATION_BUCKETS):
+		self.buckets = buckets
+		self.lock = threading.Lock()
+		self.histograms = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+		self.duration_sums = defaultdict(float)
+		self.calls = defaultdict(int)
+		self.bytes = defaultdict(int)
+		self.requests = defaultdict(int)
+		self.retries = defaultdict(int)
+		self.throttles = defaultdict(int)
+
+	def observe_call(self, operation, s3_bucket, s3_key, seconds, bytes_moved, ok):
+		labels = (operation, s3_bucket, key_prefix(s3_key))
+		with self.lock:
+			counts = self.histograms[labels]
+			for i, bound in enumerate(self.buckets):
+				if seconds <= bound:
+					counts[i] += 1
+			counts[-1] += 1
+			self.duration_sums[labels] += seconds
+			self.calls[labels + ('ok' if ok else 'error',)] += 1
+			self.bytes[labels] += bytes_moved or 0
+
+	def observe_request(self, api_operation, retries, throttled):
+		with self.lock:
+			self.requests[api_operation] += 1
+			self.retries[api_operation] += retries
+			self.throttles[api_operation] += 1 if throttled else 0
+
+	def render(self):
+		def fmt(names, values):
+			return ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+		call_labels = ('operation', 'bucket', 'prefix')
+		lines = []
+		with self.lock:
+			lines.append('# TYPE s3_wrapper_call_duration_seconds histogram')
+			for labels, counts in sorted(self.histograms.items()):
+				for bound, count in zip(self.buckets, counts):
+					lines.append(f's3_wrapper_call_duration_seconds_bucket{{{fmt(call_labels, labels)},le="{bound}"}} {count}')
+				lines.append(f's3_wrapper_call_duration_seconds_bucket{{{fmt(call_labels, labels)},le="+Inf"}} {counts[-1]}')
+				lines.append(f's3_wrapper_call_duration_seconds_sum{{{fmt(call_labels, labels)}}} {self.duration_sums[labels]}')
+				lines.append(f's3_wrapper_call_duration_seconds_count{{{fmt(call_labels, labels)}}} {counts[-1]}')
+			lines.append('# TYPE s3_wrapper_calls_total counter')
+			for labels, count in sorted(self.calls.items()):
+				lines.append(f's3_wrapper_calls_total{{{fmt(call_labels + ("outcome",), labels)}}} {count}')
+			lines.append('# TYPE s3_wrapper_bytes_total counter')
+			for labels, count in sorted(self.bytes.items()):
+				lines.append(f's3_wrapper_bytes_total{{{fmt(call_labels, labels)}}} {count}')
+			for name, series in (('requests', self.requests), ('retries', self.retries), ('throttled_requests', self.throttles)):
+				lines.append(f'# TYPE s3_wrapper_{name}_total counter')
+				for api_operation, count in sorted(series.items()):
+					lines.append(f's3_wrapper_{name}_total{{api_operation="{_escape(api_operation)}"}} {count}')
+		return '\n'.join(lines) + '\n'
+
+	def serve(self, port, host='0.0.0.0'):
+		"""Serve the metrics for scraping on http://host:port/metrics from a daemon thread"""
+		instrumentation = self
+
+		class MetricsHandler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split('?')[0] != '/metrics':
+					self.send_error(404)
+					return
+				body = instrumentation.render().encode()
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+
+		server = ThreadingHTTPServer((host, port), MetricsHandler)
+		threading.Thread(target=server.serve_forever, daemon=True, name='s3-metrics').start()
+		return server
+
+
+class StatsdInstrumentation(NullInstrumentation):
+
+	def __init__(self, host='localhost', port=8125, prefix='s3_wrapper'):
+		self.address = (host, port)
+		self.prefix = prefix
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+	def _send(self, *metrics):
+		try:
+			self.socket.sendto('\n'.join(metrics).encode(), self.address)
+		except OSError:
+			# Metrics are best effort, never fail an S3 call because the agent is away
+			pass
+
+	def observe_call(self, operation, s3_bucket, s3_key, seconds, bytes_moved, ok):
+		name = f'{self.prefix}.{operation}'
+		self._send(
+			f'{name}.duration:{seconds * 1000:.3f}|ms',
+			f'{name}.bytes:{bytes_moved or 0}|c',
+			f'{name}.{"ok" if ok else "error"}:1|c'
+			)
+
+	def observe_request(self, api_operation, retries, throttled):
+		name = f'{self.prefix}.api.{api_operation}'
+		metrics = [f'{name}.requests:1|c']
+		if retries:
+			metrics.append(f'{name}.retries:{retries}|c')
+		if throttled:
+			metrics.append(f'{name}.throttled:1|c')
+		self._send(*metrics)
+
+
+def instrument_client(s3_client, instrumentation):
+	"""Report retries and throttling of every API request made through s3_client"""
+	throttled_requests = threading.local()
+
+	def on_needs_retry(response=None, operation=None, **kwargs):
+		# Emitted after every attempt; the parsed error tells us whether S3 asked us to slow down
+		if response is not None:
+			code = response[1].get('Error', {}).get('Code')
+			if code in THROTTLING_ERROR_CODES:
+				throttled_requests.throttled = True
+
+	def on_after_call(parsed=None, model=None, **kwargs):
+		retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+		throttled = getattr(throttled_requests, 'throttled', False)
+		throttled_requests.throttled = False
+		instrumentation.observe_request(model.name if model is not None else 'unknown', retries, throttled)
+
+	s3_client.meta.events.register('needs-retry.s3', on_needs_retry)
+	s3_client.meta.events.register('after-call.s3', on_after_call)
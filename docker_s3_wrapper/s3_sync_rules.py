@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+# Declarative mirroring of derived keys. A rules file lists source key, destination key and transform:
+#
+#   {"bucket": "xxxx", "rules": [{"source": "a/timestamp", "destination": "a/timestamp_epoch", "transform": "epoch"}]}
+#
+# Every pass lists each prefix involved once (instead of a HEAD per key), GETs only the sources whose
+# ETag moved, concurrently, and only writes destinations whose derived value differs from what is stored.
+
+from dataclasses import dataclass
+from s3_batch import load_many, save_many, shared_executor
+from s3_index import ExistenceIndex
+import dateutil.parser
+import gzip
+import hashlib
+import json
+import logging
+
+
+def epoch_transform(body):
+	return str(int(dateutil.parser.parse(body.decode().strip()).timestamp())).encode()
+
+
+def copy_transform(body):
+	return body
+
+
+def gzip_transform(body):
+	# mtime=0 keeps the output byte-for-byte stable, so an unchanged source never looks changed
+	return gzip.compress(body, mtime=0)
+
+
+TRANSFORMS = {
+	'epoch': epoch_transform,
+	'copy': copy_transform,
+	'gzip': gzip_transform,
+	}
+
+
+@dataclass(frozen=True)
+class SyncRule:
+	source: str
+	destination: str
+	transform: str = 'copy'
+
+
+def load_rules(rules_path):
+	with open(rules_path) as f:
+		config = json.load(f)
+	rules = [SyncRule(**rule) for rule in config['rules']]
+	for rule in rules:
+		if rule.transform not in TRANSFORMS:
+			raise ValueError(f'Unknown transform \'{rule.transform}\' for {rule.source}, expected one of {sorted(TRANSFORMS)}')
+	return config['bucket'], rules
+
+
+def _prefix(s3_key):
+	return s3_key.rpartition('/')[0] + '/' if '/' in s3_key else ''
+
+
+def _md5_etag(body):
+	return '"' + hashlib.md5(body).hexdigest() + '"'
+
+
+class SyncEngine:
+
+	def __init__(self, s3_client, s3_bucket, rules, executor=None, cache=None):
+		self.s3_client = s3_client
+		self.s3_bucket = s3_bucket
+		self.rules = rules
+		self.executor = executor
+		# Optional DiskCache for source bodies: after a restart every rule is pending again, and unchanged
+		# sources then cost a 304 instead of a full GET
+		self.cache = cache
+		prefixes = {_prefix(s3_key) for rule in rules for s3_key in (rule.source, rule.destination)}
+		# Refreshed explicitly once per pass, never lazily in between
+		self.indexes = {prefix: ExistenceIndex(s3_client, s3_bucket, prefix, ttl_seconds=float('inf')) for prefix in sorted(prefixes)}
+		# (source ETag, destination ETag) per rule as of the last pass that left it in sync
+		self.in_sync = {}
+
+	def keys(self):
+		return sorted({s3_key for rule in self.rules for s3_key in (rule.source, rule.destination)})
+
+	def _etag(self, s3_key):
+		info = self.indexes[_prefix(s3_key)].objects.get(s3_key)
+		return None if info is None else info.etag
+
+	def run_once(self):
+		# One LIST per prefix, run concurrently
+		executor = self.executor or shared_executor()
+		list(executor.map(lambda index: index.refresh(), self.indexes.values()))
+
+		pending = []
+		for rule in self.rules:
+			source_etag = self._etag(rule.source)
+			if source_etag is None:
+				logging.info(f'No \'{rule.source}\' file exists, nothing to mirror into \'{rule.destination}\'')
+				continue
+			if self.in_sync.get(rule) == (source_etag, self._etag(rule.destination)):
+				continue
+			pending.append(rule)
+
+		if not pending:
+			logging.info(f'All {len(self.rules)} rule(s) up to date, no update required!')
+			return 0
+
+		bodies = {}
+		for result in load_many(self.s3_client, self.s3_bucket, sorted({rule.source for rule in pending}), executor=self.executor, cache=self.cache):
+			if result.ok:
+				bodies[result.s3_key] = result.value
+			else:
+				logging.error(f'Failed to load \'{result.s3_key}\': {result.error}')
+
+		writes = {}
+		for rule in pending:
+			if rule.source not in bodies:
+				continue
+			try:
+				derived = TRANSFORMS[rule.transform](bodies[rule.source])
+			except Exception as err:
+				logging.info(f'Error occurred: {err}')
+				logging.info(f'\'{rule.source}\' file can not be transformed with \'{rule.transform}\', or the file is empty!')
+				continue
+
+			# Single-part PUT ETags on unencrypted or SSE-S3 buckets are the MD5 of the body, so there an unchanged
+			# destination needs no GET to compare. Elsewhere (SSE-KMS, multipart) it is written once and then
+			# recognised by the ETag its PUT returned.
+			destination_etag = self._etag(rule.destination)
+			if _md5_etag(derived) == destination_etag:
+				self.in_sync[rule] = (self._etag(rule.source), destination_etag)
+			else:
+				logging.info(f'\'{rule.source}\' has been updated, update to \'{rule.destination}\' file required!')
+				writes[rule.destination] = (rule, derived)
+
+		written = 0
+		file_bodies = [(destination, derived) for destination, (_, derived) in writes.items()]
+		for result in save_many(self.s3_client, self.s3_bucket, file_bodies=file_bodies, executor=self.executor):
+			rule, derived = writes[result.s3_key]
+			if result.ok:
+				written += 1
+				self.in_sync[rule] = (self._etag(rule.source), result.value)
+				logging.info(f'\'{result.s3_key}\' file in S3 \'{self.s3_bucket}\' bucket has been updated successfully with value \'{derived[:64]!r}\'!')
+			else:
+				logging.error(f'Failed to update \'{result.s3_key}\': {result.error}')
+		return written
+
+	def close(self):
+		for index in self.indexes.values():
+			index.close()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import math
+import os
+import threading
+import time
+
+MB = 1024 * 1024
+
+# S3 rejects multipart parts smaller than 5 MiB (except the last one)
+MIN_PART_SIZE = 5 * MB
+
+# Size of the reads used when streaming a GET body to disk
+READ_CHUNK_SIZE = 256 * 1024
+
+RETRYABLE_ERROR_CODES = (
+	'SlowDown',
+	'Throttling',
+	'RequestTimeout',
+	'RequestTimeTooSkewed',
+	'InternalError',
+	'ServiceUnavailable',
+	'500',
+	'503',
+	)
+
+
+def is_retryable(error):
+	if isinstance(error, ClientError):
+		code = error.response.get('Error', {}).get('Code')
+		status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+		return code in RETRYABLE_ERROR_CODES or status >= 500
+	return isinstance(error, (BotoCoreError, OSError))
+
+
+class BandwidthLimiter:
+	"""Token bucket shared by every worker of a transfer, so the cap applies to the transfer as a whole"""
+
+	def __init__(self, max_bytes_per_second):
+		self.rate = max_bytes_per_second
+		self.tokens = max_bytes_per_second
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def consume(self, amount):
+		if not self.rate:
+			return
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			self.tokens -= amount
+			deficit = -self.tokens
+		# Callers may ask for more than one second's worth at once, so let the bucket go negative
+		# and sleep the debt off instead of refusing the request
+		if deficit > 0:
+			time.sleep(deficit / self.rate)
+
+
+class TransferEngine:
+	"""Parallel multipart uploads and ranged-GET downloads with per-part retries.
+
+	The s3_client should be created with a botocore Config whose max_pool_connections is at least
+	max_workers, otherwise the extra workers just queue up for a connection.
+	"""
+
+	def __init__(self, s3_client, part_size=8 * MB, max_workers=10, max_bandwidth=None, max_retries=3, retry_backoff=0.5):
+		if part_size < MIN_PART_SIZE:
+			raise ValueError(f'part_size must be at least {MIN_PART_SIZE} bytes')
+		if max_workers < 1:
+			raise ValueError('max_workers must be at least 1')
+		self.s3_client = s3_client
+		self.part_size = part_size
+		self.max_workers = max_workers
+		self.max_retries = max_retries
+		self.retry_backoff = retry_backoff
+		self.limiter = BandwidthLimiter(max_bandwidth)
+
+	def _with_retries(self, description, function, *args, **kwargs):
+		attempt = 0
+		while True:
+			try:
+				return function(*args, **kwargs)
+			except Exception as e:
+				if attempt >= self.max_retries or not is_retryable(e):
+					raise
+				attempt += 1
+				delay = self.retry_backoff * (2 ** (attempt - 1))
+				logging.info(f'{description} failed ({e}), retry {attempt}/{self.max_retries} in {delay}s')
+				time.sleep(delay)
+
+	def _part_ranges(self, size):
+		number_of_parts = max(1, math.ceil(size / self.part_size))
+		return [(number, (number - 1) * self.part_size, min(size, number * self.part_size)) for number in range(1, number_of_parts + 1)]
+
+	def upload_file(self, s3_bucket, s3_key, upload_file_path, extra_args=None):
+		extra_args = extra_args or {}
+		size = os.path.getsize(upload_file_path)
+
+		if size <= self.part_size:
+			def put():
+				with open(upload_file_path, 'rb') as f:
+					body = f.read()
+				self.limiter.consume(len(body))
+				return self.s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=body, **extra_args)
+			return self._with_retries(f'put_object {s3_key}', put)
+
+		upload_id = self.s3_client.create_multipart_upload(Bucket=s3_bucket, Key=s3_key, **extra_args)['UploadId']
+
+		def upload_part(part):
+			number, start, end = part
+			with open(upload_file_path, 'rb') as f:
+				f.seek(start)
+				body = f.read(end - start)
+
+			def send():
+				self.limiter.consume(len(body))
+				return self.s3_client.upload_part(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id, PartNumber=number, Body=body)
+
+			response = self._with_retries(f'upload_part {s3_key} #{number}', send)
+			return {'PartNumber': number, 'ETag': response['ETag']}
+
+		try:
+			with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+				parts = list(executor.map(upload_part, self._part_ranges(size)))
+			return self.s3_client.complete_multipart_upload(
+				Bucket=s3_bucket,
+				Key=s3_key,
+				UploadId=upload_id,
+				MultipartUpload={'Parts': parts}
+				)
+
+		except Exception:
+			# Don't leave orphaned parts behind, they are billed until the upload is aborted
+			self.s3_client.abort_multipart_upload(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id)
+			raise
+
+	def upload_fileobj(self, s3_bucket, s3_key, fileobj, extra_args=None):
+		# For bodies of unknown length: parts are read sequentially and uploaded in parallel, holding at
+		# most 2 * max_workers parts in memory at once. A body that fits in one part is a plain PUT.
+		extra_args = extra_args or {}
+		first_part = fileobj.read(self.part_size)
+		second_part = fileobj.read(self.part_size) if len(first_part) == self.part_size else b''
+
+		if not second_part:
+			def put():
+				self.limiter.consume(len(first_part))
+				return self.s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=first_part, **extra_args)
+			return self._with_retries(f'put_object {s3_key}', put)
+
+		upload_id = self.s3_client.create_multipart_upload(Bucket=s3_bucket, Key=s3_key, **extra_args)['UploadId']
+		slots = threading.BoundedSemaphore(self.max_workers * 2)
+
+		def upload_part(number, body):
+			def send():
+				self.limiter.consume(len(body))
+				return self.s3_client.upload_part(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id, PartNumber=number, Body=body)
+
+			try:
+				response = self._with_retries(f'upload_part {s3_key} #{number}', send)
+				return {'PartNumber': number, 'ETag': response['ETag']}
+			finally:
+				slots.release()
+
+		try:
+			futures = []
+			with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+				number = 0
+				body = first_part
+				while body:
+					number += 1
+					slots.acquire()
+					futures.append(executor.submit(upload_part, number, body))
+					body = second_part if number == 1 else fileobj.read(self.part_size)
+			parts = [future.result() for future in futures]
+			return self.s3_client.complete_multipart_upload(
+				Bucket=s3_bucket,
+				Key=s3_key,
+				UploadId=upload_id,
+				MultipartUpload={'Parts': parts}
+				)
+
+		except Exception:
+			self.s3_client.abort_multipart_upload(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id)
+			raise
+
+	def download_file(self, s3_bucket, s3_key, save_to_path):
+		head = self.s3_client.head_object(Bucket=s3_bucket, Key=s3_key)
+		size = head['ContentLength']
+		etag = head['ETag']
+
+		# Download next to the destination and rename at the end, so readers never see a partial file
+		partial_path = save_to_path + '.part'
+		with open(partial_path, 'wb') as f:
+			f.truncate(size)
+
+		def download_part(part):
+			number, start, end = part
+
+			def fetch():
+				arguments = {'Bucket': s3_bucket, 'Key': s3_key, 'IfMatch': etag}
+				if size > 0:
+					arguments['Range'] = f'bytes={start}-{end - 1}'
+				body = self.s3_client.get_object(**arguments)['Body']
+				with open(partial_path, 'r+b') as f:
+					f.seek(start)
+					for chunk in iter(lambda: body.read(READ_CHUNK_SIZE), b''):
+						self.limiter.consume(len(chunk))
+						f.write(chunk)
+
+			self._with_retries(f'get_object {s3_key} #{number}', fetch)
+
+		try:
+			with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+				list(executor.map(download_part, self._part_ranges(size)))
+			os.replace(partial_path, save_to_path)
+			return save_to_path
+
+		except Exception:
+			if os.path.exists(partial_path):
+				os.remove(partial_path)
+			raise
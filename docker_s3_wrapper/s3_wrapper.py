@@ -1,19 +1,243 @@
 #!/usr/bin/env python3
 
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 from boto3 import client
+from s3_metrics import NullInstrumentation, instrument_client
+from s3_transfer import TransferEngine
+from dataclasses import dataclass
+from typing import Optional
+import contextlib
+import functools
+import gzip
+import hashlib
+import io
 import logging
-import os
 import datetime
+import inspect
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# Error codes S3 answers with when a key does not exist (HEAD has no body, so it only carries the status)
+NOT_FOUND_ERROR_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+# User metadata carrying the SHA-256 of the uncompressed body, so multipart and compressed objects
+# (whose ETag is not a plain MD5 of the payload) can still be compared by save_file(dedup=True)
+CONTENT_SHA256_METADATA = 'content-sha256'
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Callables notified with (s3_bucket, s3_key) after save_file writes a key, e.g. to invalidate an ExistenceIndex
+_save_listeners = []
+
+def add_save_listener(listener):
+	_save_listeners.append(listener)
+
+def remove_save_listener(listener):
+	if listener in _save_listeners:
+		_save_listeners.remove(listener)
+
+def _notify_saved(s3_bucket, s3_key):
+	for listener in list(_save_listeners):
+		listener(s3_bucket, s3_key)
+
+# Receives observe_call() for every save_file/load_file/file_exists call, and for every item of the
+# s3_batch functions and ExistenceIndex listing, see s3_metrics
+_instrumentation = NullInstrumentation()
+
+# The CallObservation of the instrumented save_file/load_file/file_exists call running on each thread
+_current_call = threading.local()
+
+def set_instrumentation(instrumentation, s3_client=None):
+	# Passing the client as well also reports per-request retries and SlowDown throttling
+	global _instrumentation
+	_instrumentation = instrumentation
+	if s3_client is not None:
+		instrument_client(s3_client, instrumentation)
+
+@dataclass
+class CallObservation:
+	# Left as None, ok means the call did not raise and bytes_moved is 0
+	ok: Optional[bool] = None
+	bytes_moved: Optional[int] = None
+
+@contextlib.contextmanager
+def observed_call(operation, s3_bucket, s3_key):
+	# Reports the body as one call of operation; it sets ok/bytes_moved on the yielded CallObservation,
+	# and an exception always counts as an error
+	call = CallObservation()
+	start = time.perf_counter()
+	try:
+		yield call
+	except BaseException:
+		call.ok = False
+		raise
+	finally:
+		ok = call.ok is not False
+		_instrumentation.observe_call(operation, s3_bucket, s3_key, time.perf_counter() - start, (call.bytes_moved or 0) if ok else 0, ok)
+
+def _body_size(file_body):
+	if isinstance(file_body, str):
+		return len(file_body.encode())
+	if isinstance(file_body, (bytes, bytearray, memoryview)):
+		return len(file_body)
+	return 0
+
+def _bytes_moved(arguments):
+	for path in (arguments.get('upload_file_path'), arguments.get('save_to_path')):
+		if path is not None and os.path.exists(path):
+			return os.path.getsize(path)
+	return _body_size(arguments.get('file_body'))
+
+def _instrumented(function):
+	signature = inspect.signature(function)
+
+	@functools.wraps(function)
+	def wrapper(*args, **kwargs):
+		arguments = signature.bind(*args, **kwargs).arguments
+		with observed_call(function.__name__, arguments.get('s3_bucket'), arguments.get('s3_key')) as call:
+			# Restore the outer call's observation afterwards, an instrumented call can run inside another
+			outer_call = getattr(_current_call, 'observation', None)
+			_current_call.observation = call
+			try:
+				result = function(*args, **kwargs)
+			finally:
+				_current_call.observation = outer_call
+			# The wrapper reports failures as False/None, unless the function decided the outcome itself
+			if call.ok is None:
+				call.ok = result is not None and result is not False
+			if call.bytes_moved is None:
+				call.bytes_moved = _bytes_moved(arguments)
+		return result
+
+	return wrapper
+
+def put_body(s3_client, s3_bucket, s3_key, file_body, transfer_engine=None, extra_args=None):
+	# Uploads straight from memory: bytes, str and memoryview bodies up to one part go up as a single
+	# put_object, anything larger (or a file-like object of unknown length) as a multipart upload
+	extra_args = extra_args or {}
+	if isinstance(file_body, str):
+		file_body = file_body.encode()
+	transfer_engine = transfer_engine or TransferEngine(s3_client)
+
+	if isinstance(file_body, (bytes, bytearray, memoryview)):
+		if len(file_body) <= transfer_engine.part_size:
+			return s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=bytes(file_body), **extra_args)
+		file_body = io.BytesIO(file_body)
+
+	return transfer_engine.upload_fileobj(s3_bucket=s3_bucket, s3_key=s3_key, fileobj=file_body, extra_args=extra_args)
+
+def _spool(file_body=None, upload_file_path=None):
+	# Hash the payload in one streaming pass, keeping a re-readable copy of it for the upload
+	md5 = hashlib.md5()
+	sha256 = hashlib.sha256()
+	if upload_file_path is not None:
+		spooled = open(upload_file_path, 'rb')
+		source = spooled
+	else:
+		if isinstance(file_body, str):
+			file_body = file_body.encode()
+		source = io.BytesIO(file_body) if isinstance(file_body, (bytes, bytearray, memoryview)) else file_body
+		spooled = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024)
+
+	for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+		md5.update(chunk)
+		sha256.update(chunk)
+		if spooled is not source:
+			spooled.write(chunk)
+	spooled.seek(0)
+	return spooled, md5.hexdigest(), sha256.hexdigest()
+
+def _stored_copy_matches(s3_client, s3_bucket, s3_key, md5_hex, sha256_hex):
+	try:
+		response = s3_client.head_object(Bucket=s3_bucket, Key=s3_key)
+	except ClientError as e:
+		if e.response.get('Error', {}).get('Code') in NOT_FOUND_ERROR_CODES:
+			return False
+		raise
+	if response.get('Metadata', {}).get(CONTENT_SHA256_METADATA) == sha256_hex:
+		return True
+	# Objects uploaded without our metadata: a single-part, uncompressed object's ETag is the MD5 of its body
+	etag = response['ETag'].strip('"')
+	return '-' not in etag and not response.get('ContentEncoding') and etag == md5_hex
+
+def _compress(source, compression):
+	compressed = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024)
+	if compression == 'gzip':
+		# mtime=0 so identical payloads always compress to identical bytes
+		with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as f:
+			shutil.copyfileobj(source, f)
+	elif compression == 'zstd':
+		import zstandard  # pip install zstandard, only needed for compression='zstd'
+		zstandard.ZstdCompressor().copy_stream(source, compressed)
+	else:
+		raise ValueError(f'Unsupported compression \'{compression}\', expected \'gzip\' or \'zstd\'')
+	compressed.seek(0)
+	return compressed
+
+def _save_with_options(s3_client, s3_bucket, s3_key, file_body, upload_file_path, transfer_engine, dedup, compression):
+	spooled, md5_hex, sha256_hex = _spool(file_body=file_body, upload_file_path=upload_file_path)
+	with spooled:
+		if dedup and _stored_copy_matches(s3_client, s3_bucket, s3_key, md5_hex, sha256_hex):
+			logging.info(f'{s3_key} in {s3_bucket} already has identical content, skipping upload')
+			return True
+
+		extra_args = {'Metadata': {CONTENT_SHA256_METADATA: sha256_hex}}
+		body = spooled
+		if compression is not None:
+			body = _compress(spooled, compression)
+			extra_args['ContentEncoding'] = compression
+
+		with body:
+			put_body(s3_client, s3_bucket, s3_key, body, transfer_engine=transfer_engine, extra_args=extra_args)
+	_notify_saved(s3_bucket, s3_key)
+	return True
+
+@_instrumented
+def save_file(s3_client, s3_bucket, s3_key, file_body=None, upload_file_path=None, transfer_engine=None, dedup=False, compression=None):
+	# dedup=True skips the upload when the stored object already has the same content (one HEAD),
+	# compression='gzip' or 'zstd' uploads the body compressed with a matching Content-Encoding
+	if (dedup or compression is not None) and (upload_file_path is not None or file_body is not None):
+		try:
+			return _save_with_options(
+				s3_client=s3_client,
+				s3_bucket=s3_bucket,
+				s3_key=s3_key,
+				file_body=file_body,
+				upload_file_path=upload_file_path,
+				transfer_engine=transfer_engine,
+				dedup=dedup,
+				compression=compression
+				)
+
+		except (ClientError, BotoCoreError, OSError) as e:
+			logging.error(e)
+			return False
+
+	elif (upload_file_path is not None) and (transfer_engine is not None):
+		try:
+			response = transfer_engine.upload_file(
+				s3_bucket=s3_bucket,
+				s3_key=s3_key,
+				upload_file_path=upload_file_path
+				)
+			_notify_saved(s3_bucket, s3_key)
+			return True
+
+		except (ClientError, BotoCoreError) as e:
+			logging.error(e)
+			return False
 
-def save_file(s3_client, s3_bucket, s3_key, file_body=None, upload_file_path=None):
-	if (upload_file_path is not None):
+	elif (upload_file_path is not None):
 		try:
 			response = s3_client.upload_file(
 				Bucket=s3_bucket,
 				Key=s3_key,
 				Filename=upload_file_path
 				)
+			_notify_saved(s3_bucket, s3_key)
 			return True
 
 		except ClientError as e:
@@ -22,14 +246,17 @@ def save_file(s3_client, s3_bucket, s3_key, file_body=None, upload_file_path=Non
 
 	elif (upload_file_path is None) and (file_body is not None):
 		try:
-			response = s3_client.put_object(
-				Bucket=s3_bucket,
-				Key=s3_key,
-				Body=file_body
+			response = put_body(
+				s3_client=s3_client,
+				s3_bucket=s3_bucket,
+				s3_key=s3_key,
+				file_body=file_body,
+				transfer_engine=transfer_engine
 				)
+			_notify_saved(s3_bucket, s3_key)
 			return True
 
-		except ClientError as e:
+		except (ClientError, BotoCoreError) as e:
 			logging.error(e)
 			return False
 
@@ -37,8 +264,41 @@ def save_file(s3_client, s3_bucket, s3_key, file_body=None, upload_file_path=Non
 		logging.info("No file_body or upload_file_path provided!")
 		
 
-def load_file(s3_client, s3_bucket, s3_key, save_to_path=None):
-	if (save_to_path is not None):
+@_instrumented
+def load_file(s3_client, s3_bucket, s3_key, save_to_path=None, transfer_engine=None, cache=None):
+	if (cache is not None):
+		try:
+			body = cache.open(s3_client, s3_bucket, s3_key)
+
+		except (ClientError, BotoCoreError, OSError) as e:
+			logging.error(e)
+			return None
+
+		if (save_to_path is None):
+			return body
+
+		try:
+			with body, open(save_to_path, 'wb') as f:
+				shutil.copyfileobj(body, f)
+			return save_to_path
+
+		except (ClientError, BotoCoreError, OSError) as e:
+			logging.error(e)
+			return None
+
+	elif (save_to_path is not None) and (transfer_engine is not None):
+		try:
+			return transfer_engine.download_file(
+				s3_bucket=s3_bucket,
+				s3_key=s3_key,
+				save_to_path=save_to_path
+				)
+
+		except (ClientError, BotoCoreError) as e:
+			logging.error(e)
+			return None
+
+	elif (save_to_path is not None):
 		try:
 			response = s3_client.download_file(
 				Bucket=s3_bucket,
@@ -58,6 +318,7 @@ def load_file(s3_client, s3_bucket, s3_key, save_to_path=None):
 				Key=s3_key
 				)
 
+			_current_call.observation.bytes_moved = response['ContentLength']
 			return response['Body']
 
 		except ClientError as e:
@@ -67,7 +328,18 @@ def load_file(s3_client, s3_bucket, s3_key, save_to_path=None):
 	else:
 		return None
 	
-def file_exists(s3_client, s3_bucket, s3_key):
+@_instrumented
+def file_exists(s3_client, s3_bucket, s3_key, existence_index=None):
+	if (existence_index is not None) and existence_index.covers(s3_bucket, s3_key):
+		try:
+			exists = existence_index.exists(s3_key)
+			_current_call.observation.ok = True
+			return exists
+
+		except ClientError as e:
+			logging.error(e)
+			return False
+
 	try:
 		response = s3_client.head_object(
 			Bucket=s3_bucket,
@@ -76,7 +348,12 @@ def file_exists(s3_client, s3_bucket, s3_key):
 		return True
 
 	except ClientError as e:
-		logging.error(e)
+		# A missing key is an expected answer, not an error
+		if e.response.get('Error', {}).get('Code') in NOT_FOUND_ERROR_CODES:
+			logging.info(f'{s3_key} does not exist in {s3_bucket}')
+			_current_call.observation.ok = True
+		else:
+			logging.error(e)
 		return False
 
 def main():
@@ -97,23 +374,17 @@ def main():
 	s3_key_save_file = 'assignments/infra/timestamp_usman'
 	s3_key_load_file = 'assignments/infra/timestamp_usman'
 	s3_key_file_exists = 'assignments/infra/timestamp_usman'
-	#file_body = 'Foo!'
 
-	#Create 'timestamp_usman' file with current epoch time on the fly so it can be used for save_file
+	#Upload the current epoch time straight from memory, no local 'timestamp_usman' file needed
 	timestamp_now_epoch = int(datetime.datetime.now().timestamp())
-	timestamp_usman_filename = "timestamp_usman"
-	os.system(f'touch {timestamp_usman_filename}')
-	os.system(f'echo {timestamp_now_epoch} > {timestamp_usman_filename}')
-	current_working_directory = str(os.getcwd())
-	upload_file_path = (current_working_directory + '/' + timestamp_usman_filename)
-	logging.info(f'\'{timestamp_usman_filename}\' file created in local directory \'{current_working_directory}\'!')
+	file_body = f'{timestamp_now_epoch}\n'
 	save_to_path = './new_timestamp_usman'
 
 	response_save_file = save_file(
 		s3_client=s3_client,
 		s3_bucket=s3_bucket,
 		s3_key=s3_key_save_file,
-		upload_file_path=upload_file_path # can also be None and instead can pass in file_body, or both
+		file_body=file_body # can also be an upload_file_path instead
 		)
 
 	logging.info(f'Added {s3_key_save_file} to {s3_bucket}!')
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+# asyncio flavour of s3_wrapper, built on aiobotocore (pip install aiobotocore). One event loop can keep
+# hundreds of transfers in flight without a thread per transfer, and bodies are streamed in chunks
+# instead of being read into memory:
+#
+#   async with create_client(...) as s3_client:
+#       chunks = await load_file(s3_client, s3_bucket, s3_key)
+#       if chunks is not None:
+#           async with chunks:
+#               async for chunk in chunks:
+#                   ...
+
+from aiobotocore.session import get_session
+from botocore.exceptions import BotoCoreError, ClientError
+from s3_wrapper import NOT_FOUND_ERROR_CODES, _notify_saved
+import aiohttp
+import asyncio
+import logging
+
+MB = 1024 * 1024
+
+# Async iterators are re-buffered into parts of this size; S3 requires at least 5 MiB per multipart part
+PART_SIZE = 8 * MB
+
+# Parts of one upload that may be in flight at once, which also bounds the memory an upload holds
+MAX_CONCURRENT_PARTS = 4
+
+READ_CHUNK_SIZE = 256 * 1024
+
+# Failures of a transfer that are reported as a False/None result, like ClientError: connection and
+# read errors surface from botocore, aiohttp or the socket depending on where the transfer broke
+TRANSFER_ERRORS = (ClientError, BotoCoreError, aiohttp.ClientError, asyncio.TimeoutError, OSError)
+
+
+def create_client(**client_kwargs):
+	return get_session().create_client('s3', **client_kwargs)
+
+
+async def _read_file_chunks(upload_file_path, chunk_size=PART_SIZE):
+	loop = asyncio.get_running_loop()
+	with open(upload_file_path, 'rb') as f:
+		while True:
+			chunk = await loop.run_in_executor(None, f.read, chunk_size)
+			if not chunk:
+				break
+			yield chunk
+
+
+async def _buffer_parts(chunks, part_size):
+	buffer = bytearray()
+	async for chunk in chunks:
+		buffer += chunk.encode() if isinstance(chunk, str) else chunk
+		while len(buffer) >= part_size:
+			yield bytes(buffer[:part_size])
+			del buffer[:part_size]
+	if buffer:
+		yield bytes(buffer)
+
+
+async def _upload_chunks(s3_client, s3_bucket, s3_key, chunks, part_size):
+	parts = _buffer_parts(chunks, part_size)
+	first_part = await anext(parts, None)
+	second_part = await anext(parts, None)
+
+	# Anything that fits in one part goes up as a plain PUT
+	if second_part is None:
+		await s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=first_part or b'')
+		return
+
+	response = await s3_client.create_multipart_upload(Bucket=s3_bucket, Key=s3_key)
+	upload_id = response['UploadId']
+	slots = asyncio.Semaphore(MAX_CONCURRENT_PARTS)
+
+	async def upload_part(number, body):
+		try:
+			response = await s3_client.upload_part(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id, PartNumber=number, Body=body)
+			return {'PartNumber': number, 'ETag': response['ETag']}
+		finally:
+			slots.release()
+
+	async def all_parts():
+		yield first_part
+		yield second_part
+		async for part in parts:
+			yield part
+
+	tasks = []
+	try:
+		number = 0
+		async for body in all_parts():
+			number += 1
+			# Wait for a free slot before pulling more data, so a fast producer can't buffer the whole body
+			await slots.acquire()
+			tasks.append(asyncio.create_task(upload_part(number, body)))
+		uploaded_parts = await asyncio.gather(*tasks)
+		await s3_client.complete_multipart_upload(
+			Bucket=s3_bucket,
+			Key=s3_key,
+			UploadId=upload_id,
+			MultipartUpload={'Parts': uploaded_parts}
+			)
+
+	except BaseException:
+		for task in tasks:
+			task.cancel()
+		await s3_client.abort_multipart_upload(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id)
+		raise
+
+
+async def save_file(s3_client, s3_bucket, s3_key, file_body=None, upload_file_path=None, part_size=PART_SIZE):
+	# file_body may be bytes/str, or an async iterator of bytes/str chunks of unknown total length
+	if (upload_file_path is not None):
+		chunks = _read_file_chunks(upload_file_path)
+
+	elif isinstance(file_body, (bytes, bytearray, memoryview, str)):
+		try:
+			await s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=file_body)
+			_notify_saved(s3_bucket, s3_key)
+			return True
+
+		except TRANSFER_ERRORS as e:
+			logging.error(e)
+			return False
+
+	elif (file_body is not None):
+		chunks = file_body
+
+	else:
+		logging.info("No file_body or upload_file_path provided!")
+		return None
+
+	try:
+		await _upload_chunks(s3_client, s3_bucket, s3_key, chunks, part_size)
+		_notify_saved(s3_bucket, s3_key)
+		return True
+
+	except TRANSFER_ERRORS as e:
+		logging.error(e)
+		return False
+
+
+class BodyChunks:
+	# Async iterator over a response body in chunks. The response is released once the body has been read
+	# to the end or failed, and on aclose() or leaving `async with`, so stopping early leaks no connection.
+
+	def __init__(self, body, chunk_size):
+		self.body = body
+		self.chunk_size = chunk_size
+		self.closed = False
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		if self.closed:
+			raise StopAsyncIteration
+		try:
+			chunk = await self.body.read(self.chunk_size)
+		except BaseException:
+			await self.aclose()
+			raise
+		if not chunk:
+			await self.aclose()
+			raise StopAsyncIteration
+		return chunk
+
+	async def aclose(self):
+		if self.closed:
+			return
+		self.closed = True
+		# Older aiobotocore bodies only have a synchronous close()
+		aclose = getattr(self.body, 'aclose', None)
+		if aclose is not None:
+			await aclose()
+		else:
+			self.body.close()
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *exc_info):
+		await self.aclose()
+
+
+async def load_file(s3_client, s3_bucket, s3_key, save_to_path=None, chunk_size=READ_CHUNK_SIZE):
+	# Without save_to_path this returns a BodyChunks async iterator over the body (use it with `async with`
+	# unless it is always read to the end), or None if the GET failed
+	try:
+		response = await s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
+
+	except TRANSFER_ERRORS as e:
+		logging.error(e)
+		return None
+
+	chunks = BodyChunks(response['Body'], chunk_size)
+	if (save_to_path is None):
+		return chunks
+
+	loop = asyncio.get_running_loop()
+	try:
+		async with chunks:
+			with open(save_to_path, 'wb') as f:
+				async for chunk in chunks:
+					await loop.run_in_executor(None, f.write, chunk)
+		return save_to_path
+
+	except TRANSFER_ERRORS as e:
+		logging.error(e)
+		return None
+
+
+async def file_exists(s3_client, s3_bucket, s3_key):
+	try:
+		await s3_client.head_object(Bucket=s3_bucket, Key=s3_key)
+		return True
+
+	except ClientError as e:
+		if e.response.get('Error', {}).get('Code') in NOT_FOUND_ERROR_CODES:
+			logging.info(f'{s3_key} does not exist in {s3_bucket}')
+		else:
+			logging.error(e)
+		return False
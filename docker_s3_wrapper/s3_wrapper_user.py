@@ -1,99 +1,117 @@
 #!/usr/bin/env python3
 
-from datetime import datetime
-import dateutil.parser
+import argparse
+import json
 import logging
 import os
+import sys
+import time
+import urllib.parse
 from s3_wrapper import *
-
-s3_client = client(
-		's3',
-		aws_access_key_id='ACCESS_KEY_ID', # replace with ACCESS_KEY_ID
-		aws_secret_access_key='SECRET_ACCESS_KEY' # replace with SECRET_ACCESS_KEY
-	)
-
-logging.basicConfig(
-	level=logging.INFO,
-	filename='/var/log/cron.log',
-	format='%(levelname)s: %(asctime)s: %(message)s'
-	)
-
-s3_bucket = 'xxxx'
-s3_key_timestamp = 'assignments/infra/timestamp'
-s3_key_timestamp_usman = 'assignments/infra/timestamp_usman'
-
-timestamp_load_file = load_file(
-		s3_client=s3_client,
-		s3_bucket=s3_bucket,
-		s3_key=s3_key_timestamp,
-	)
-
-if timestamp_load_file is not None:
-	timestamp_stream = timestamp_load_file.read()
-
-	try:
-		timestamp_epoch_datetime = int(dateutil.parser.parse(timestamp_stream).timestamp())
-		timestamp_usman_load_file = load_file(
-			s3_client=s3_client,
-			s3_bucket=s3_bucket,
-			s3_key=s3_key_timestamp_usman,
+from s3_cache import DiskCache
+from s3_metrics import PrometheusInstrumentation, StatsdInstrumentation
+from s3_sync_rules import SyncEngine, load_rules
+
+
+class QueueEvents:
+	"""Detects changes from S3 event notifications delivered to an SQS queue (or a local stand-in such as ElasticMQ)"""
+
+	def __init__(self, sqs_client, queue_url, s3_bucket, s3_keys):
+		self.sqs_client = sqs_client
+		self.queue_url = queue_url
+		self.s3_bucket = s3_bucket
+		self.s3_keys = set(s3_keys)
+
+	def _matches(self, message):
+		try:
+			records = json.loads(message['Body']).get('Records', [])
+		except ValueError:
+			return False
+		for record in records:
+			s3 = record.get('s3', {})
+			# Keys in event notifications are URL-encoded
+			s3_key = urllib.parse.unquote_plus(s3.get('object', {}).get('key', ''))
+			if s3.get('bucket', {}).get('name') == self.s3_bucket and s3_key in self.s3_keys:
+				return True
+		return False
+
+	def wait_for_change(self, timeout):
+		response = self.sqs_client.receive_message(
+			QueueUrl=self.queue_url,
+			MaxNumberOfMessages=10,
+			WaitTimeSeconds=max(0, min(20, int(timeout)))
 			)
-
-		if (timestamp_usman_load_file is not None):
-			timestamp_usman_stream = timestamp_usman_load_file.read()
-			try:
-				timestamp_usman_epoch_datetime = int(timestamp_usman_stream)
-				if (timestamp_epoch_datetime == timestamp_usman_epoch_datetime):
-					logging.info(f'\'{s3_key_timestamp}\' file has not been updated since previous check 1 minute ago, no update to \'{s3_key_timestamp_usman}\' file required!')
-				else:
-					logging.info(f'\'{s3_key_timestamp}\' has been updated since previous check 1 minute ago, update to \'{s3_key_timestamp_usman}\' file required!')
-					logging.info(f'Updating \'{s3_key_timestamp_usman}\' file with new converted epoch time from \'{s3_key_timestamp}\' file...')
-
-					timestamp_usman_update_file = save_file(
-						s3_client=s3_client,
-						s3_bucket=s3_bucket,
-						s3_key=s3_key_timestamp_usman,
-						file_body=str(timestamp_epoch_datetime)
-						)
-
-					if timestamp_usman_update_file:
-						logging.info(f'\'{s3_key_timestamp_usman}\' file in S3 \'{s3_bucket}\' bucket has been updated successfully with value \'{timestamp_epoch_datetime}\'!')
-					else:
-						logging.info(timestamp_usman_update_file)
-
-			except Exception as err:
-				logging.info(f'Error occurred: {err}')
-				logging.info(f'\'{s3_key_timestamp_usman}\' file does not contain a valid epoch timestamp, or the file is empty!')
-
-		else:
-			logging.info(timestamp_usman_load_file)
-			logging.info(f'No \'{s3_key_timestamp_usman}\' file exists!')
-
-			timestamp_usman_filename = "timestamp_usman"
-			os.system(f'touch {timestamp_usman_filename}')
-			os.system(f'echo {timestamp_epoch_datetime} > {timestamp_usman_filename}')
-			current_working_directory = str(os.getcwd())
-			
-			upload_file_path = (current_working_directory + '/' + timestamp_usman_filename)
-			logging.info(f'\'{timestamp_usman_filename}\' file created in local directory \'{current_working_directory}\'!')
-			logging.info(f'Uploading \'{timestamp_usman_filename}\' file to S3 \'{s3_bucket}\' bucket...')
-
-			timestamp_usman_save_file = save_file(
-				s3_client=s3_client,
-				s3_bucket=s3_bucket,
-				s3_key=s3_key_timestamp_usman,
-				upload_file_path=upload_file_path
-				)
-
-			if timestamp_usman_save_file:
-				logging.info(f'\'{s3_key_timestamp_usman}\' file uploaded to S3 \'{s3_bucket}\' bucket successfully!')
-			else:
-				logging.info(timestamp_usman_save_file)
-
-	except Exception as err:
-		logging.info(f'Error occurred: {err}')
-		logging.info(f'\'{s3_key_timestamp}\' file does not contain a valid timestamp string, or the file is empty!')
-
-else:
-	logging.info(timestamp_load_file)
-	logging.info(f'No \'{s3_key_timestamp}\' file exists, or invalid AWS credentials!')
+		changed = False
+		for message in response.get('Messages', []):
+			changed = self._matches(message) or changed
+			self.sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message['ReceiptHandle'])
+		return changed
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Mirror derived S3 keys according to a rules file')
+	parser.add_argument('--rules', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sync_rules.json'))
+	parser.add_argument('--interval', type=float, default=10, help='seconds between checks (long-poll timeout with --queue-url)')
+	parser.add_argument('--queue-url', help='SQS queue receiving S3 event notifications, instead of listing every interval')
+	parser.add_argument('--queue-endpoint-url', help='endpoint of a local SQS stand-in')
+	parser.add_argument('--once', action='store_true', help='sync once and exit')
+	parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on this port at /metrics')
+	parser.add_argument('--statsd-host', help='send StatsD metrics to host[:port]')
+	parser.add_argument('--cache-dir', help='keep source bodies in a disk cache here, revalidated by ETag')
+	args = parser.parse_args()
+
+	logging.basicConfig(
+		level=logging.INFO,
+		filename='/var/log/cron.log',
+		format='%(levelname)s: %(asctime)s: %(message)s'
+		)
+
+	# One warm client for the life of the process
+	s3_client = client(
+			's3',
+			aws_access_key_id='ACCESS_KEY_ID', # replace with ACCESS_KEY_ID
+			aws_secret_access_key='SECRET_ACCESS_KEY' # replace with SECRET_ACCESS_KEY
+		)
+
+	if args.metrics_port is not None:
+		instrumentation = PrometheusInstrumentation()
+		instrumentation.serve(args.metrics_port)
+		set_instrumentation(instrumentation, s3_client)
+	elif args.statsd_host is not None:
+		host, _, port = args.statsd_host.partition(':')
+		set_instrumentation(StatsdInstrumentation(host, int(port or 8125)), s3_client)
+
+	s3_bucket, rules = load_rules(args.rules)
+	cache = DiskCache(args.cache_dir) if args.cache_dir is not None else None
+	sync_engine = SyncEngine(s3_client, s3_bucket, rules, cache=cache)
+	logging.info(f'Loaded {len(rules)} sync rule(s) for {s3_bucket} from {args.rules}')
+
+	# Without a queue every pass is the check itself: one LIST per prefix, GETs/PUTs only for changed rules
+	watcher = None
+	if args.queue_url is not None and not args.once:
+		sqs_client = client('sqs', endpoint_url=args.queue_endpoint_url)
+		watcher = QueueEvents(sqs_client, args.queue_url, s3_bucket, sync_engine.keys())
+
+	# The first pass runs straight away, and is retried like any other until it gets through
+	synced = False
+	while True:
+		try:
+			if not synced:
+				sync_engine.run_once()
+				synced = True
+				if args.once:
+					return
+			elif watcher is None:
+				time.sleep(args.interval)
+				sync_engine.run_once()
+			elif watcher.wait_for_change(args.interval):
+				sync_engine.run_once()
+		except (ClientError, BotoCoreError) as e:
+			# Keep the service up through transient S3/SQS failures, supervisord only restarts on crashes
+			logging.error(e)
+			if args.once:
+				sys.exit(1)
+			time.sleep(args.interval)
+
+if __name__ == '__main__':
+	main()
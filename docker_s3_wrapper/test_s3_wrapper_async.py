@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+# Runs s3_wrapper_async against a local moto server (pip install 'moto[server]' aiobotocore pytest)
+
+import pytest
+
+pytest.importorskip('aiobotocore')
+moto_server = pytest.importorskip('moto.server')
+
+from botocore.exceptions import ClientError
+import asyncio
+import os
+import socket
+
+import s3_wrapper_async
+from s3_wrapper_async import MB
+
+S3_BUCKET = 'test-bucket'
+
+
+@pytest.fixture(scope='module')
+def endpoint_url():
+	with socket.socket() as s:
+		s.bind(('127.0.0.1', 0))
+		port = s.getsockname()[1]
+	server = moto_server.ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+	server.start()
+	try:
+		yield f'http://127.0.0.1:{port}'
+	finally:
+		server.stop()
+
+
+def run(endpoint_url, test):
+	# Every test gets a fresh client and an empty bucket
+	async def main():
+		async with s3_wrapper_async.create_client(
+			endpoint_url=endpoint_url,
+			region_name='us-east-1',
+			aws_access_key_id='testing',
+			aws_secret_access_key='testing'
+			) as s3_client:
+			await s3_client.create_bucket(Bucket=S3_BUCKET)
+			try:
+				return await test(s3_client)
+			finally:
+				response = await s3_client.list_objects_v2(Bucket=S3_BUCKET)
+				for item in response.get('Contents', []):
+					await s3_client.delete_object(Bucket=S3_BUCKET, Key=item['Key'])
+				await s3_client.delete_bucket(Bucket=S3_BUCKET)
+
+	return asyncio.run(main())
+
+
+async def _chunks(payload, chunk_size=MB):
+	for start in range(0, len(payload), chunk_size):
+		yield payload[start:start + chunk_size]
+
+
+async def _read(s3_client, s3_key):
+	response = await s3_client.get_object(Bucket=S3_BUCKET, Key=s3_key)
+	async with response['Body'] as stream:
+		return await stream.read()
+
+
+class FailingPartClient:
+	# Passes everything through to the real client, except that one part of every multipart upload fails
+
+	def __init__(self, s3_client, fail_part_number):
+		self.s3_client = s3_client
+		self.fail_part_number = fail_part_number
+
+	def __getattr__(self, name):
+		return getattr(self.s3_client, name)
+
+	async def upload_part(self, **kwargs):
+		if kwargs['PartNumber'] == self.fail_part_number:
+			raise ClientError({'Error': {'Code': 'InternalError', 'Message': 'injected failure'}}, 'UploadPart')
+		return await self.s3_client.upload_part(**kwargs)
+
+
+def test_small_async_iterator_is_a_single_put(endpoint_url):
+	payload = os.urandom(3 * MB)
+
+	async def test(s3_client):
+		assert await s3_wrapper_async.save_file(s3_client, S3_BUCKET, 'small', file_body=_chunks(payload), part_size=5 * MB)
+		head = await s3_client.head_object(Bucket=S3_BUCKET, Key='small')
+		assert '-' not in head['ETag']
+		assert await _read(s3_client, 'small') == payload
+
+	run(endpoint_url, test)
+
+
+def test_large_async_iterator_is_a_multipart_upload(endpoint_url):
+	payload = os.urandom(12 * MB)
+
+	async def test(s3_client):
+		assert await s3_wrapper_async.save_file(s3_client, S3_BUCKET, 'large', file_body=_chunks(payload), part_size=5 * MB)
+		head = await s3_client.head_object(Bucket=S3_BUCKET, Key='large')
+		# A multipart ETag ends in -<number of parts>: 5 + 5 + 2 MiB
+		assert head['ETag'].strip('"').endswith('-3')
+		assert await _read(s3_client, 'large') == payload
+
+	run(endpoint_url, test)
+
+
+def test_failed_part_aborts_the_upload(endpoint_url):
+	payload = os.urandom(12 * MB)
+
+	async def test(s3_client):
+		failing_client = FailingPartClient(s3_client, fail_part_number=2)
+		assert await s3_wrapper_async.save_file(failing_client, S3_BUCKET, 'aborted', file_body=_chunks(payload), part_size=5 * MB) is False
+		uploads = await s3_client.list_multipart_uploads(Bucket=S3_BUCKET)
+		assert not uploads.get('Uploads')
+		assert await s3_wrapper_async.file_exists(s3_client, S3_BUCKET, 'aborted') is False
+
+	run(endpoint_url, test)
+
+
+def test_load_file_yields_chunks(endpoint_url):
+	payload = os.urandom(100 * 1024)
+
+	async def test(s3_client):
+		await s3_client.put_object(Bucket=S3_BUCKET, Key='chunked', Body=payload)
+		chunks = await s3_wrapper_async.load_file(s3_client, S3_BUCKET, 'chunked', chunk_size=16 * 1024)
+		received = [chunk async for chunk in chunks]
+		assert len(received) > 1
+		assert all(len(chunk) <= 16 * 1024 for chunk in received)
+		assert b''.join(received) == payload
+
+	run(endpoint_url, test)
+
+
+def test_load_file_releases_the_body_when_stopped_early(endpoint_url):
+	payload = os.urandom(100 * 1024)
+
+	async def test(s3_client):
+		await s3_client.put_object(Bucket=S3_BUCKET, Key='early', Body=payload)
+		chunks = await s3_wrapper_async.load_file(s3_client, S3_BUCKET, 'early', chunk_size=16 * 1024)
+		async with chunks:
+			async for chunk in chunks:
+				break
+		assert chunks.closed
+		assert [chunk async for chunk in chunks] == []
+
+	run(endpoint_url, test)
+
+
+def test_load_file_to_path(endpoint_url, tmp_path):
+	payload = os.urandom(100 * 1024)
+	save_to_path = str(tmp_path / 'downloaded')
+
+	async def test(s3_client):
+		await s3_client.put_object(Bucket=S3_BUCKET, Key='to_path', Body=payload)
+		assert await s3_wrapper_async.load_file(s3_client, S3_BUCKET, 'to_path', save_to_path=save_to_path) == save_to_path
+
+	run(endpoint_url, test)
+	with open(save_to_path, 'rb') as f:
+		assert f.read() == payload
+
+
+def test_file_exists(endpoint_url):
+	async def test(s3_client):
+		assert await s3_wrapper_async.file_exists(s3_client, S3_BUCKET, 'missing') is False
+		assert await s3_wrapper_async.save_file(s3_client, S3_BUCKET, 'present', file_body='hello')
+		assert await s3_wrapper_async.file_exists(s3_client, S3_BUCKET, 'present') is True
+
+	run(endpoint_url, test)
+
+
+def test_load_file_to_an_unwritable_path_returns_none(endpoint_url, tmp_path):
+	async def test(s3_client):
+		await s3_client.put_object(Bucket=S3_BUCKET, Key='to_path', Body=b'hello')
+		save_to_path = str(tmp_path / 'missing-dir' / 'downloaded')
+		assert await s3_wrapper_async.load_file(s3_client, S3_BUCKET, 'to_path', save_to_path=save_to_path) is None
+
+	run(endpoint_url, test)
+
+
+def test_load_file_on_a_miss_returns_none(endpoint_url):
+	async def test(s3_client):
+		assert await s3_wrapper_async.load_file(s3_client, S3_BUCKET, 'missing') is None
+
+	run(endpoint_url, test)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Benchmark of the DDL export against a local PostgreSQL stand-in for Redshift, e.g.
+#   docker run -d -p 5432:5432 -e POSTGRES_PASSWORD=postgres postgres
+#   ./benchmark_export.py --dsn "host=localhost user=postgres password=postgres" --rows 2000000
+#
+# v_generate_tbl_ddl only runs on Redshift, so a table with the view's columns is filled with synthetic DDL
+# lines instead. Every mode runs in its own process, so the peak RSS reported is that of the export alone.
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import psycopg2  # pip install psycopg2-binary
+
+from extract_redshift_schema import build_schema_sql, export_schema, open_schema_file
+
+STAND_IN_TABLE = 'public.v_generate_tbl_ddl_benchmark'
+
+
+def create_stand_in(dsn, rows):
+  conn = psycopg2.connect(dsn)
+  cursor = conn.cursor()
+  cursor.execute(f"DROP TABLE IF EXISTS {STAND_IN_TABLE}")
+  cursor.execute(f"CREATE TABLE {STAND_IN_TABLE} (table_id bigint, schemaname varchar, tablename varchar, seq int, ddl varchar)")
+  # About 20 lines per table, like a CREATE TABLE with a dozen columns, and an FK ALTER for every tenth table
+  cursor.execute(f"""
+    INSERT INTO {STAND_IN_TABLE}
+    SELECT i / 20, 'public', 'table' || (i / 20), i %% 20,
+           CASE WHEN i %% 200 = 19 THEN 'ALTER TABLE public.table' || (i / 20) || ' ADD FOREIGN KEY (parent_id) REFERENCES public.parent(id);'
+                ELSE '\t,"column' || (i %% 20) || '" VARCHAR(256)   ENCODE lzo' || repeat(' ', 40) END
+    FROM generate_series(1, %s) AS i
+  """, (rows,))
+  conn.commit()
+  conn.close()
+
+
+def run_mode(dsn, mode, itersize, output_dir):
+  conn = psycopg2.connect(dsn)
+  path = os.path.join(output_dir, f'schema_file_{mode}.sql')
+  start = time.perf_counter()
+  sql, params = build_schema_sql(STAND_IN_TABLE)
+  with open_schema_file(path, compress=mode.endswith('gzip')) as schema_file:
+    rows = export_schema(conn, sql, schema_file, itersize=None if mode == 'client' else itersize, params=params)
+  elapsed = time.perf_counter() - start
+  conn.close()
+  size = os.path.getsize(path + ('.gz' if mode.endswith('gzip') else ''))
+  peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+  print(f"{mode:<14} {elapsed:8.2f}s {rows:>10} {peak_rss_mb:>12.1f} {size / 1024 / 1024:>10.1f}")
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--dsn', default='host=localhost user=postgres')
+  parser.add_argument('--rows', type=int, default=1000000)
+  parser.add_argument('--itersize', type=int, default=10000)
+  parser.add_argument('--mode', help=argparse.SUPPRESS)
+  parser.add_argument('--output-dir', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.mode:
+    run_mode(args.dsn, args.mode, args.itersize, args.output_dir)
+    return
+
+  create_stand_in(args.dsn, args.rows)
+  print(f"{'mode':<14} {'elapsed':>9} {'rows':>10} {'peak RSS MB':>12} {'output MB':>10}")
+  with tempfile.TemporaryDirectory() as output_dir:
+    for mode in ('client', 'server', 'server-gzip'):
+      subprocess.run([sys.executable, __file__, '--dsn', args.dsn, '--itersize', str(args.itersize), '--mode', mode, '--output-dir', output_dir], check=True)
+
+
+if __name__ == '__main__':
+  main()
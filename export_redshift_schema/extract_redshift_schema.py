@@ -1,48 +1,337 @@
 #!/usr/bin/env python3
 
-import boto3
+import argparse
+import gzip
+import hashlib
+import json
 import psycopg2  # pip install psycopg2-binary
+import psycopg2.pool
+import shutil
 import sys
 import os
-from sys import argv
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Tuple
 
+from redshift_session import DEFAULT_CREDENTIALS_CACHE_DIR, DEFAULT_VIEW, RedshiftSession, ensure_view, inline_view
 
-def extract_redshift_schema(
-  region,
-  db_name,
-  db_user,
-  cluster_identifier,
-  endpoint,
-  redshift_copy_schema_dir,
-  v_generate_tbl_ddl_sql_file,
-  get_schema_sql,
-  schema_file):
+# Rows fetched per round trip by the server-side cursor, and the output buffer size
+DEFAULT_ITERSIZE = 10000
+OUTPUT_BUFFER_SIZE = 1024 * 1024
 
-  try:
-    # Create redshift connection
-    client = boto3.client('redshift', region_name=region)
 
-    # Get temporary username and password
-    cluster_creds = client.get_cluster_credentials(
-      DbUser=db_user, DbName=db_name, ClusterIdentifier=cluster_identifier, AutoCreate=False)
+# How v_generate_tbl_ddl writes foreign keys. Their seq (700000000 + oid) can't be used to recognise them:
+# constraints inside CREATE TABLE are numbered 200000000 + oid and reach that range once oids pass 500M
+FK_DDL_PATTERN = 'ALTER TABLE % ADD FOREIGN KEY%'
 
-    temp_user = cluster_creds['DbUser']
-    temp_password = cluster_creds['DbPassword']
 
-    # Create connection string to database
-    conn = psycopg2.connect(f"host='{endpoint}' port='5439' user={temp_user} password={temp_password} dbname='{db_name}'")
-    cursor = conn.cursor()
+@dataclass(frozen=True)
+class SchemaFilter:
+  """Which tables to export: schemas by name, tables by POSIX regex (as matched by Redshift's ~ operator)"""
+  schemas: Tuple[str, ...] = ('public',)
+  table_regex: Optional[str] = None
+  # By default only tables with no underscores are exported. This can be changed if needed.
+  exclude_table_regex: Optional[str] = '_'
 
-    # Execute SQL file to create view, which we can then query to get the schema
-    cursor.execute(v_generate_tbl_ddl_sql_file.read())
+  def where(self, schema=None, table=None, schemaname=None, tablename=None):
+    """SQL condition on v_generate_tbl_ddl rows and its parameters, optionally narrowed to one schema or table.
 
-    # Query view to get the schema of all tables in the schema
-    cursor.execute(get_schema_sql)
+    schemaname/tablename are the SQL expressions matched, by default the view's columns.
+    """
+    schemaname = schemaname or 'schemaname'
+    tablename = tablename or 'tablename'
+    conditions, params = [f"{schemaname} in %s"], [tuple([schema] if schema is not None else self.schemas)]
+    if table is not None:
+      conditions.append(f"{tablename} = %s")
+      params.append(table)
+    if self.table_regex:
+      conditions.append(f"{tablename} ~ %s")
+      params.append(self.table_regex)
+    if self.exclude_table_regex:
+      conditions.append(f"{tablename} !~ %s")
+      params.append(self.exclude_table_regex)
+    return ' and '.join(conditions), params
+
+
+def build_schema_sql(view=DEFAULT_VIEW, schema_filter=SchemaFilter()):
+  # CREATE TABLEs first and all ALTERs (ownership, then foreign keys) after them, so the file can be replayed as is
+  where, params = schema_filter.where()
+  return "select ddl from ( " + \
+      f"(select * from {view} " + \
+          "where ddl not like 'ALTER TABLE %%' " + \
+          "order by tablename)" + \
+      "UNION ALL " + \
+      f"(select * from {view} " + \
+          "where ddl like 'ALTER TABLE %%' " + \
+          "order by tablename) " + \
+      f") as tbl_ddl where {where};", params
+
+
+def open_schema_file(path, compress=False):
+  """Buffered text output for the DDL, gzipped to path + '.gz' when compress is set"""
+  if compress:
+    return gzip.open(f"{path}.gz", 'wt')
+  return open(path, 'w', buffering=OUTPUT_BUFFER_SIZE)
+
+
+def export_schema(conn, get_schema_sql, schema_file, itersize=DEFAULT_ITERSIZE, params=None):
+  """Write the ddl rows of get_schema_sql to schema_file, returning how many were written.
+
+  With an itersize the rows are streamed through a named (server-side) cursor, itersize rows per round trip,
+  so memory stays flat however big the schema is. itersize=None fetches the whole result client-side first.
+  """
+  if itersize:
+    cursor = conn.cursor(name='schema_export')
+    cursor.itersize = itersize
+  else:
+    cursor = conn.cursor()
+  try:
+    cursor.execute(get_schema_sql, params)
+    rows = 0
     for line in cursor:
       schema_file.write(f"{line[0]}\n")
+      rows += 1
+    return rows
+  finally:
+    cursor.close()
+
+
+# Part file sections, merged in this order: CREATE TABLEs, then ownership ALTERs, then foreign keys last
+SECTIONS = ['create', 'alter', 'fk']
+
+
+def list_tables(conn, schema_filter):
+  """(schema, table) of every table selected by schema_filter, from the catalog rather than the view"""
+  where, params = schema_filter.where(schemaname='n.nspname', tablename='c.relname')
+  cursor = conn.cursor()
+  try:
+    cursor.execute(
+      "select n.nspname, c.relname from pg_class c join pg_namespace n on n.oid = c.relnamespace "
+      f"where c.relkind = 'r' and {where} order by 1, 2", params)
+    return [tuple(row) for row in cursor.fetchall()]
+  finally:
+    cursor.close()
+
+
+# Catalog entries v_generate_tbl_ddl builds a table's DDL from, one query per kind, read back per table
+FINGERPRINT_QUERIES = [
+  "select n.nspname, c.relname, c.oid, u.usename, c.reldiststyle "
+  "from pg_class c join pg_namespace n on n.oid = c.relnamespace join pg_user u on u.usesysid = c.relowner "
+  "where c.relkind = 'r' and {where}",
+  "select n.nspname, c.relname, a.attnum, a.attname, format_type(a.atttypid, a.atttypmod), a.attencodingtype, "
+  "a.attnotnull, a.attisdistkey, a.attsortkeyord, adef.adsrc "
+  "from pg_class c join pg_namespace n on n.oid = c.relnamespace join pg_attribute a on a.attrelid = c.oid "
+  "left join pg_attrdef adef on adef.adrelid = a.attrelid and adef.adnum = a.attnum "
+  "where c.relkind = 'r' and a.attnum > 0 and not a.attisdropped and {where}",
+  "select n.nspname, c.relname, con.conname, pg_get_constraintdef(con.oid) "
+  "from pg_constraint con join pg_class c on c.oid = con.conrelid join pg_namespace n on n.oid = c.relnamespace "
+  "where c.relkind = 'r' and {where}",
+  # BACKUP NO is kept in pg_conf as pg_class_backup_<database oid>_<table oid>, as the view reads it
+  "select n.nspname, c.relname, 'BACKUP NO' "
+  "from pg_class c join pg_namespace n on n.oid = c.relnamespace "
+  "join (select split_part(key, '_', 5) as id from pg_conf where key like 'pg_class_backup_%%' "
+  "and split_part(key, '_', 4) = (select oid from pg_database where datname = current_database())) t on t.id = c.oid "
+  "where c.relkind = 'r' and {where}",
+]
+
+
+def table_fingerprints(conn, schema_filter):
+  """{(schema, table): fingerprint} of every table selected by schema_filter, hashed from its catalog entries.
+
+  Covers what the DDL is generated from: table id, owner, diststyle, BACKUP setting, columns (type, encoding,
+  default, nullability, dist and sort keys) and constraints. Data changes, including the relfilenode changes they
+  cause, leave the fingerprint alone. The rows are hashed client-side, as Redshift cannot aggregate catalog tables.
+  """
+  where, params = schema_filter.where(schemaname='n.nspname', tablename='c.relname')
+  entries = {}
+  cursor = conn.cursor()
+  try:
+    for query_number, query in enumerate(FINGERPRINT_QUERIES):
+      cursor.execute(query.format(where=where), params)
+      for schema, table, *entry in cursor:
+        if query_number == 0:
+          entries[(schema, table)] = []
+        if (schema, table) in entries:
+          entries[(schema, table)].append(repr((query_number, *entry)))
+  finally:
+    cursor.close()
+  return {table: hashlib.sha256('\n'.join(sorted(lines)).encode()).hexdigest() for table, lines in entries.items()}
+
+
+def unit_key(unit):
+  """Manifest key of a (schema,) or (schema, table) unit. Names may contain dots, so they are JSON-encoded, not joined"""
+  return json.dumps(list(unit))
+
+
+def unit_part_paths(parts_dir, unit):
+  # Hashed: a name may hold any character, including '/', and a schema.table name can exceed the file name limit
+  name = hashlib.sha256(unit_key(unit).encode()).hexdigest()
+  return [os.path.join(parts_dir, f"{name}.{section}.sql") for section in SECTIONS]
+
+
+def load_manifest(path):
+  if not os.path.exists(path):
+    return None
+  with open(path) as f:
+    return json.load(f)
+
+
+def save_manifest(path, manifest):
+  tmp_path = f"{path}.tmp"
+  with open(tmp_path, 'w') as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+  os.replace(tmp_path, path)
+
+
+def export_unit(conn, view, schema_filter, unit, part_paths, itersize=DEFAULT_ITERSIZE):
+  """Write the DDL of one schema or table (unit) into one part file per section, returning the number of lines"""
+  where, params = schema_filter.where(*unit)
+  sql = "select ddl, case when ddl like %s then 2 when ddl like 'ALTER TABLE %%' then 1 else 0 end as section " + \
+      f"from {view} where {where} order by section, tablename, seq"
+  cursor = conn.cursor(name='schema_export_unit')
+  cursor.itersize = itersize or DEFAULT_ITERSIZE
+  part_files = [open(path, 'w', buffering=OUTPUT_BUFFER_SIZE) for path in part_paths]
+  try:
+    cursor.execute(sql, [FK_DDL_PATTERN, *params])
+    rows = 0
+    for ddl, section in cursor:
+      part_files[section].write(f"{ddl}\n")
+      rows += 1
+    return rows
+  finally:
+    cursor.close()
+    for part_file in part_files:
+      part_file.close()
+
+
+def export_parallel(dsn, schema_filter, schema_file, parts_dir, view=DEFAULT_VIEW, workers=4, split_by='table', itersize=DEFAULT_ITERSIZE,
+                    manifest_path=None, settings='', prepare=None):
+  """Extract the DDL per table (or per schema) concurrently over a pool of `workers` connections.
+
+  Every unit is written to its own part files in parts_dir, which are then merged into schema_file in
+  (schema, table) order, section by section, so the result does not depend on which query finished first.
+
+  With a manifest_path the export is incremental: tables are fingerprinted from the catalog, and only units
+  whose fingerprint changed since the last export (or whose parts are missing) are extracted again. The
+  parts of the others are reused. The manifest is discarded when `settings` (view SQL, filters) changed.
+  prepare(conn), e.g. creating the view, is only called when there is something to extract.
+  Returns the number of lines written to schema_file, reused parts included.
+  """
+  pool = psycopg2.pool.ThreadedConnectionPool(1, workers, dsn)
+  try:
+    conn = pool.getconn()
+    try:
+      if manifest_path is not None:
+        fingerprints = table_fingerprints(conn, schema_filter)
+        tables = sorted(fingerprints)
+      else:
+        tables = list_tables(conn, schema_filter)
+      units = tables if split_by == 'table' else sorted({(schema,) for schema, _ in tables})
+      part_paths = {unit: unit_part_paths(parts_dir, unit) for unit in units}
+
+      previous = load_manifest(manifest_path) if manifest_path is not None else None
+      if previous is None or previous.get('settings') != settings:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        previous = {'units': {}}
+      os.makedirs(parts_dir, exist_ok=True)
+      # Parts of tables that were dropped or are no longer selected
+      expected = {os.path.basename(path) for paths in part_paths.values() for path in paths}
+      for name in os.listdir(parts_dir):
+        if name not in expected:
+          os.remove(os.path.join(parts_dir, name))
+
+      unit_fingerprints = {}
+      if manifest_path is not None:
+        unit_tables = {}
+        for table in tables:
+          unit_tables.setdefault(table if split_by == 'table' else table[:1], []).append(fingerprints[table])
+        for unit in units:
+          unit_fingerprints[unit_key(unit)] = hashlib.sha256(''.join(unit_tables[unit]).encode()).hexdigest()
+      stale = [
+        unit for unit in units
+        if manifest_path is None
+        or previous['units'].get(unit_key(unit)) != unit_fingerprints[unit_key(unit)]
+        or not all(os.path.exists(path) for path in part_paths[unit])
+      ]
+      logging.info(f"Extracting DDL of {len(stale)} of {len(units)} part(s) ({len(tables)} table(s)) over {workers} connection(s), reusing {len(units) - len(stale)}")
+
+      if stale and prepare is not None:
+        prepare(conn)
+    finally:
+      pool.putconn(conn)
+
+    def export_with_pooled_connection(unit):
+      conn = pool.getconn()
+      try:
+        rows = export_unit(conn, view, schema_filter, unit, part_paths[unit], itersize=itersize)
+        conn.commit()
+        return rows
+      except Exception:
+        conn.rollback()
+        raise
+      finally:
+        pool.putconn(conn)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      extracted = sum(executor.map(export_with_pooled_connection, stale))
+    logging.info(f"Extracted {extracted} line(s) of DDL")
+  finally:
+    pool.closeall()
+
+  rows = 0
+  for section in range(len(SECTIONS)):
+    for unit in units:
+      with open(part_paths[unit][section]) as part_file:
+        for chunk in iter(lambda: part_file.read(OUTPUT_BUFFER_SIZE), ''):
+          schema_file.write(chunk)
+          rows += chunk.count('\n')
+  # Only written once every part is in place, so an interrupted export is redone next time
+  if manifest_path is not None:
+    save_manifest(manifest_path, {'settings': settings, 'units': unit_fingerprints})
+  return rows
+
+
+def extract_redshift_schema(
+  session,
+  redshift_copy_schema_dir,
+  v_generate_tbl_ddl_sql,
+  get_schema_sql,
+  schema_file,
+  itersize=DEFAULT_ITERSIZE,
+  get_schema_params=None,
+  parallel=1,
+  schema_filter=SchemaFilter(),
+  split_by='table',
+  incremental=False,
+  view=DEFAULT_VIEW):
+
+  conn = None
+  try:
+    # Create redshift connection, with temporary credentials that are reused while they are valid
+    dsn = session.dsn()
+    conn = psycopg2.connect(dsn)
+
+    def create_view(conn):
+      # Execute SQL file to create view, which we can then query to get the schema, unless it is already
+      # there as defined in the file. An inlined view is part of every query and needs no setup.
+      if view == DEFAULT_VIEW:
+        ensure_view(conn, v_generate_tbl_ddl_sql, view)
+
+    if parallel > 1 or incremental:
+      # A change to the view or the filters changes every table's DDL, the manifest is only valid for the same ones
+      settings = hashlib.sha256(f"{v_generate_tbl_ddl_sql}\n{schema_filter!r}\n{split_by}".encode()).hexdigest()
+      rows = export_parallel(
+        dsn, schema_filter, schema_file, f"{redshift_copy_schema_dir}/schema_parts",
+        view=view, workers=max(1, parallel), split_by=split_by, itersize=itersize,
+        manifest_path=f"{redshift_copy_schema_dir}/schema_manifest.json" if incremental else None,
+        settings=settings, prepare=create_view)
+    else:
+      create_view(conn)
+      # Query view to get the schema of all tables in the schema
+      rows = export_schema(conn, get_schema_sql, schema_file, itersize=itersize, params=get_schema_params)
     conn.commit()
-    print("Schema has been exported successfully!")
+    print(f"Schema has been exported successfully! ({rows} lines)")
 
   # Report any errors
   except Exception as e:
@@ -53,51 +342,74 @@ def extract_redshift_schema(
 
   # Close all connections
   finally:
-    cursor.close()
-    conn.close()
+    if conn is not None:
+      conn.close()
 
 
-def main(region, db_name, db_user, cluster_identifier, endpoint):
+def main(region, db_name, db_user, cluster_identifier, endpoint, itersize=DEFAULT_ITERSIZE, compress=False,
+         schema_filter=SchemaFilter(), parallel=1, split_by='table', incremental=False, inline=False,
+         credentials_cache_dir=DEFAULT_CREDENTIALS_CACHE_DIR, credentials_duration=900):
 
   # Sources:
   # - https://github.com/awslabs/amazon-redshift-utils/blob/4646dacf0d25494d2b2225c66c1b50305564e8c3/src/AdminViews/v_generate_tbl_ddl.sql
 
   redshift_copy_schema_dir = "scripts/redshift/extract_schema"
-  v_generate_tbl_ddl_sql_file = open(f"{redshift_copy_schema_dir}/v_generate_tbl_ddl.sql", 'r')
-  get_schema_sql = "select ddl from ( " + \
-      "(select * from public.v_generate_tbl_ddl " + \
-          "where ddl not like 'ALTER TABLE %' " + \
-          "order by tablename)" + \
-      "UNION ALL " + \
-      "(select * from public.v_generate_tbl_ddl " + \
-          "where ddl like 'ALTER TABLE %' " + \
-          "order by tablename) " + \
-      ") where schemaname = 'public' and tablename !~ '_';"  # the last filter returns only tables with no underscores. This can be chnaged later if needed.
+  with open(f"{redshift_copy_schema_dir}/v_generate_tbl_ddl.sql", 'r') as v_generate_tbl_ddl_sql_file:
+    v_generate_tbl_ddl_sql = v_generate_tbl_ddl_sql_file.read()
+  # Inline, the view's query runs as a subquery of the export and no view is created
+  view = inline_view(v_generate_tbl_ddl_sql) if inline else DEFAULT_VIEW
+  get_schema_sql, get_schema_params = build_schema_sql(view=view, schema_filter=schema_filter)
 
-  schema_file = open(f"{redshift_copy_schema_dir}/schema_file.sql", 'w')
+  schema_file = open_schema_file(f"{redshift_copy_schema_dir}/schema_file.sql", compress=compress)
 
   logging.basicConfig(
     level=logging.INFO,
     format='%(levelname)s: %(asctime)s: %(message)s'
   )
 
+  session = RedshiftSession(
+    region, db_name, db_user, cluster_identifier, endpoint,
+    cache_dir=credentials_cache_dir, duration_seconds=credentials_duration)
+
   extract_redshift_schema(
-    region=region,
-    db_name=db_name,
-    db_user=db_user,
-    cluster_identifier=cluster_identifier,
-    endpoint=endpoint,
+    session=session,
     redshift_copy_schema_dir=redshift_copy_schema_dir,
-    v_generate_tbl_ddl_sql_file=v_generate_tbl_ddl_sql_file,
+    v_generate_tbl_ddl_sql=v_generate_tbl_ddl_sql,
     get_schema_sql=get_schema_sql,
-    schema_file=schema_file
+    schema_file=schema_file,
+    itersize=itersize,
+    get_schema_params=get_schema_params,
+    parallel=parallel,
+    schema_filter=schema_filter,
+    split_by=split_by,
+    incremental=incremental,
+    view=view
   )
+  schema_file.close()
 
 
 if __name__ == '__main__':
-  region = argv[1]
-  db_name = argv[2]
-  db_user = argv[3]
-  cluster_identifier = argv[4]
-  endpoint = argv[5]
-  main(region, db_name, db_user, cluster_identifier, endpoint)
+  parser = argparse.ArgumentParser(description='Export the DDL of a Redshift schema')
+  parser.add_argument('region')
+  parser.add_argument('db_name')
+  parser.add_argument('db_user')
+  parser.add_argument('cluster_identifier')
+  parser.add_argument('endpoint')
+  parser.add_argument('--itersize', type=int, default=DEFAULT_ITERSIZE, help='rows per round trip of the server-side cursor, 0 fetches everything client-side')
+  parser.add_argument('--gzip', action='store_true', help='write schema_file.sql.gz instead of schema_file.sql')
+  parser.add_argument('--schema', action='append', help='schema to export, can be repeated (default: public)')
+  parser.add_argument('--table-regex', help='only export tables whose name matches this POSIX regex')
+  parser.add_argument('--exclude-table-regex', default='_', help="skip tables whose name matches this POSIX regex (default: '_', pass '' to keep all)")
+  parser.add_argument('--parallel', type=int, default=1, help='extract tables concurrently over this many connections')
+  parser.add_argument('--split-by', choices=['table', 'schema'], default='table', help='unit of work and part file of --parallel')
+  parser.add_argument('--incremental', action='store_true', help='only extract tables whose catalog fingerprint changed since the last export, reusing the other parts')
+  parser.add_argument('--inline-view', action='store_true', help='run the view query inline instead of creating public.v_generate_tbl_ddl')
+  parser.add_argument('--credentials-cache-dir', default=DEFAULT_CREDENTIALS_CACHE_DIR, help=f'where temporary cluster credentials are cached between runs (default: {DEFAULT_CREDENTIALS_CACHE_DIR})')
+  parser.add_argument('--no-credentials-cache', action='store_true', help='always request new cluster credentials')
+  parser.add_argument('--credentials-duration', type=int, default=900, help='lifetime of requested cluster credentials in seconds (900 to 3600)')
+  args = parser.parse_args()
+  schema_filter = SchemaFilter(tuple(args.schema or ['public']), args.table_regex, args.exclude_table_regex)
+  main(args.region, args.db_name, args.db_user, args.cluster_identifier, args.endpoint, itersize=args.itersize, compress=args.gzip,
+       schema_filter=schema_filter, parallel=args.parallel, split_by=args.split_by,
+       incremental=args.incremental, inline=args.inline_view,
+       credentials_cache_dir=None if args.no_credentials_cache else args.credentials_cache_dir, credentials_duration=args.credentials_duration)
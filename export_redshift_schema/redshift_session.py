@@ -0,0 +1,126 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+
+import boto3
+import psycopg2  # pip install psycopg2-binary
+
+DEFAULT_VIEW = 'public.v_generate_tbl_ddl'
+DEFAULT_CREDENTIALS_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'extract_redshift_schema')
+# Cached credentials are not used any closer to their expiry than this, so a connection never races it
+CREDENTIALS_EXPIRY_MARGIN = datetime.timedelta(minutes=2)
+VIEW_HASH_PREFIX = 'sha256:'
+
+
+class RedshiftSession:
+  """Connections to one Redshift cluster, with its temporary IAM credentials cached across runs.
+
+  get_cluster_credentials is only called when there are no cached credentials valid for at least
+  CREDENTIALS_EXPIRY_MARGIN more. They are kept in a file only the current user can read under cache_dir,
+  so back-to-back exports (e.g. from CI) skip the round trip. cache_dir=None keeps them in memory only.
+  """
+
+  def __init__(self, region, db_name, db_user, cluster_identifier, endpoint, port=5439,
+               cache_dir=DEFAULT_CREDENTIALS_CACHE_DIR, duration_seconds=900):
+    self.region = region
+    self.db_name = db_name
+    self.db_user = db_user
+    self.cluster_identifier = cluster_identifier
+    self.endpoint = endpoint
+    self.port = port
+    self.cache_dir = cache_dir
+    self.duration_seconds = duration_seconds
+    self.cached = None
+
+  def _cache_path(self):
+    key = hashlib.sha256(f"{self.region}/{self.cluster_identifier}/{self.db_name}/{self.db_user}".encode()).hexdigest()[:16]
+    return os.path.join(self.cache_dir, f"credentials-{key}.json")
+
+  @staticmethod
+  def _valid(credentials):
+    expiration = datetime.datetime.fromisoformat(credentials['Expiration'])
+    return expiration - CREDENTIALS_EXPIRY_MARGIN > datetime.datetime.now(datetime.timezone.utc)
+
+  def credentials(self):
+    """(user, password) of temporary credentials that are valid for a while longer"""
+    if self.cached is None and self.cache_dir is not None and os.path.exists(self._cache_path()):
+      try:
+        with open(self._cache_path()) as f:
+          self.cached = json.load(f)
+      except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable credentials cache {self._cache_path()}: {e}")
+
+    if self.cached is not None and self._valid(self.cached):
+      logging.info(f"Reusing cached cluster credentials, valid until {self.cached['Expiration']}")
+    else:
+      client = boto3.client('redshift', region_name=self.region)
+      cluster_creds = client.get_cluster_credentials(
+        DbUser=self.db_user, DbName=self.db_name, ClusterIdentifier=self.cluster_identifier,
+        DurationSeconds=self.duration_seconds, AutoCreate=False)
+      self.cached = {
+        'DbUser': cluster_creds['DbUser'],
+        'DbPassword': cluster_creds['DbPassword'],
+        'Expiration': cluster_creds['Expiration'].isoformat(),
+      }
+      if self.cache_dir is not None:
+        self._save()
+
+    return self.cached['DbUser'], self.cached['DbPassword']
+
+  def _save(self):
+    os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+    tmp_path = f"{self._cache_path()}.tmp"
+    with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+      json.dump(self.cached, f)
+    os.replace(tmp_path, self._cache_path())
+
+  def dsn(self):
+    temp_user, temp_password = self.credentials()
+    return f"host='{self.endpoint}' port='{self.port}' user={temp_user} password={temp_password} dbname='{self.db_name}'"
+
+  def connect(self):
+    return psycopg2.connect(self.dsn())
+
+
+def view_hash(view_sql):
+  return VIEW_HASH_PREFIX + hashlib.sha256(view_sql.encode()).hexdigest()
+
+
+def ensure_view(conn, view_sql, view=DEFAULT_VIEW):
+  """Run view_sql (CREATE OR REPLACE VIEW) only if the view does not already exist with this exact definition.
+
+  The hash of the definition is kept as the view's comment. Returns whether the view was (re)created.
+  """
+  schema, name = view.split('.')
+  expected = view_hash(view_sql)
+  cursor = conn.cursor()
+  try:
+    cursor.execute(
+      "select d.description from pg_class c join pg_namespace n on n.oid = c.relnamespace "
+      "left join pg_description d on d.objoid = c.oid and d.objsubid = 0 "
+      "where c.relkind = 'v' and n.nspname = %s and c.relname = %s", (schema, name))
+    row = cursor.fetchone()
+    if row is not None and row[0] == expected:
+      logging.info(f"View {view} is up to date, not replacing it")
+      return False
+    cursor.execute(view_sql)
+    cursor.execute(f"COMMENT ON VIEW {view} IS %s", (expected,))
+    # The other connections only see the view once it is committed
+    conn.commit()
+    logging.info(f"View {view} {'replaced' if row is not None else 'created'}")
+    return True
+  finally:
+    cursor.close()
+
+
+def inline_view(view_sql, alias='v_generate_tbl_ddl'):
+  """The SELECT of a CREATE VIEW statement as a subquery to query in place of the view, which then is never created"""
+  match = re.search(r'CREATE\s+OR\s+REPLACE\s+VIEW\s+\S+\s+AS\s+(.*)', view_sql, re.IGNORECASE | re.DOTALL)
+  if match is None:
+    raise ValueError("No CREATE OR REPLACE VIEW ... AS statement found in the view SQL")
+  select = match.group(1).strip().rstrip(';').strip()
+  # The exports run it with query parameters, where % starts a placeholder
+  return f"({select.replace('%', '%%')}) AS {alias}"
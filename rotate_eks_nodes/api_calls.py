@@ -0,0 +1,38 @@
+import logging
+import threading
+from collections import Counter
+
+
+class ApiCallCounter:
+  """Thread-safe count of API calls, per endpoint"""
+
+  def __init__(self):
+    self.counts = Counter()
+    self.lock = threading.Lock()
+
+  def add(self, endpoint):
+    with self.lock:
+      self.counts[endpoint] += 1
+
+  def total(self):
+    with self.lock:
+      return sum(self.counts.values())
+
+  def snapshot(self):
+    with self.lock:
+      return dict(self.counts)
+
+  def instrument_boto3(self, client):
+    service = client.meta.service_model.service_name
+
+    def on_before_call(model=None, **kwargs):
+      self.add(f"aws {service}:{model.name}")
+
+    client.meta.events.register(f'before-call.{service}', on_before_call)
+    return client
+
+  def log_summary(self, title="API calls"):
+    counts = self.snapshot()
+    logging.info(f"{title}: {sum(counts.values())} in total")
+    for endpoint, count in sorted(counts.items(), key=lambda item: -item[1]):
+      logging.info(f"  {count:>6}  {endpoint}")
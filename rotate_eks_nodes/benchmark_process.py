@@ -0,0 +1,64 @@
+"""Benchmark for streaming subprocess output.
+
+Runs a local process that writes --lines lines as fast as it can, through the old select/readline loop
+and through process_runner.run_streaming, and reports wall time and how many lines each captured.
+"""
+import argparse
+import select
+import subprocess
+import sys
+import threading
+import time
+
+from process_runner import run_streaming
+
+
+def legacy_stream(args, timeout):
+  # The loop stream_while_running used before process_runner, kept here as the baseline. readline() blocks on one
+  # pipe until EOF while the other one can fill up, so a watchdog kills the process if it deadlocks.
+  proc = subprocess.Popen(args=args, stderr=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+  watchdog = threading.Timer(timeout, proc.kill)
+  watchdog.start()
+  stdout = []
+  stderr = []
+  while True:
+    if proc.poll() is not None:
+      break
+    rdrs, _, _ = select.select([proc.stdout, proc.stderr], [], [], 0.05)
+    for r in rdrs:
+      keep_reading = True
+      while keep_reading:
+        line = r.readline()
+        if len(line) > 0:
+          (stdout if r is proc.stdout else stderr).append(line.rstrip('\n'))
+        else:
+          keep_reading = False
+  watchdog.cancel()
+  return len(stdout) + len(stderr), proc.returncode
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--lines', type=int, default=200000)
+  parser.add_argument('--max-lines', type=int, default=1000, help='ring buffer size for run_streaming')
+  parser.add_argument('--legacy-timeout', type=float, default=30, help='kill the legacy loop after this many seconds')
+  args = parser.parse_args()
+
+  emitter = [sys.executable, '-c', f"import sys\nfor i in range({args.lines}):\n  (sys.stdout if i % 4 else sys.stderr).write(f'line {{i}} ' + 'x' * 60 + '\\n')"]
+
+  start = time.perf_counter()
+  captured, returncode = legacy_stream(emitter, args.legacy_timeout)
+  outcome = 'deadlocked, killed' if returncode == -9 else f'exit {returncode}'
+  print(f"{'select/readline loop':<35} {time.perf_counter() - start:7.2f}s  {captured}/{args.lines} lines captured, {outcome}")
+
+  for max_lines in (None, args.max_lines):
+    start = time.perf_counter()
+    result = run_streaming(emitter, max_lines=max_lines)
+    captured = result.stdout.total_lines + result.stderr.total_lines
+    kept = len(result.stdout.lines) + len(result.stderr.lines)
+    label = f"run_streaming ({'unbounded' if max_lines is None else f'ring of {max_lines}'})"
+    print(f"{label:<35} {time.perf_counter() - start:7.2f}s  {captured}/{args.lines} lines seen, {kept} kept, exit {result.returncode}")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,94 @@
+"""Simulated-cluster benchmark for the rotation wait phases.
+
+Every phase becomes true after a random delay. It is then awaited with the old fixed 30 second polling,
+with jittered backoff polling (as used for the ASG describe calls) and with a list+watch (as used for
+drains and replica readiness). Time runs --time-scale times faster than real time, and results are
+reported in simulated seconds.
+"""
+import argparse
+import random
+import statistics
+import threading
+import time
+from types import SimpleNamespace
+
+from waiters import Backoff, poll_until, watch_until
+
+
+class SimulatedPhase:
+  """A node with one pod that disappears `done_after` (scaled) seconds after the phase starts"""
+
+  def __init__(self, done_after):
+    self.done_at = time.monotonic() + done_after
+    self.api_calls = 0
+    self.lock = threading.Lock()
+
+  def done(self):
+    return time.monotonic() >= self.done_at
+
+  def list_pods(self, **kwargs):
+    with self.lock:
+      self.api_calls += 1
+    pod = SimpleNamespace(metadata=SimpleNamespace(namespace='default', name='app-0'))
+    return SimpleNamespace(items=[] if self.done() else [pod], metadata=SimpleNamespace(resource_version='1'))
+
+
+class SimulatedWatch:
+
+  def __init__(self, phase):
+    self.phase = phase
+
+  def stream(self, func, timeout_seconds=None, **kwargs):
+    with self.phase.lock:
+      self.phase.api_calls += 1
+    time.sleep(max(0, self.phase.done_at - time.monotonic()))
+    yield {'type': 'DELETED', 'object': SimpleNamespace(metadata=SimpleNamespace(namespace='default', name='app-0'))}
+
+  def stop(self):
+    pass
+
+
+def fixed_polling(phase, scale):
+  while not phase.list_pods().items == []:
+    time.sleep(30 * scale)
+
+
+def backoff_polling(phase, scale):
+  poll_until(lambda: phase.list_pods().items == [], Backoff(initial=2 * scale, maximum=30 * scale))
+
+
+def watching(phase, scale):
+  watch_until(phase.list_pods, lambda pods: not pods, watch_factory=lambda: SimulatedWatch(phase))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--phases', type=int, default=20)
+  parser.add_argument('--min-seconds', type=float, default=5)
+  parser.add_argument('--max-seconds', type=float, default=120)
+  parser.add_argument('--time-scale', type=float, default=0.005)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  rng = random.Random(args.seed)
+  durations = [rng.uniform(args.min_seconds, args.max_seconds) for _ in range(args.phases)]
+  scale = args.time_scale
+
+  print(f"{'strategy':<20} {'total (s)':>10} {'wasted (s)':>11} {'median wasted':>14} {'API calls':>10}")
+  for name, strategy in (('fixed 30s polling', fixed_polling), ('backoff polling', backoff_polling), ('list + watch', watching)):
+    wasted = []
+    api_calls = 0
+    total = 0
+    for duration in durations:
+      phase = SimulatedPhase(duration * scale)
+      start = time.monotonic()
+      strategy(phase, scale)
+      elapsed = (time.monotonic() - start) / scale
+      total += elapsed
+      wasted.append(max(0, elapsed - duration))
+      api_calls += phase.api_calls
+    print(f"{name:<20} {total:>10.0f} {sum(wasted):>11.0f} {statistics.median(wasted):>14.1f} {api_calls:>10}")
+
+
+if __name__ == '__main__':
+  main()
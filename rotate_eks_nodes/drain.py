@@ -0,0 +1,122 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from kubernetes.client.rest import ApiException
+from waiters import Backoff
+
+MIRROR_POD_ANNOTATION = 'kubernetes.io/config.mirror'
+
+
+class DrainError(Exception):
+  pass
+
+
+def stays_on_node(pod):
+  """Whether a drain leaves the pod on its node: DaemonSet pods are recreated there, mirror pods belong to the kubelet"""
+  if any(owner.kind == 'DaemonSet' for owner in (pod.metadata.owner_references or [])):
+    return True
+  return MIRROR_POD_ANNOTATION in (pod.metadata.annotations or {})
+
+
+@dataclass
+class EvictionResult:
+  namespace: str
+  name: str
+  status: str
+  attempts: int = 0
+  error: str = None
+
+
+class DrainEngine:
+  """In-process cordon/drain/uncordon through the Eviction API, a drop-in for `kubectl cordon/drain/uncordon`.
+
+  Mirrors `kubectl drain --ignore-daemonsets --delete-local-data`: DaemonSet and mirror pods are left
+  alone, pods with emptyDir volumes are evicted, and unmanaged pods make the drain fail unless force=True.
+  Evictions run concurrently; a 429 means a PodDisruptionBudget does not allow it yet and is retried
+  with backoff until eviction_timeout.
+  """
+
+  def __init__(self, core_api, max_parallel_evictions=8, eviction_timeout=600, force=False, backoff_factory=None, retries=None):
+    self.core_api = core_api
+    self.max_parallel_evictions = max_parallel_evictions
+    self.eviction_timeout = eviction_timeout
+    self.force = force
+    self.backoff_factory = backoff_factory or (lambda: Backoff(initial=1, maximum=15))
+    # Optional ApiCallCounter-like counter of evictions retried because of a PodDisruptionBudget
+    self.retries = retries
+
+  def cordon(self, node_name):
+    logging.info(f"Cordoning node {node_name}")
+    self.core_api.patch_node(node_name, {'spec': {'unschedulable': True}})
+
+  def uncordon(self, node_name):
+    logging.info(f"Uncordoning node {node_name}")
+    self.core_api.patch_node(node_name, {'spec': {'unschedulable': False}})
+
+  def pods_to_evict(self, node_name):
+    pods = self.core_api.list_pod_for_all_namespaces(field_selector='spec.nodeName=' + node_name).items
+    evict, unmanaged = [], []
+    for pod in pods:
+      if stays_on_node(pod):
+        continue
+      owners = pod.metadata.owner_references or []
+      if not owners and pod.status.phase not in ('Succeeded', 'Failed'):
+        unmanaged.append(f"{pod.metadata.namespace}/{pod.metadata.name}")
+      evict.append(pod)
+    if unmanaged and not self.force:
+      raise DrainError(f"Cannot drain {node_name}, pods not managed by a controller would be lost: {unmanaged}")
+    return evict
+
+  def evict(self, pod):
+    namespace, name = pod.metadata.namespace, pod.metadata.name
+    body = {'apiVersion': 'policy/v1', 'kind': 'Eviction', 'metadata': {'name': name, 'namespace': namespace}}
+    backoff = self.backoff_factory()
+    deadline = time.monotonic() + self.eviction_timeout
+    attempts = 0
+    while True:
+      attempts += 1
+      try:
+        self.core_api.create_namespaced_pod_eviction(name, namespace, body)
+        return EvictionResult(namespace, name, 'evicted', attempts)
+      except ApiException as e:
+        if e.status == 404:
+          return EvictionResult(namespace, name, 'gone', attempts)
+        if e.status != 429:
+          return EvictionResult(namespace, name, 'failed', attempts, str(e.reason or e))
+      # 429: a PodDisruptionBudget does not allow this eviction right now
+      if time.monotonic() >= deadline:
+        return EvictionResult(namespace, name, 'failed', attempts, f"PodDisruptionBudget still blocking after {self.eviction_timeout}s")
+      if self.retries is not None:
+        self.retries.add(f"eviction blocked by PDB ({namespace})")
+      delay = backoff.next_delay()
+      logging.info(f"Eviction of {namespace}/{name} blocked by a PodDisruptionBudget, retrying in {delay:.1f}s")
+      time.sleep(delay)
+
+  def drain(self, node_name):
+    self.cordon(node_name)
+    pods = self.pods_to_evict(node_name)
+    logging.info(f"Evicting {len(pods)} pod(s) from node {node_name}, {self.max_parallel_evictions} at a time")
+
+    done = 0
+    lock = threading.Lock()
+    results = []
+
+    def evict_and_report(pod):
+      nonlocal done
+      result = self.evict(pod)
+      with lock:
+        done += 1
+        results.append(result)
+        logging.info(f"[{done}/{len(pods)}] {result.namespace}/{result.name}: {result.status}{' (' + result.error + ')' if result.error else ''}")
+      return result
+
+    with ThreadPoolExecutor(max_workers=self.max_parallel_evictions) as executor:
+      list(executor.map(evict_and_report, pods))
+
+    failed = [f"{result.namespace}/{result.name}: {result.error}" for result in results if result.status == 'failed']
+    if failed:
+      raise DrainError(f"Failed to evict {len(failed)} pod(s) from {node_name}: {failed}")
+    return results
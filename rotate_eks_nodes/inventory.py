@@ -0,0 +1,196 @@
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+ASG_TAG = 'aws:autoscaling:groupName'
+
+# EC2 accepts at most 200 values per filter, and at most 1000 instance ids per request
+MAX_FILTER_VALUES = 200
+MAX_INSTANCE_IDS = 1000
+# Largest pages the APIs return. describe_instances does not accept MaxResults together with InstanceIds.
+EC2_PAGE_SIZE = 1000
+ASG_PAGE_SIZE = 100
+
+
+@dataclass
+class InstanceRecord:
+  instance_id: str
+  asg_name: Optional[str]
+  private_dns_name: Optional[str]
+  state: Optional[str]
+  node_name: Optional[str] = None
+  raw: Dict = field(default_factory=dict, repr=False)
+
+
+def _chunks(values, size):
+  values = list(values)
+  for start in range(0, len(values), size):
+    yield values[start:start + size]
+
+
+def asg_name_matches(target, asg_name):
+  """Whether an ASG belongs to the 'dbs', 'apps' or 'all' rotation target"""
+  if target == 'dbs':
+    return 'db' in asg_name
+  if target == 'apps':
+    return 'db' not in asg_name
+  return target == 'all'
+
+
+def list_asg_names(asg_client, target='all'):
+  paginator = asg_client.get_paginator('describe_auto_scaling_groups')
+  pages = paginator.paginate(PaginationConfig={'PageSize': ASG_PAGE_SIZE})
+  return [name for name in pages.search('AutoScalingGroups[].AutoScalingGroupName') if asg_name_matches(target, name)]
+
+
+def list_instances(ec2_client, **request):
+  """Every instance matching a describe_instances request, across all pages and reservations"""
+  paginator = ec2_client.get_paginator('describe_instances')
+  if 'InstanceIds' not in request:
+    request['PaginationConfig'] = {'PageSize': EC2_PAGE_SIZE}
+  return list(paginator.paginate(**request).search('Reservations[].Instances[]'))
+
+
+def _record(instance):
+  tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+  return InstanceRecord(
+    instance_id=instance['InstanceId'],
+    asg_name=tags.get(ASG_TAG),
+    private_dns_name=instance.get('PrivateDnsName'),
+    state=instance.get('State', {}).get('Name'),
+    raw=instance
+  )
+
+
+class InventoryIndex:
+  """EC2 instances keyed by InstanceId, ASG name and Kubernetes node name, for O(1) lookups"""
+
+  def __init__(self, instances: List[Dict]):
+    self.by_instance_id: Dict[str, InstanceRecord] = {}
+    self.by_asg: Dict[str, List[InstanceRecord]] = defaultdict(list)
+    self.by_node_name: Dict[str, InstanceRecord] = {}
+    for instance in instances:
+      record = _record(instance)
+      self.by_instance_id[record.instance_id] = record
+      if record.asg_name is not None:
+        self.by_asg[record.asg_name].append(record)
+
+  @classmethod
+  def fetch(cls, ec2_client, asg_names=None, instance_ids=None, executor=None, asg_chunk_size=MAX_FILTER_VALUES):
+    """Fetch only the relevant instances, filtered server-side by ASG tag and/or instance ids.
+
+    ASG names are filtered on in chunks of asg_chunk_size, and with an executor the chunks are fetched concurrently.
+    """
+    if asg_names is not None:
+      asg_names = list(asg_names)
+      if not asg_names:
+        return cls([])
+
+    if asg_names is not None:
+      asg_chunk_size = min(MAX_FILTER_VALUES, asg_chunk_size)
+      asg_filters = [[{'Name': f'tag:{ASG_TAG}', 'Values': chunk}] for chunk in _chunks(asg_names, asg_chunk_size)]
+
+    if instance_ids is not None:
+      requests = [{'InstanceIds': chunk} for chunk in _chunks(instance_ids, MAX_INSTANCE_IDS)]
+      if asg_names is not None:
+        # Both given: filter the id chunks by ASG as well
+        requests = [dict(request, Filters=filters) for request in requests for filters in asg_filters]
+    elif asg_names is not None:
+      requests = [{'Filters': filters} for filters in asg_filters]
+    else:
+      requests = [{}]
+
+    fetch_one = lambda request: list_instances(ec2_client, **request)
+    results = executor.map(fetch_one, requests) if executor is not None else map(fetch_one, requests)
+    instances = {}
+    for chunk in results:
+      for instance in chunk:
+        instances[instance['InstanceId']] = instance
+    logging.info(f"Indexed {len(instances)} EC2 instance(s) from {len(requests)} request(s)")
+    return cls(list(instances.values()))
+
+  def link_nodes(self, k8s_nodes):
+    """Record the Kubernetes node name of every indexed instance backing one of the given nodes"""
+    for k8s_node in k8s_nodes:
+      record = self.get(k8s_node.spec.provider_id.split('/')[-1])
+      if record is not None:
+        record.node_name = k8s_node.metadata.name
+        self.by_node_name[record.node_name] = record
+
+  def get(self, instance_id) -> Optional[InstanceRecord]:
+    return self.by_instance_id.get(instance_id)
+
+  def for_node(self, node_name) -> Optional[InstanceRecord]:
+    return self.by_node_name.get(node_name)
+
+  def in_asg(self, asg_name) -> List[InstanceRecord]:
+    return self.by_asg.get(asg_name, [])
+
+
+class InventoryCollector:
+  """ASG names and InventoryIndexes of one or more regions, fetched concurrently and cached for ttl_seconds.
+
+  client_factory(service_name, region) creates the boto3 clients, once per region and up front, as
+  creating clients is not thread-safe. Regions are collected in parallel, and so are the ASG chunks
+  within a region, on a pool of max_workers.
+  """
+
+  def __init__(self, client_factory, regions, max_workers=8, ttl_seconds=60):
+    self.regions = list(regions)
+    self.clients = {region: (client_factory('ec2', region), client_factory('autoscaling', region)) for region in self.regions}
+    self.max_workers = max_workers
+    self.ttl_seconds = ttl_seconds
+    self.cache = {}
+    self.lock = threading.Lock()
+    # Separate pools, so region tasks waiting on their chunk requests can never starve them
+    self.region_executor = ThreadPoolExecutor(max_workers=max(1, len(self.regions)), thread_name_prefix='inventory-region')
+    self.request_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='inventory')
+
+  def ec2_client(self, region):
+    return self.clients[region][0]
+
+  def asg_client(self, region):
+    return self.clients[region][1]
+
+  def _cached(self, key, fetch):
+    now = time.monotonic()
+    with self.lock:
+      entry = self.cache.get(key)
+      if entry is not None and entry[0] > now:
+        return entry[1]
+    value = fetch()
+    with self.lock:
+      self.cache[key] = (time.monotonic() + self.ttl_seconds, value)
+    return value
+
+  def asg_names(self, region, target='all'):
+    return self._cached(('asgs', region, target), lambda: list_asg_names(self.asg_client(region), target))
+
+  def index(self, region, asg_names):
+    key = ('instances', region, frozenset(asg_names))
+    # Spread the ASGs over the workers rather than sending them all in one filter
+    chunk_size = max(1, math.ceil(len(asg_names) / self.max_workers))
+    return self._cached(key, lambda: InventoryIndex.fetch(self.ec2_client(region), asg_names=asg_names, executor=self.request_executor, asg_chunk_size=chunk_size))
+
+  def collect(self, target='all'):
+    """{region: (ASG names, InventoryIndex of their instances)} for every region, collected in parallel"""
+
+    def collect_region(region):
+      asg_names = self.asg_names(region, target)
+      return asg_names, self.index(region, asg_names)
+
+    futures = {region: self.region_executor.submit(collect_region, region) for region in self.regions}
+    return {region: future.result() for region, future in futures.items()}
+
+  def invalidate(self):
+    with self.lock:
+      self.cache.clear()
+
+  def close(self):
+    self.region_executor.shutdown()
+    self.request_executor.shutdown()
@@ -0,0 +1,38 @@
+import kubernetes
+
+from api_calls import ApiCallCounter
+
+
+class KubernetesContext:
+  """One kubeconfig load and one pooled ApiClient shared by every Kubernetes API the rotation uses"""
+
+  def __init__(self, config_file=None, context=None, pool_size=16, counter=None):
+    configuration = kubernetes.client.Configuration()
+    kubernetes.config.load_kube_config(config_file=config_file, context=context, client_configuration=configuration)
+    # Parallel rotations keep several watches and requests open at once, size the pool for them
+    configuration.connection_pool_maxsize = pool_size
+    self.api_client = kubernetes.client.ApiClient(configuration)
+    self.counter = counter or ApiCallCounter()
+
+    call_api = self.api_client.call_api
+
+    def counted_call_api(resource_path, method, path_params=None, query_params=None, *args, **kwargs):
+      # resource_path is still the template here (e.g. /api/v1/namespaces/{namespace}/pods), so calls are counted per endpoint
+      watch = dict(query_params or []).get('watch', False)
+      self.counter.add(f"k8s {method} {resource_path}{' (watch)' if watch else ''}")
+      return call_api(resource_path, method, path_params, query_params, *args, **kwargs)
+
+    self.api_client.call_api = counted_call_api
+
+    self.core = kubernetes.client.CoreV1Api(self.api_client)
+    self.apps = kubernetes.client.AppsV1Api(self.api_client)
+    self.policy = kubernetes.client.PolicyV1Api(self.api_client)
+
+  def close(self):
+    self.api_client.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
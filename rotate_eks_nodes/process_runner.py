@@ -0,0 +1,86 @@
+import logging
+import os
+import selectors
+import subprocess
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, List, Optional
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+@dataclass
+class StreamCapture:
+  """Lines of one output stream, keeping only the last max_lines when bounded"""
+  max_lines: Optional[int] = None
+  lines: Deque[str] = field(init=False)
+  total_lines: int = field(init=False, default=0)
+  pending: bytes = field(init=False, default=b'')
+
+  def __post_init__(self):
+    self.lines = deque(maxlen=self.max_lines)
+
+  @property
+  def dropped_lines(self):
+    return self.total_lines - len(self.lines)
+
+  def feed(self, data: bytes) -> List[str]:
+    """Split a chunk into complete lines, keeping a trailing partial line for the next chunk"""
+    *complete, self.pending = (self.pending + data).split(b'\n')
+    return self._add(complete)
+
+  def flush(self) -> List[str]:
+    if not self.pending:
+      return []
+    complete, self.pending = [self.pending], b''
+    return self._add(complete)
+
+  def _add(self, raw_lines):
+    decoded = [line.decode(errors='replace').rstrip('\r') for line in raw_lines]
+    self.lines.extend(decoded)
+    self.total_lines += len(decoded)
+    return decoded
+
+
+@dataclass
+class ProcessResult:
+  returncode: int
+  stdout: StreamCapture
+  stderr: StreamCapture
+  proc: subprocess.Popen
+
+
+def run_streaming(args, cwd=None, max_lines=None, on_line: Callable[[str, str], None] = None, chunk_size=READ_CHUNK_SIZE):
+  """Run a process, streaming its stdout/stderr line by line while it runs.
+
+  Both pipes are read in non-blocking chunks through a selector (no polling timeout), lines are split
+  incrementally, and the pipes are read until EOF after the process exits, so no output is lost.
+  on_line(stream_name, line) is called for every line; max_lines bounds what is kept per stream.
+  """
+  proc = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+  captures = {'stdout': StreamCapture(max_lines), 'stderr': StreamCapture(max_lines)}
+
+  with selectors.DefaultSelector() as selector:
+    for name, pipe in (('stdout', proc.stdout), ('stderr', proc.stderr)):
+      os.set_blocking(pipe.fileno(), False)
+      selector.register(pipe, selectors.EVENT_READ, name)
+
+    while selector.get_map():
+      for key, _ in selector.select():
+        name = key.data
+        try:
+          data = os.read(key.fileobj.fileno(), chunk_size)
+        except BlockingIOError:
+          continue
+        lines = captures[name].feed(data) if data else captures[name].flush()
+        if not data:
+          selector.unregister(key.fileobj)
+          key.fileobj.close()
+        if on_line is not None:
+          for line in lines:
+            on_line(name, line)
+
+  returncode = proc.wait()
+  if returncode != 0:
+    logging.info(f"{args[0]} exited with status {returncode}")
+  return ProcessResult(returncode, captures['stdout'], captures['stderr'], proc)
@@ -0,0 +1,60 @@
+import logging
+from collections import defaultdict
+
+from waiters import watch_until
+
+
+class ReplicaReadinessTracker:
+  """Waits until ReplicaSets/StatefulSets have all their replicas ready, in any namespace.
+
+  Controllers are (namespace, name, kind) tuples and are deduplicated first. Each kind is then followed
+  with a single list+watch, namespaced when all its controllers share a namespace and cluster-wide
+  otherwise, so waiting on any number of controllers costs one list call per kind plus watch events.
+  """
+
+  def __init__(self, apps_api):
+    self.list_funcs = {
+      'ReplicaSet': (apps_api.list_namespaced_replica_set, apps_api.list_replica_set_for_all_namespaces),
+      'StatefulSet': (apps_api.list_namespaced_stateful_set, apps_api.list_stateful_set_for_all_namespaces),
+    }
+
+  def by_kind(self, controllers):
+    """{kind: {(namespace, name), ...}} for the kinds that are tracked, other owners (e.g. Jobs) are ignored"""
+    grouped = defaultdict(set)
+    for namespace, name, kind in controllers:
+      if kind in self.list_funcs:
+        grouped[kind].add((namespace, name))
+    return grouped
+
+  @staticmethod
+  def unready(keys, objects):
+    unready = []
+    for key in sorted(keys):
+      controller = objects.get(key)
+      # A controller that no longer exists has nothing left to wait for
+      if controller is None:
+        continue
+      number_of_replicas = controller.status.replicas or 0
+      number_of_ready_replicas = controller.status.ready_replicas or 0
+      if number_of_ready_replicas < number_of_replicas:
+        unready.append(f"{key[0]}/{key[1]} ({number_of_ready_replicas}/{number_of_replicas})")
+    return unready
+
+  def wait(self, controllers, timeout=None, stop=None):
+    for kind, keys in self.by_kind(controllers).items():
+      namespaced_func, all_namespaces_func = self.list_funcs[kind]
+      namespaces = {namespace for namespace, _ in keys}
+      # The API functions are passed as they are, kubernetes.watch needs them to deserialize events
+      if len(namespaces) == 1:
+        list_func, list_kwargs = namespaced_func, {'namespace': namespaces.pop()}
+      else:
+        list_func, list_kwargs = all_namespaces_func, {}
+      logging.info(f"Waiting for {len(keys)} {kind}(s) to have all replicas ready...")
+
+      def all_ready(objects, kind=kind, keys=keys):
+        unready = self.unready(keys, objects)
+        if unready:
+          logging.info(f"{kind}(s) without all replicas ready: {unready}")
+        return not unready
+
+      watch_until(list_func, all_ready, timeout=timeout, description=f"{kind} replicas", stop=stop, **list_kwargs)
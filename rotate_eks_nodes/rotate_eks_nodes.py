@@ -1,17 +1,26 @@
+import argparse
 import datetime
-import select
 import subprocess
 import time
-from sys import argv
 import sys
-import os
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Dict, DefaultDict
-from collections import defaultdict
+from typing import Dict, List, Optional
 import logging
 import boto3
-import kubernetes
+import botocore.config
 from kubernetes.client.rest import ApiException
+from drain import DrainEngine, stays_on_node
+from inventory import InventoryCollector, list_asg_names, list_instances
+from process_runner import run_streaming
+from replica_tracker import ReplicaReadinessTracker
+from api_calls import ApiCallCounter
+from k8s_context import KubernetesContext
+from rotation_journal import RotationJournal
+from rotation_planner import build_plan
+from rotation_telemetry import RotationTelemetry
+from rotation_scheduler import NodeTarget, RotationError, RotationScheduler
+from waiters import Backoff, poll_until, watch_until
 
 
 @dataclass
@@ -20,354 +29,319 @@ class ProcessOutput:
   stdout: str
   other_fds: Dict[int, str]
   proc: subprocess.Popen
+  returncode: Optional[int] = None
 
 
-def stream_while_running(cwd, args, line_delimiter='', log_output=True):
+def stream_while_running(cwd, args, line_delimiter='', log_output=True, max_lines=None):
   """Helper function for streaming a process' output whilst gathering it into a string"""
-  proc = subprocess.Popen(cwd=cwd,
-                          args=args, stderr=subprocess.PIPE,
-                          stdout=subprocess.PIPE, text=True, bufsize=1)
-
-  stderr = []
-  stdout = []
-  fds: DefaultDict[str] = defaultdict(list)
-  while True:
-    poll = proc.poll()
-    if poll is not None:
-      break
-    else:
-      # Poll the stdout/err streams every 0.05 seconds to see if anything has been written
-      rdrs, _, _ = select.select([proc.stdout, proc.stderr], [], [], 0.05)
-
-      # figure out which was returned
-      if rdrs != []:
-        for r in rdrs:
-          # The FD might return multiple lines, so keep calling readline()
-          # until we get a '' implying nothing more to consume
-          keep_reading = True
-          while keep_reading:
-            line = r.readline()
-            if len(line) > 0:
-              if line[-1] == "\n":
-                line = line[:-1]
-              if r.name == proc.stdout.fileno():
-                stdout.append(line)
-                if log_output:
-                  #logging.info(f"PID {str(proc.pid)} stdout: {line}")
-                  logging.info(f"{line}")
-              elif r.name == proc.stderr.fileno():
-                stderr.append(line)
-                if log_output:
-                  #logging.info(f"PID {str(proc.pid)} stderr: {line}")
-                  logging.info(f"{line}")
-              else:
-                fds[r.name].append(line)
-                if log_output:
-                  #logging.info(f"PID {str(proc.pid)} fd {r.name}: {line}")
-                  logging.info(f"{line}")
-            else:
-              keep_reading = False
-      else:
-        # no new output
-        continue
-
-  # Flatten the list of list of strings that are the file descriptor outputs.
-  # It makes it consistent with the subprocess output capture format
-  for fd in fds:
-    fds[fd] = line_delimiter.join(fds[fd])
-
-  return ProcessOutput(line_delimiter.join(stderr), line_delimiter.join(stdout), fds, proc)
+  def log_line(stream_name, line):
+    logging.info(f"{line}")
+
+  result = run_streaming(args, cwd=cwd, max_lines=max_lines, on_line=log_line if log_output else None)
+  return ProcessOutput(
+    line_delimiter.join(result.stderr.lines),
+    line_delimiter.join(result.stdout.lines),
+    {},
+    result.proc,
+    result.returncode
+  )
 
 
 def slurp_ec2_instances(client):
-  next_token = None
-  instances = []
-  keep_going = True
-  while keep_going:
-    if next_token is None:
-      tmp = client.describe_instances()
-    else:
-      tmp = client.describe_instances(NextToken=next_token)
-    for reservation in tmp['Reservations']:
-      for instance in reservation['Instances']:
-        instances.append(instance)
-      if 'NextToken' in tmp and tmp['NextToken'] is not None:
-        next_token = tmp['NextToken']
-      else:
-        keep_going = False
-  return instances
+  # Paginated by boto3, so pages without reservations still advance to the next one
+  return list_instances(client)
 
 
 def get_asgs_names(client, target):
-  next_token = None
-  asgs_names_list = []
-  keep_going = True
-  while keep_going:
-    if next_token is None:
-      tmp = client.describe_auto_scaling_groups()
+  return list_asg_names(client, target)
+
+
+def selector_matches(selector, labels):
+  """Whether a Kubernetes V1LabelSelector selects an object with the given labels"""
+  if selector is None:
+    return False
+  labels = labels or {}
+  for key, value in (selector.match_labels or {}).items():
+    if labels.get(key) != value:
+      return False
+  for expression in (selector.match_expressions or []):
+    values = expression.values or []
+    if expression.operator == 'In' and labels.get(expression.key) not in values:
+      return False
+    if expression.operator == 'NotIn' and labels.get(expression.key) in values:
+      return False
+    if expression.operator == 'Exists' and expression.key not in labels:
+      return False
+    if expression.operator == 'DoesNotExist' and expression.key in labels:
+      return False
+  return True
+
+
+class ClusterOperations:
+  """Every EC2/ASG/Kubernetes call a rotation makes. The clients are injected so fakes can stand in for them."""
+
+  def __init__(self, ec2_client, asg_client, k8s_core_client, k8s_policy_client, k8s_app_client,
+               namespace='default', snooze_seconds=30, pods_to_ignore=None, drain_engine=None, retries=None):
+    self.ec2_client = ec2_client
+    self.asg_client = asg_client
+    self.k8s_core_client = k8s_core_client
+    self.k8s_policy_client = k8s_policy_client
+    self.k8s_app_client = k8s_app_client
+    # None means pods in every namespace are rotated off the nodes and waited for
+    self.namespace = namespace
+    self.snooze_seconds = snooze_seconds
+    self.pods_to_ignore = pods_to_ignore or []
+    # Without a DrainEngine, cordon/drain/uncordon shell out to kubectl
+    self.drain_engine = drain_engine
+    self.replica_tracker = ReplicaReadinessTracker(k8s_app_client)
+    self.retries = retries or ApiCallCounter()
+
+  def snooze(self):
+    time.sleep(self.snooze_seconds)
+
+  def _kubectl(self, *args):
+    output = stream_while_running("/", ['kubectl', *args], line_delimiter='\n', max_lines=1000)
+    if output.returncode != 0:
+      raise RuntimeError(f"kubectl {' '.join(args)} failed with exit status {output.returncode}: {output.stderr}")
+
+  def cordon(self, node_name):
+    if self.drain_engine is not None:
+      self.drain_engine.cordon(node_name)
+    else:
+      self._kubectl('cordon', node_name)
+
+  def uncordon(self, node_name):
+    if self.drain_engine is not None:
+      self.drain_engine.uncordon(node_name)
     else:
-      tmp = client.describe_auto_scaling_groups(NextToken=next_token)
-    for asg in tmp['AutoScalingGroups']:
-      if target == 'dbs':
-        if 'db' in asg['AutoScalingGroupName']:
-          asgs_names_list.append(asg['AutoScalingGroupName'])
-      elif target == 'apps':
-        if 'db' not in asg['AutoScalingGroupName']:
-          asgs_names_list.append(asg['AutoScalingGroupName'])
-      elif target == 'all':
-        asgs_names_list.append(asg['AutoScalingGroupName'])
-    if 'NextToken' in tmp and tmp['NextToken'] is not None:
-      next_token = tmp['NextToken']
+      self._kubectl('uncordon', node_name)
+
+  def drain(self, node_name):
+    if self.drain_engine is not None:
+      self.drain_engine.drain(node_name)
     else:
-      keep_going = False
-  return asgs_names_list
+      self._kubectl('drain', '--ignore-daemonsets', '--delete-local-data', node_name)
 
+  def _pod_lister(self):
+    """The pod list function and its namespace argument, for watch_until and direct calls alike"""
+    if self.namespace is None:
+      return self.k8s_core_client.list_pod_for_all_namespaces, {}
+    return self.k8s_core_client.list_namespaced_pod, {'namespace': self.namespace}
 
-def main(region, target):
+  def _drained_pods(self, pods):
+    """The pods a drain moves off their node, without DaemonSet and mirror pods and the ones in pods_to_ignore"""
+    return [pod for pod in pods if not stays_on_node(pod) and not pod.metadata.name.startswith(tuple(self.pods_to_ignore))]
+
+  def list_node_pods(self, node_name):
+    list_func, list_kwargs = self._pod_lister()
+    try:
+      field_selector = 'spec.nodeName=' + node_name
+      ret = list_func(watch=False, field_selector=field_selector, **list_kwargs)
+      return self._drained_pods(ret.items)
+    except ApiException as e:
+      logging.error(f"Exception when calling Kubernetes CoreV1Api->{list_func.__name__}: {e}\n")
+      raise
+
+  def pod_controllers(self, pods):
+    """(namespace, controller name, controller kind) tuples for the given pods, from the owner references the pod list already carries"""
+    pod_controller_and_controller_kind_tuple_list = []
+    for pod in pods:
+      # Ad hoc pods have no controller, nothing will bring them back to wait for
+      for owner in (pod.metadata.owner_references or [])[:1]:
+        pod_controller_and_controller_kind_tuple_list.append((pod.metadata.namespace, owner.name, owner.kind))
+    return pod_controller_and_controller_kind_tuple_list
+
+  def blocking_pdbs(self, node_name):
+    """Names of PodDisruptionBudgets covering pods on the node which currently allow no disruptions"""
+    pods = self.list_node_pods(node_name)
+    if self.namespace is None:
+      budgets = self.k8s_policy_client.list_pod_disruption_budget_for_all_namespaces().items
+    else:
+      budgets = self.k8s_policy_client.list_namespaced_pod_disruption_budget(self.namespace).items
+    blocking = []
+    for budget in budgets:
+      if (budget.status.disruptions_allowed or 0) > 0:
+        continue
+      # A budget only covers pods in its own namespace
+      if any(pod.metadata.namespace == budget.metadata.namespace and selector_matches(budget.spec.selector, pod.metadata.labels) for pod in pods):
+        blocking.append(f"{budget.metadata.namespace}/{budget.metadata.name}")
+    return blocking
+
+  def asg_capacity(self, asg_name):
+    get_asg = self.asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
+    return get_asg['AutoScalingGroups'][0]['DesiredCapacity'], get_asg['AutoScalingGroups'][0]['MaxSize']
+
+  def set_asg_capacity(self, asg_name, desired_capacity, max_size):
+    self.asg_client.update_auto_scaling_group(AutoScalingGroupName=asg_name, DesiredCapacity=desired_capacity, MaxSize=max_size)
+
+  def wait_for_in_service(self, asg_name, count, timeout=datetime.timedelta(minutes=5), stop=None):
+    logging.info(f"Waiting for {count} instance(s) to be InService in ASG: {asg_name}...")
+
+    def in_service():
+      get_asg = self.asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
+      instances = get_asg['AutoScalingGroups'][0]['Instances']
+      instances_lifecycle_states = [instance['LifecycleState'] for instance in instances]
+      number_of_in_service_instances = instances_lifecycle_states.count("InService")
+      if number_of_in_service_instances != count:
+        self.retries.add(f"InService poll of {asg_name}")
+        logging.info(f"Still waiting for {count} instance(s) to be InService in ASG: {asg_name} ({number_of_in_service_instances} now)...")
+      return number_of_in_service_instances == count
+
+    # ASGs have no watch API: poll with jittered backoff, starting fast and capped at snooze_seconds
+    try:
+      poll_until(in_service, Backoff(initial=2, maximum=self.snooze_seconds), timeout=timeout, description=f"ASG {asg_name} InService", stop=stop)
+    except TimeoutError:
+      raise RuntimeError(f"ASG: {asg_name} did not reach {count} InService instance(s) in {timeout}. Bailing out!")
+    logging.info(f"{count} instance(s) InService in ASG: {asg_name}. Moving along...")
+
+  def wait_for_drained(self, node_name, timeout=datetime.timedelta(minutes=15), stop=None):
+    last_count = None
+
+    def drained(pods):
+      nonlocal last_count
+      # DaemonSet and mirror pods (kube-proxy, CNI, log shippers with --all-namespaces) stay until the node is gone
+      remaining = [f"{pod.metadata.namespace}/{pod.metadata.name}" for pod in self._drained_pods(pods.values())]
+      if remaining and len(remaining) != last_count:
+        logging.info(f"Still waiting for all pods to be drained off node {node_name}. {len(remaining)} pod(s) ({remaining}) left...")
+      last_count = len(remaining)
+      return not remaining
+
+    # Follow the node's pods with a watch, so we move on the moment the last one is gone
+    list_func, list_kwargs = self._pod_lister()
+    try:
+      watch_until(
+        list_func,
+        drained,
+        timeout=timeout,
+        description=f"node {node_name} to drain",
+        stop=stop,
+        field_selector='spec.nodeName=' + node_name,
+        **list_kwargs
+      )
+    except TimeoutError:
+      raise RuntimeError(f"Pods still running on node {node_name} after {timeout}: {last_count} pod(s) left. Bailing out!")
+    logging.info(f"All pods have been drained off node {node_name}. Moving along...")
+
+  def wait_for_replicas(self, controllers, stop=None):
+    # One list+watch per controller kind, however many ReplicaSets/StatefulSets the batch's pods belong to
+    logging.info(f"Will wait for all replicas to be available for each ReplicaSet/StatefulSet, while ignoring DaemonSet/Ad Hoc Pods ({self.pods_to_ignore})...")
+    self.replica_tracker.wait(controllers, stop=stop)
+    logging.info("100% replicas available for each ReplicaSet/StatefulSet. Moving along...")
+
+  def terminate(self, instance_ids):
+    self.ec2_client.terminate_instances(InstanceIds=instance_ids)
+
+
+def main(region, target, surge=1, max_unavailable=1, max_parallel_asgs=1, kubectl_drain=False, max_parallel_evictions=8, state_file=None, plan=False, plan_output=None,
+         namespace='default', timings_file=None, pushgateway=None, inventory_workers=8):
 
   logging.basicConfig(
     level=logging.INFO,
-    format='%(levelname)s: %(asctime)s: %(message)s'
+    format='%(levelname)s: %(asctime)s: %(threadName)s: %(message)s'
   )
 
-  ec2_client = boto3.client('ec2', region_name=region)
-  asg_client = boto3.client('autoscaling', region_name=region)
+  # Every AWS and Kubernetes call of the rotation is counted, so API server load can be compared between runs
+  api_calls = ApiCallCounter()
+  aws_config = botocore.config.Config(max_pool_connections=max(10, inventory_workers))
+  collector = InventoryCollector(
+    lambda service_name, region_name: api_calls.instrument_boto3(boto3.client(service_name, region_name=region_name, config=aws_config)),
+    [region],
+    max_workers=inventory_workers
+  )
+  ec2_client, asg_client = collector.ec2_client(region), collector.asg_client(region)
+  retries = ApiCallCounter()
 
-  namespace = 'default'
   snooze_seconds = 30
   pods_to_ignore = ['datadog-agent']
-  errored = False
 
-  # Get ASGS
-  asgs_names_list = get_asgs_names(asg_client, target)
+  # Collect the ASGs and only their EC2 instances (filtered server-side by ASG tag) while the K8s nodes are listed
+  with ThreadPoolExecutor(max_workers=1, thread_name_prefix='inventory') as startup:
+    inventory_future = startup.submit(collector.collect, target)
 
-  # Get K8s nodes information
-  kubernetes.config.load_kube_config()
-  k8s_core_client = kubernetes.client.CoreV1Api()
-  nodes = k8s_core_client.list_node()
+    # Get K8s nodes information, through one kubeconfig load and one pooled API client for the whole run
+    k8s = KubernetesContext(counter=api_calls)
+    nodes = k8s.core.list_node()
 
-  # Get EC2 instance tag information
-  ec2_instances = slurp_ec2_instances(ec2_client)
+    asgs_names_list, inventory = inventory_future.result()[region]
+  collector.close()
+  logging.info(f"{len(asgs_names_list)} ASG(s) targeted: {asgs_names_list}")
+  inventory.link_nodes(nodes.items)
 
+  targets: List[NodeTarget] = []
   for k8s_node in nodes.items:
     instance_id = k8s_node.spec.provider_id.split('/')[-1]
-    node_name = k8s_node.metadata.name
-    matched_ec2_node = list(filter(lambda x: x['InstanceId'] == instance_id, ec2_instances))[0]
-    asg_name = [x['Value'] for x in matched_ec2_node['Tags'] if x['Key'] == 'aws:autoscaling:groupName'][0]
-    if asg_name not in asgs_names_list:
+    record = inventory.get(instance_id)
+    if record is None:
+      # Not in one of the targeted ASGs (or not an ASG instance at all)
       continue
-
-    print()
-    logging.info(f"Dealing with instance: {instance_id}, in ASG: {asg_name}")
-
-    logging.info(f"Will cordon instance: {instance_id}, with node_name: {node_name} so no new pods are scheduled on it")
-    stream_while_running("/", ['kubectl', 'cordon', node_name])
-
-    # Create a dict with node and pods details
-    try:
-      node_and_pods_dict = {}
-      kubernetes.config.load_kube_config()
-      k8s_core_client = kubernetes.client.CoreV1Api()
-      field_selector = 'spec.nodeName=' + k8s_node.metadata.name
-      ret = k8s_core_client.list_namespaced_pod(namespace, watch=False, field_selector=field_selector)
-      node_and_pods_dict[instance_id] = {}
-      node_and_pods_dict[instance_id]['node_name'] = k8s_node.metadata.name
-      node_and_pods_dict[instance_id]['asg_name'] = asg_name
-      node_and_pods_dict[instance_id]['pods'] = []
-
-      for i in ret.items:
-        if not i.metadata.name.startswith(tuple(pods_to_ignore)):
-          node_and_pods_dict[instance_id]['pods'].append(i.metadata.name)
-      node_and_pods_dict[instance_id]['number_of_pods'] = len(node_and_pods_dict[instance_id]['pods'])
-
-    except ApiException as e:
-      logging.error("Exception when calling Kubernetes CoreV1Api->list_namespaced_pod: %s\n" % e)
-
-    logging.info(f"Instance and pod info: {node_and_pods_dict}")
-
-    pod_controller_and_controller_kind_tuple_list = []
-
-    # Create a list of tuples with controller name (derived from pod name) and controller kind
-    for pod in node_and_pods_dict[instance_id]['pods']:
-      try:
-        kubernetes.config.load_kube_config()
-        k8s_core_client = kubernetes.client.CoreV1Api()
-        api_response = k8s_core_client.read_namespaced_pod(pod, namespace)
-        controller_kind = (api_response.__dict__['_metadata'].__dict__['_owner_references'][0].__dict__['_kind'])
-        pod_controller = pod.rpartition('-')[0]
-        pod_controller_and_controller_kind_tuple = (pod_controller, controller_kind)
-        pod_controller_and_controller_kind_tuple_list.append(pod_controller_and_controller_kind_tuple)
-      except ApiException as e:
-        logging.error("Exception when calling Kubernetes CoreV1Api->read_namespaced_pod: %s\n" % e)
-
-    # Scale up ASG DesiredCapacity by 1, and also possibly increase MaxSize by 1 if DesiredCapacity + 1 > MaxSize
-    logging.info(f"Dealing with ASG: {asg_name}")
-    get_asg = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
-
-    # Current ASG values
-    current_desired_capacity = get_asg['AutoScalingGroups'][0]['DesiredCapacity']
-    logging.info(f"Current ASG DesiredCapacity: {current_desired_capacity}")
-    current_max_size = get_asg['AutoScalingGroups'][0]['MaxSize']
-    logging.info(f"Current ASG MaxSize: {current_max_size}")
-
-    # New ASG values
-    new_desired_capacity = current_desired_capacity + 1
-    logging.info(f"New ASG DesiredCapacity: {new_desired_capacity}")
-    new_max_size = new_desired_capacity if new_desired_capacity > current_max_size else current_max_size
-    logging.info(f"New ASG MaxSize: {new_max_size}")
-
-    try:
-      logging.info(f"Updating ASG: {asg_name} with new DesiredCapacity: {new_desired_capacity} and MaxSize: {new_max_size}")
-      update_asg = asg_client.update_auto_scaling_group(AutoScalingGroupName=asg_name, DesiredCapacity=new_desired_capacity, MaxSize=new_max_size)
-
-      # Wait for new instance to be InService
-      logging.info("Waiting for new instance to be InService...")
-      new_instance_not_up = True
-      while new_instance_not_up:
-        get_asg = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
-        instances = get_asg['AutoScalingGroups'][0]['Instances']
-        instances_lifecycle_states = [instance['LifecycleState'] for instance in instances]
-        number_of_in_service_instances = instances_lifecycle_states.count("InService")
-        if number_of_in_service_instances == new_desired_capacity:
-          logging.info("New instance ready. Moving along...")
-          new_instance_not_up = False
-        else:
-          logging.info(f"Still waiting for new instance to be InService. Will snooze for {snooze_seconds} seconds and try again...")
-          time.sleep(snooze_seconds)
-
-        # Set a 5 minute limit on the startup, in case something goes wrong
-        start_time = datetime.datetime.now()
-        if datetime.datetime.now() > (start_time + datetime.timedelta(minutes=5)):
-          raise RuntimeError("Failed to get new node in 5 minutes. Bailing out!")
-
-      # Drain the old node, and wait till it's fully drained
-      logging.info(f"Draining old instance {instance_id}/{node_name} in ASG {asg_name}")
-      stream_while_running("/", ['kubectl', 'drain', '--ignore-daemonsets', '--delete-local-data', node_name])
-      all_pods_not_drained = True
-
-      while all_pods_not_drained:
-        try:
-          node_and_pods_drained_node_dict = {}
-          kubernetes.config.load_kube_config()
-          k8s_core_client = kubernetes.client.CoreV1Api()
-          field_selector = 'spec.nodeName=' + k8s_node.metadata.name
-          ret = k8s_core_client.list_namespaced_pod(namespace, watch=False, field_selector=field_selector)
-          node_and_pods_drained_node_dict[instance_id] = {}
-          node_and_pods_drained_node_dict[instance_id]['node_name'] = k8s_node.metadata.name
-          node_and_pods_drained_node_dict[instance_id]['asg_name'] = asg_name
-          node_and_pods_drained_node_dict[instance_id]['pods'] = []
-
-          for i in ret.items:
-            if not i.metadata.name.startswith(tuple(pods_to_ignore)):
-              node_and_pods_drained_node_dict[instance_id]['pods'].append(i.metadata.name)
-          node_and_pods_drained_node_dict[instance_id]['number_of_pods'] = len(node_and_pods_drained_node_dict[instance_id]['pods'])
-
-        except ApiException as e:
-          logging.error("Exception when calling Kubernetes CoreV1Api->list_namespaced_pod: %s\n" % e)
-
-        if node_and_pods_drained_node_dict[instance_id]['number_of_pods'] == 0:
-          logging.info(f"All pods have been drained off instance {instance_id}. Moving along...")
-          all_pods_not_drained = False
-        else:
-          logging.info(f"Still waiting for all pods to be drained off instance {instance_id}. {node_and_pods_drained_node_dict[instance_id]['number_of_pods']} pod(s) ({node_and_pods_drained_node_dict[instance_id]['pods']}) left. Will snooze for {snooze_seconds} seconds and try again...")
-          time.sleep(snooze_seconds)
-
-      # Wait and keep checking Kubernetes API to see if there are 100% replicas available for each ReplicaSet and StatefulSet
-      logging.info(f"Will wait for all replicas to be available for each ReplicaSet/StatefulSet, while ignoring DaemonSet/Ad Hoc Pods ({pods_to_ignore})...")
-
-      set_counter_list = []
-
-      while len(pod_controller_and_controller_kind_tuple_list) > len(set_counter_list):
-        for pod_controller, controller_kind in pod_controller_and_controller_kind_tuple_list:
-          logging.info(f"Dealing with {pod_controller}, {controller_kind}")
-          all_replicas_not_available = True
-          while all_replicas_not_available:
-            try:
-              kubernetes.config.load_kube_config()
-              k8s_app_client = kubernetes.client.AppsV1Api()
-              if controller_kind == 'ReplicaSet':
-                api_response = k8s_app_client.read_namespaced_replica_set(pod_controller, namespace)
-              elif controller_kind == 'StatefulSet':
-                api_response = k8s_app_client.read_namespaced_stateful_set(pod_controller, namespace)
-              else:
-                set_counter_list.append("UnknownController")
-                continue
-              number_of_replicas = api_response.__dict__['_status'].__dict__['_replicas']
-              number_of_ready_replicas = api_response.__dict__['_status'].__dict__['_ready_replicas']
-              if number_of_ready_replicas is None or number_of_ready_replicas < number_of_replicas:
-                logging.info(f"{pod_controller} {controller_kind} does not have {number_of_replicas}/{number_of_replicas} replicas ready (only {number_of_ready_replicas or 0}/{number_of_replicas} ready). Will snooze for {snooze_seconds} seconds and try again...")
-                time.sleep(snooze_seconds)
-              elif number_of_ready_replicas >= number_of_replicas:
-                logging.info(f"{pod_controller} {controller_kind} has {number_of_ready_replicas}/{number_of_replicas} replicas ready. Moving along...")
-                all_replicas_not_available = False
-                set_counter_list.append(pod_controller)
-              else:
-                logging.info(f"{pod_controller} {controller_kind} does not have {number_of_replicas}/{number_of_replicas} replicas ready (only {number_of_ready_replicas}/{number_of_replicas} ready). Will snooze for {snooze_seconds} seconds and try again...")
-                time.sleep(snooze_seconds)
-            except ApiException as e:
-              logging.error("Exception when calling Kubernetes AppsV1Api: %s\n" % e)
-
-      logging.info("100% replicas available for each ReplicaSet/StatefulSet. Moving along...")
-
-      # Terminate the old node
-      logging.info("Terminating old instance...")
-      terminate_instance = ec2_client.terminate_instances(InstanceIds=[instance_id])
-
-      # Scale ASG DesiredCapacity and MaxSize back down to original values so we are consistent with Terraform
-      logging.info(f"Reverting ASG: {asg_name} with original DesiredCapacity: {current_desired_capacity} and MaxSize: {current_max_size}")
-      update_asg = asg_client.update_auto_scaling_group(AutoScalingGroupName=asg_name, DesiredCapacity=current_desired_capacity, MaxSize=current_max_size)
-
-    except (KeyboardInterrupt, TypeError) as e:
-      errored = True
-      logging.error(e)
-      logging.error(f"Signal/TypeError caught! Will revert ASG: {asg_name} back to original DesiredCapacity: {current_desired_capacity} and MaxSize: {current_max_size} before exiting!")
-      stream_while_running("/", ['kubectl', 'uncordon', node_name])
-      update_asg = asg_client.update_auto_scaling_group(AutoScalingGroupName=asg_name, DesiredCapacity=current_desired_capacity, MaxSize=current_max_size)
-      logging.error(f"ASG reverted back to original values. Instance {instance_id} has been uncordoned. Check state of Kubernetes and AWS before running the script again. Exiting!")
-      try:
-        sys.exit(0)
-      except SystemExit:
-        os._exit(0)
-
-    except:
-      errored = True
-      logging.error("Unexpected error:", sys.exc_info()[0])
-      logging.error(f"Will revert ASG: {asg_name} back to original DesiredCapacity: {current_desired_capacity} and MaxSize: {current_max_size} before exiting!")
-      stream_while_running("/", ['kubectl', 'uncordon', node_name])
-      update_asg = asg_client.update_auto_scaling_group(AutoScalingGroupName=asg_name, DesiredCapacity=current_desired_capacity, MaxSize=current_max_size)
-      logging.error(f"ASG reverted back to original values. Instance {instance_id} has been uncordoned. Check state of Kubernetes and AWS before running the script again. Exiting!")
-      try:
-        sys.exit(0)
-      except SystemExit:
-        os._exit(0)
-      raise
-
+    targets.append(NodeTarget(instance_id=instance_id, node_name=k8s_node.metadata.name, asg_name=record.asg_name))
+
+  ops = ClusterOperations(
+    ec2_client=ec2_client,
+    asg_client=asg_client,
+    k8s_core_client=k8s.core,
+    k8s_policy_client=k8s.policy,
+    k8s_app_client=k8s.apps,
+    namespace=namespace,
+    snooze_seconds=snooze_seconds,
+    pods_to_ignore=pods_to_ignore,
+    drain_engine=None if kubectl_drain else DrainEngine(k8s.core, max_parallel_evictions=max_parallel_evictions, retries=retries),
+    retries=retries
+  )
+  # Per-node progress survives crashes and kills, a rerun resumes from it instead of starting over
+  journal = RotationJournal(state_file or f'rotate_eks_nodes-{region}-{target}.state.json')
+  # Phase timings are appended across runs, so they accumulate into data for rotation_simulator.py
+  telemetry = RotationTelemetry(timings_file or f'rotate_eks_nodes-{region}-{target}.timings.jsonl', api_calls=api_calls, retries=retries)
+  scheduler = RotationScheduler(ops, surge=surge, max_unavailable=max_unavailable, max_parallel_asgs=max_parallel_asgs, journal=journal, telemetry=telemetry)
+
+  if plan or plan_output:
+    # Only read calls from here: nothing is cordoned, scaled, drained or terminated
     try:
-      if errored:
-        logging.error(f"An error occurred above, and the ASG: {asg_name} has already been reverted to original DesiredCapacity: {current_desired_capacity} and MaxSize: {current_max_size}. Exiting!")
-      else:
-        # Wait for number of instances in ASG to scale back down
-        logging.info("Waiting for number of instances in ASG to scale back down...")
-        asg_instances_not_scaled_down = True
-        while asg_instances_not_scaled_down:
-          get_asg = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
-          instances = get_asg['AutoScalingGroups'][0]['Instances']
-          instances_lifecycle_states = [instance['LifecycleState'] for instance in instances]
-          number_of_in_service_instances = instances_lifecycle_states.count("InService")
-          if number_of_in_service_instances == current_desired_capacity:
-            logging.info(f"Number of instances in ASG has scaled back down to original DesiredCapacity: {current_desired_capacity}")
-            print("--------------------------------------------------------------------------------------------")
-            print("--------------------------------------------------------------------------------------------")
-            asg_instances_not_scaled_down = False
-          else:
-            logging.info(f"Still waiting for number of instances in ASG to scale back down. Will snooze for {snooze_seconds} seconds and try again...")
-            time.sleep(snooze_seconds)
-    except Exception as e:
-      logging.error(e)
-      logging.error(f"An error occurred above, and the infrastructure is possibily in an unstable state now. Check state of Kubernetes and AWS before running the script again. Exiting!")
+      rotation_plan = build_plan(scheduler, targets)
+      rotation_plan.log()
+      if plan_output:
+        rotation_plan.save(plan_output)
+        logging.info(f"Plan written to {plan_output}, estimate its duration with rotation_simulator.py --plan {plan_output}")
+    finally:
+      api_calls.log_summary(f"API calls for planning {len(targets)} node(s)")
+      k8s.close()
+    return
+
+  logging.info(f"Rotating {len(targets)} node(s) in {len({t.asg_name for t in targets})} ASG(s), surge: {scheduler.surge}, max unavailable: {max_unavailable}, parallel ASGs: {max_parallel_asgs}")
+  try:
+    scheduler.run(targets)
+    journal.complete()
+  except (RotationError, KeyboardInterrupt) as e:
+    logging.error(e)
+    logging.error(f"An error occurred above, and the affected ASG(s) have been reverted. Check state of Kubernetes and AWS before running the script again, it will resume from {journal.path}. Exiting!")
+    sys.exit(1)
+  finally:
+    telemetry.log_summary()
+    if pushgateway:
+      telemetry.push(pushgateway)
+    k8s.close()
 
 
 if __name__ == '__main__':
-  region = argv[1]
-  target = argv[2]
-  main(region, target)
+  parser = argparse.ArgumentParser(description='Rotate EKS nodes by surging their ASGs, draining and terminating the old nodes')
+  parser.add_argument('region')
+  parser.add_argument('target', choices=['dbs', 'apps', 'all'])
+  parser.add_argument('--surge', type=int, default=1, help='nodes rotated at once per ASG')
+  parser.add_argument('--max-unavailable', type=int, default=1, help='nodes cordoned/draining at once across all ASGs')
+  parser.add_argument('--max-parallel-asgs', type=int, default=1, help='ASGs rotated concurrently')
+  parser.add_argument('--max-parallel-evictions', type=int, default=8, help='pods evicted concurrently per drain')
+  parser.add_argument('--kubectl-drain', action='store_true', help='cordon/drain/uncordon with kubectl instead of the Eviction API')
+  parser.add_argument('--state-file', help='rotation progress journal to resume from (default: rotate_eks_nodes-<region>-<target>.state.json)')
+  parser.add_argument('--plan', action='store_true', help='only print which nodes and ASGs would be rotated, in which batches, changing nothing')
+  parser.add_argument('--plan-output', help='write the plan as JSON to this file (implies --plan)')
+  parser.add_argument('--namespace', default='default', help='namespace whose pods are drained and waited for (default: default)')
+  parser.add_argument('--all-namespaces', action='store_true', help='drain and wait for pods in every namespace')
+  parser.add_argument('--timings-file', help='JSON lines file phase timings are appended to (default: rotate_eks_nodes-<region>-<target>.timings.jsonl)')
+  parser.add_argument('--pushgateway', help='Prometheus pushgateway URL to push the rotation metrics to at the end')
+  parser.add_argument('--inventory-workers', type=int, default=8, help='concurrent EC2/ASG describe requests while collecting the inventory')
+  args = parser.parse_args()
+  main(args.region, args.target, surge=args.surge, max_unavailable=args.max_unavailable, max_parallel_asgs=args.max_parallel_asgs,
+       kubectl_drain=args.kubectl_drain, max_parallel_evictions=args.max_parallel_evictions, state_file=args.state_file,
+       plan=args.plan, plan_output=args.plan_output,
+       namespace=None if args.all_namespaces else args.namespace, timings_file=args.timings_file, pushgateway=args.pushgateway,
+       inventory_workers=args.inventory_workers)
@@ -0,0 +1,113 @@
+import datetime
+import json
+import logging
+import os
+import threading
+
+# Phases a node goes through, in order. A node is only ever moved forward, except when its batch is reverted.
+PENDING = 'pending'
+CORDONED = 'cordoned'
+DRAINED = 'drained'
+TERMINATED = 'terminated'
+PHASES = [PENDING, CORDONED, DRAINED, TERMINATED]
+
+
+class RotationJournal:
+  """Per-node phase progress and per-ASG surge state of a rotation, persisted to a local JSON file.
+
+  Every change is written through atomically (temp file + rename), so after a crash or kill the next run
+  can skip terminated nodes, resume a half-rotated batch from its last completed phase and revert an ASG
+  to the capacity it had before it was surged. With path=None nothing is persisted.
+  """
+
+  def __init__(self, path=None):
+    self.path = path
+    self.lock = threading.Lock()
+    self.state = {'nodes': {}, 'asgs': {}}
+    if path is not None and os.path.exists(path):
+      with open(path) as f:
+        self.state = json.load(f)
+      logging.info(f"Resuming from rotation state in {path}: {self.summary()}")
+
+  def summary(self):
+    with self.lock:
+      counts = {}
+      for node in self.state['nodes'].values():
+        counts[node['phase']] = counts.get(node['phase'], 0) + 1
+      return ', '.join(f"{count} {phase}" for phase, count in counts.items()) or 'no nodes'
+
+  def _save(self):
+    if self.path is None:
+      return
+    tmp_path = self.path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      json.dump(self.state, f, indent=2, sort_keys=True)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, self.path)
+
+  def phase(self, node):
+    with self.lock:
+      return self.state['nodes'].get(node.instance_id, {}).get('phase', PENDING)
+
+  def reached(self, node, phase):
+    return PHASES.index(self.phase(node)) >= PHASES.index(phase)
+
+  def set_phase(self, node, phase):
+    with self.lock:
+      self.state['nodes'][node.instance_id] = {
+        'node_name': node.node_name,
+        'asg_name': node.asg_name,
+        'phase': phase,
+        'updated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+      }
+      self._save()
+
+  def in_progress(self, node):
+    return self.phase(node) not in (PENDING, TERMINATED)
+
+  def surge(self, asg_name):
+    """(desired capacity, max size, controllers) the ASG had before it was surged, or None if it is not surged"""
+    with self.lock:
+      record = self.state['asgs'].get(asg_name)
+    if record is None:
+      return None
+    return record['desired_capacity'], record['max_size'], [tuple(controller) for controller in record['controllers']]
+
+  def surged_batch(self, asg_name):
+    """Instance ids of the batch the ASG was surged for, in the order they were batched"""
+    with self.lock:
+      return list(self.state['asgs'].get(asg_name, {}).get('batch', []))
+
+  def surged_asgs(self):
+    with self.lock:
+      return list(self.state['asgs'])
+
+  def record_surge(self, asg_name, desired_capacity, max_size, controllers, instance_ids):
+    # The batch members are kept too: the surge is sized by them, so a resume must finish exactly that batch
+    with self.lock:
+      self.state['asgs'][asg_name] = {
+        'desired_capacity': desired_capacity,
+        'max_size': max_size,
+        'controllers': [list(c) for c in controllers],
+        'batch': list(instance_ids),
+      }
+      self._save()
+
+  def clear_surge(self, asg_name):
+    with self.lock:
+      self.state['asgs'].pop(asg_name, None)
+      self._save()
+
+  def reset(self, nodes):
+    """Forget the progress of nodes whose batch was reverted (uncordoned), they are rotated from scratch next time"""
+    with self.lock:
+      for node in nodes:
+        self.state['nodes'].pop(node.instance_id, None)
+      self._save()
+
+  def complete(self):
+    """The whole rotation finished, nothing is left to resume"""
+    if self.path is not None and os.path.exists(self.path):
+      logging.info(f"Rotation complete, removing state file {self.path}")
+      os.remove(self.path)
@@ -0,0 +1,86 @@
+import json
+import logging
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Tuple
+
+from rotation_scheduler import NodeTarget
+
+
+@dataclass
+class AsgPlan:
+  asg_name: str
+  desired_capacity: int
+  max_size: int
+  batches: List[List[NodeTarget]]
+  # node name -> (namespace, controller name, controller kind) of the pods that will be evicted from it
+  controllers: Dict[str, List[Tuple[str, str, str]]] = field(default_factory=dict)
+  # node name -> PodDisruptionBudgets that would hold up its drain right now
+  blocking_pdbs: Dict[str, List[str]] = field(default_factory=dict)
+
+  @property
+  def node_count(self):
+    return sum(len(batch) for batch in self.batches)
+
+  @property
+  def surged_capacity(self):
+    return self.desired_capacity + max((len(batch) for batch in self.batches), default=0)
+
+
+@dataclass
+class RotationPlan:
+  """What a rotation would do: which nodes, in which batches, in which ASGs, and which controllers it waits on"""
+  surge: int
+  max_unavailable: int
+  max_parallel_asgs: int
+  asgs: List[AsgPlan]
+  skipped: List[NodeTarget] = field(default_factory=list)
+
+  def log(self):
+    logging.info(f"Rotation plan: {sum(asg.node_count for asg in self.asgs)} node(s) in {len(self.asgs)} ASG(s), surge: {self.surge}, max unavailable: {self.max_unavailable}, parallel ASGs: {self.max_parallel_asgs}")
+    for asg in self.asgs:
+      logging.info(f"ASG: {asg.asg_name}, DesiredCapacity {asg.desired_capacity} -> {asg.surged_capacity} while rotating, MaxSize {asg.max_size} -> {max(asg.max_size, asg.surged_capacity)}")
+      for number, batch in enumerate(asg.batches, 1):
+        logging.info(f"  batch {number}/{len(asg.batches)}:")
+        for node in batch:
+          controllers = sorted({f"{kind}/{namespace}/{name}" for namespace, name, kind in asg.controllers.get(node.node_name, [])})
+          blocking = asg.blocking_pdbs.get(node.node_name)
+          logging.info(f"    {node.instance_id} {node.node_name}, controllers: {controllers or 'none'}{f', blocked by PDB(s) {blocking}' if blocking else ''}")
+    for node in self.skipped:
+      logging.info(f"Skipped, already replaced: {node.instance_id} {node.node_name} ({node.asg_name})")
+
+  def save(self, path):
+    with open(path, 'w') as f:
+      json.dump(asdict(self), f, indent=2)
+
+  @classmethod
+  def load(cls, path):
+    with open(path) as f:
+      data = json.load(f)
+    asgs = []
+    for asg in data['asgs']:
+      batches = [[NodeTarget(**node) for node in batch] for batch in asg['batches']]
+      controllers = {node_name: [tuple(c) for c in cs] for node_name, cs in asg['controllers'].items()}
+      asgs.append(AsgPlan(asg['asg_name'], asg['desired_capacity'], asg['max_size'], batches, controllers, asg['blocking_pdbs']))
+    skipped = [NodeTarget(**node) for node in data['skipped']]
+    return cls(data['surge'], data['max_unavailable'], data['max_parallel_asgs'], asgs, skipped)
+
+
+def build_plan(scheduler, targets: List[NodeTarget]):
+  """Plan a rotation with the scheduler's settings and journal, through read-only calls on scheduler.ops only"""
+  ops = scheduler.ops
+  by_asg = scheduler.queue(targets)
+  queued = {node for nodes in by_asg.values() for node in nodes}
+
+  asgs = []
+  for asg_name, nodes in by_asg.items():
+    desired_capacity, max_size = ops.asg_capacity(asg_name)
+    plan = AsgPlan(asg_name, desired_capacity, max_size, scheduler.batches(nodes))
+    for node in nodes:
+      plan.controllers[node.node_name] = ops.pod_controllers(ops.list_node_pods(node.node_name))
+      blocking = ops.blocking_pdbs(node.node_name)
+      if blocking:
+        plan.blocking_pdbs[node.node_name] = blocking
+    asgs.append(plan)
+
+  skipped = [target for target in targets if target not in queued]
+  return RotationPlan(scheduler.surge, scheduler.max_unavailable, scheduler.max_parallel_asgs, asgs, skipped)
@@ -0,0 +1,268 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import List
+
+from rotation_journal import CORDONED, DRAINED, TERMINATED, RotationJournal
+from rotation_telemetry import RotationTelemetry
+
+
+@dataclass(frozen=True)
+class NodeTarget:
+  instance_id: str
+  node_name: str
+  asg_name: str
+
+
+class RotationError(Exception):
+  """Raised when a batch failed; its ASG has been reverted and its nodes uncordoned"""
+
+
+class RotationInterrupted(RotationError):
+  """Raised in the batches in flight once the rotation was interrupted, so they revert like a failed batch"""
+
+
+class UnavailableSlots:
+  """Global cap on how many nodes may be cordoned/draining at once, across all ASGs"""
+
+  def __init__(self, max_unavailable):
+    self.available = max_unavailable
+    self.condition = threading.Condition()
+
+  def acquire(self, count):
+    with self.condition:
+      self.condition.wait_for(lambda: self.available >= count)
+      self.available -= count
+
+  def release(self, count):
+    with self.condition:
+      self.available += count
+      self.condition.notify_all()
+
+
+class RotationScheduler:
+  """Rotates nodes in batches of `surge` per ASG, with up to `max_parallel_asgs` ASGs in flight at once.
+
+  All cluster access goes through `ops` (see ClusterOperations in rotate_eks_nodes.py), so the scheduler
+  can be driven by fake EC2/ASG/Kubernetes clients. Progress is recorded in `journal`, so an interrupted
+  rotation picks up where it stopped instead of starting over, and every phase is timed in `telemetry`.
+  """
+
+  def __init__(self, ops, surge=1, max_unavailable=1, max_parallel_asgs=1, journal=None, telemetry=None):
+    if surge < 1 or max_unavailable < 1 or max_parallel_asgs < 1:
+      raise ValueError("surge, max_unavailable and max_parallel_asgs must all be at least 1")
+    self.ops = ops
+    # A batch can never be bigger than what we are allowed to have unavailable at once
+    self.surge = min(surge, max_unavailable)
+    self.max_unavailable = max_unavailable
+    self.slots = UnavailableSlots(max_unavailable)
+    self.max_parallel_asgs = max_parallel_asgs
+    self.failed = threading.Event()
+    # Only the main thread sees Ctrl-C, the batches running on executor threads check this between steps
+    # and every wait they block in is stopped by it
+    self.interrupted = threading.Event()
+    self.journal = journal or RotationJournal()
+    self.telemetry = telemetry or RotationTelemetry()
+
+  def queue(self, targets: List[NodeTarget]):
+    """Targets grouped per ASG in the order they will be rotated, without those an interrupted run already replaced"""
+    by_asg = OrderedDict()
+    for target in targets:
+      if self.journal.phase(target) == TERMINATED:
+        logging.info(f"Skipping instance {target.instance_id} ({target.node_name}), it was already replaced")
+        continue
+      by_asg.setdefault(target.asg_name, []).append(target)
+    for asg_name, nodes in by_asg.items():
+      # A batch that was interrupted half-way goes first, so it is finished with the surge already in place
+      nodes.sort(key=lambda node: not self.journal.in_progress(node))
+    return by_asg
+
+  def batches(self, nodes: List[NodeTarget]):
+    """Batches of `surge` nodes of one ASG, led by what is left of the batch an interrupted run surged it for"""
+    surged = set(self.journal.surged_batch(nodes[0].asg_name)) if nodes else set()
+    # That batch keeps the size it was surged with, whatever --surge is now
+    resumed = [node for node in nodes if node.instance_id in surged]
+    rest = [node for node in nodes if node.instance_id not in surged]
+    return ([resumed] if resumed else []) + [rest[start:start + self.surge] for start in range(0, len(rest), self.surge)]
+
+  def run(self, targets: List[NodeTarget]):
+    by_asg = self.queue(targets)
+    errors = []
+    with ThreadPoolExecutor(max_workers=self.max_parallel_asgs) as executor:
+      # Ctrl-C can arrive while ASGs are still being submitted, the first ones may be rotating already
+      try:
+        futures = {executor.submit(self.rotate_asg, asg_name, nodes): asg_name for asg_name, nodes in by_asg.items()}
+        # ASGs whose last batch was terminated before the interruption only need scaling back down
+        for asg_name in self.journal.surged_asgs():
+          if asg_name not in by_asg:
+            futures[executor.submit(self.scale_down, asg_name)] = asg_name
+        for future, asg_name in futures.items():
+          # Waiting in slices: Ctrl-C may be delivered to a worker thread, and would then not wake a blocked wait
+          while not wait([future], timeout=1).done:
+            pass
+          try:
+            future.result()
+          except Exception as e:
+            errors.append((asg_name, e))
+      except KeyboardInterrupt:
+        # Leaving the executor waits for its threads, by then every batch in flight has reverted its ASG
+        logging.error("Interrupted, reverting the batches in flight and not starting any more")
+        self.interrupted.set()
+        self.failed.set()
+    if self.interrupted.is_set():
+      raise KeyboardInterrupt
+
+    if errors:
+      raise RotationError("; ".join(f"{asg_name}: {e}" for asg_name, e in errors))
+
+  def rotate_asg(self, asg_name, nodes: List[NodeTarget]):
+    with self.telemetry.phase('asg', asg_name, nodes):
+      surged = set(self.journal.surged_batch(asg_name))
+      if self.journal.surge(asg_name) and not any(node.instance_id in surged for node in nodes):
+        # The surged batch was terminated before the interruption, scale it back down before surging for the next one
+        self.scale_down(asg_name)
+      self._rotate_batches(asg_name, nodes)
+
+  def _rotate_batches(self, asg_name, nodes: List[NodeTarget]):
+    for batch in self.batches(nodes):
+      if self.failed.is_set():
+        logging.error(f"Another ASG failed, not starting any more batches in ASG: {asg_name}")
+        return
+      # A resumed batch may be bigger than max_unavailable now, its nodes are cordoned already anyway
+      slots = min(len(batch), self.max_unavailable)
+      self.slots.acquire(slots)
+      try:
+        # Another ASG may have failed while this one was waiting for unavailable slots
+        if self.failed.is_set():
+          logging.error(f"Another ASG failed, not starting any more batches in ASG: {asg_name}")
+          return
+        with self.telemetry.phase('batch', asg_name, batch):
+          self.rotate_batch(asg_name, batch)
+      except Exception:
+        self.failed.set()
+        raise
+      finally:
+        self.slots.release(slots)
+
+  def _check_interrupted(self, asg_name):
+    if self.interrupted.is_set():
+      raise RotationInterrupted(f"Rotation interrupted, stopping the batch in ASG: {asg_name}")
+
+  def rotate_batch(self, asg_name, batch: List[NodeTarget]):
+    print()
+    logging.info(f"Dealing with instance(s): {[node.instance_id for node in batch]}, in ASG: {asg_name}")
+    ops = self.ops
+    journal = self.journal
+    telemetry = self.telemetry
+
+    for node in batch:
+      logging.info(f"Will cordon instance: {node.instance_id}, with node_name: {node.node_name} so no new pods are scheduled on it")
+      with telemetry.phase('cordon', asg_name, [node]):
+        ops.cordon(node.node_name)
+      if not journal.reached(node, CORDONED):
+        journal.set_phase(node, CORDONED)
+
+    surge = journal.surge(asg_name)
+    # Controllers of pods already drained by an interrupted run are only known from the journal
+    controllers = list(surge[2]) if surge else []
+    for node in batch:
+      pods = ops.list_node_pods(node.node_name)
+      logging.info(f"Instance and pod info: {node.instance_id} {node.node_name} {[pod.metadata.name for pod in pods]}")
+      for controller in ops.pod_controllers(pods):
+        if controller not in controllers:
+          controllers.append(controller)
+
+    # Scale up ASG DesiredCapacity by the batch size, and also possibly increase MaxSize if DesiredCapacity goes above it
+    logging.info(f"Dealing with ASG: {asg_name}")
+    if surge:
+      # Surged by an interrupted run: size relative to the original capacity, not to the surged one, and by the
+      # batch it was surged for, some of which may already be terminated
+      current_desired_capacity, current_max_size, _ = surge
+      surged_instance_ids = journal.surged_batch(asg_name)
+      logging.info(f"ASG: {asg_name} was already surged by an interrupted run for instance(s) {surged_instance_ids}, resuming")
+    else:
+      current_desired_capacity, current_max_size = ops.asg_capacity(asg_name)
+      surged_instance_ids = [node.instance_id for node in batch]
+    logging.info(f"Current ASG DesiredCapacity: {current_desired_capacity}")
+    logging.info(f"Current ASG MaxSize: {current_max_size}")
+    new_desired_capacity = current_desired_capacity + len(surged_instance_ids)
+    new_max_size = max(new_desired_capacity, current_max_size)
+    logging.info(f"New ASG DesiredCapacity: {new_desired_capacity}")
+    logging.info(f"New ASG MaxSize: {new_max_size}")
+
+    try:
+      # Recorded before the update, so a crash in between still leaves the original capacity to revert to
+      journal.record_surge(asg_name, current_desired_capacity, current_max_size, controllers, surged_instance_ids)
+      logging.info(f"Updating ASG: {asg_name} with new DesiredCapacity: {new_desired_capacity} and MaxSize: {new_max_size}")
+      with telemetry.phase('surge', asg_name, batch):
+        ops.set_asg_capacity(asg_name, new_desired_capacity, new_max_size)
+        ops.wait_for_in_service(asg_name, new_desired_capacity, stop=self.interrupted)
+
+      for node in batch:
+        self._check_interrupted(asg_name)
+        if journal.reached(node, DRAINED):
+          logging.info(f"Instance {node.instance_id}/{node.node_name} was already drained, skipping the drain")
+          continue
+        with telemetry.phase('drain', asg_name, [node]):
+          self.wait_for_pdbs(node)
+          logging.info(f"Draining old instance {node.instance_id}/{node.node_name} in ASG {asg_name}")
+          ops.drain(node.node_name)
+          ops.wait_for_drained(node.node_name, stop=self.interrupted)
+        journal.set_phase(node, DRAINED)
+
+      self._check_interrupted(asg_name)
+      with telemetry.phase('replicas', asg_name, batch):
+        ops.wait_for_replicas(controllers, stop=self.interrupted)
+
+      self._check_interrupted(asg_name)
+      logging.info("Terminating old instance(s)...")
+      with telemetry.phase('terminate', asg_name, batch):
+        ops.terminate([node.instance_id for node in batch])
+      for node in batch:
+        journal.set_phase(node, TERMINATED)
+
+      # Scale ASG DesiredCapacity and MaxSize back down to original values so we are consistent with Terraform
+      logging.info(f"Reverting ASG: {asg_name} with original DesiredCapacity: {current_desired_capacity} and MaxSize: {current_max_size}")
+      ops.set_asg_capacity(asg_name, current_desired_capacity, current_max_size)
+      journal.clear_surge(asg_name)
+
+    except BaseException as e:
+      logging.error(e)
+      logging.error(f"Will revert ASG: {asg_name} back to original DesiredCapacity: {current_desired_capacity} and MaxSize: {current_max_size} before exiting!")
+      for node in batch:
+        ops.uncordon(node.node_name)
+      ops.set_asg_capacity(asg_name, current_desired_capacity, current_max_size)
+      journal.reset(batch)
+      journal.clear_surge(asg_name)
+      logging.error(f"ASG reverted back to original values. Instance(s) {[node.instance_id for node in batch]} have been uncordoned. Check state of Kubernetes and AWS before running the script again.")
+      raise
+
+    if self.interrupted.is_set():
+      # The capacity is already back to its original values, the ASG scales down without us
+      return
+    logging.info("Waiting for number of instances in ASG to scale back down...")
+    with telemetry.phase('scale_down', asg_name, batch):
+      ops.wait_for_in_service(asg_name, current_desired_capacity, timeout=None, stop=self.interrupted)
+    logging.info(f"Number of instances in ASG has scaled back down to original DesiredCapacity: {current_desired_capacity}")
+    print("--------------------------------------------------------------------------------------------")
+
+  def scale_down(self, asg_name):
+    desired_capacity, max_size, _ = self.journal.surge(asg_name)
+    logging.info(f"Reverting ASG: {asg_name}, left surged by an interrupted run, to original DesiredCapacity: {desired_capacity} and MaxSize: {max_size}")
+    self.ops.set_asg_capacity(asg_name, desired_capacity, max_size)
+    self.journal.clear_surge(asg_name)
+    self.ops.wait_for_in_service(asg_name, desired_capacity, timeout=None, stop=self.interrupted)
+
+  def wait_for_pdbs(self, node: NodeTarget):
+    # Evictions are checked against PodDisruptionBudgets server-side anyway, this just avoids starting
+    # a drain (and holding an unavailable slot busy) while a budget has nothing left to give
+    while True:
+      self._check_interrupted(node.asg_name)
+      blocking = self.ops.blocking_pdbs(node.node_name)
+      if not blocking:
+        return
+      logging.info(f"PodDisruptionBudget(s) {blocking} allow no disruptions for pods on {node.node_name}. Will snooze and try again...")
+      self.telemetry.retries.add(f"PDB snooze before drain in {node.asg_name}")
+      self.ops.snooze()
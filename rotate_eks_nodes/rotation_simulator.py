@@ -0,0 +1,144 @@
+"""Discrete-event simulator estimating how long a rotation takes under different parallelism settings.
+
+Replays phase durations recorded from earlier rotations (the --timings-file of rotate_eks_nodes.py, or
+any JSON lines with "phase" and "seconds", sampled at random per phase) over the ASGs and node counts of a plan written with `--plan-output`, or of
+--asgs synthetic ASGs of --nodes-per-asg nodes. Batches are scheduled like RotationScheduler does: each
+ASG works through batches of `surge` nodes, up to `max_parallel_asgs` ASGs at once, and a batch only starts
+when `max_unavailable` leaves room for all its nodes. Phases without recordings use DEFAULT_PHASE_SECONDS.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import random
+import statistics
+from collections import defaultdict, deque
+
+from rotation_planner import RotationPlan
+
+# Rough durations of an EKS rotation, in seconds. cordon and drain are per node, the others per batch.
+DEFAULT_PHASE_SECONDS = {
+  'cordon': 1,
+  'surge': 180,
+  'drain': 90,
+  'replicas': 60,
+  'terminate': 2,
+  'scale_down': 120,
+}
+
+
+class PhaseDurations:
+
+  def __init__(self, samples=None):
+    self.samples = samples or {}
+
+  @classmethod
+  def load(cls, path):
+    samples = defaultdict(list)
+    with open(path) as f:
+      for line in f:
+        if not line.strip():
+          continue
+        record = json.loads(line)
+        # Phases that failed part-way say nothing about how long they take
+        if record.get('phase') in DEFAULT_PHASE_SECONDS and 'seconds' in record and record.get('ok', True):
+          samples[record['phase']].append(float(record['seconds']))
+    return cls(dict(samples))
+
+  def sample(self, phase, rng):
+    recorded = self.samples.get(phase)
+    return rng.choice(recorded) if recorded else DEFAULT_PHASE_SECONDS[phase]
+
+  def batch_seconds(self, size, rng):
+    """A batch runs its phases one after the other, cordoning and draining its nodes one at a time"""
+    per_node = sum(self.sample('cordon', rng) + self.sample('drain', rng) for _ in range(size))
+    return per_node + sum(self.sample(phase, rng) for phase in ('surge', 'replicas', 'terminate', 'scale_down'))
+
+
+def simulate(node_counts, durations, surge=1, max_unavailable=1, max_parallel_asgs=1, rng=None):
+  """Simulated wall time, in seconds, to rotate ASGs with the given node counts (a list, in rotation order)"""
+  rng = rng or random.Random()
+  surge = min(surge, max_unavailable)
+  asg_batches = [deque(min(surge, count - start) for start in range(0, count, surge)) for count in node_counts if count]
+  pending_asgs = deque(range(len(asg_batches)))
+  running_asgs = 0
+  free_slots = max_unavailable
+  waiting = []  # ASGs whose next batch waits for unavailable slots, in the order they started waiting
+  events = []  # (finish time, sequence, asg, batch size)
+  sequence = itertools.count()
+  now = 0.0
+
+  def start_or_wait(asg):
+    nonlocal free_slots, running_asgs
+    batches = asg_batches[asg]
+    if not batches:
+      running_asgs -= 1
+      return
+    if batches[0] > free_slots:
+      waiting.append(asg)
+      return
+    size = batches.popleft()
+    free_slots -= size
+    heapq.heappush(events, (now + durations.batch_seconds(size, rng), next(sequence), asg, size))
+
+  def start_asgs():
+    nonlocal running_asgs
+    while pending_asgs and running_asgs < max_parallel_asgs:
+      running_asgs += 1
+      start_or_wait(pending_asgs.popleft())
+
+  start_asgs()
+  while events:
+    now, _, asg, size = heapq.heappop(events)
+    free_slots += size
+    # Freed slots wake every waiting batch (like UnavailableSlots' notify_all), the first ones that fit go
+    woken, waiting[:] = list(waiting), []
+    for waiting_asg in woken:
+      start_or_wait(waiting_asg)
+    start_or_wait(asg)
+    start_asgs()
+  return now
+
+
+def _format_duration(seconds):
+  hours, remainder = divmod(int(seconds), 3600)
+  return f"{hours}h{remainder // 60:02d}m"
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--plan', help='plan JSON written by rotate_eks_nodes.py --plan --plan-output')
+  parser.add_argument('--asgs', type=int, default=3, help='synthetic ASGs, when no --plan is given')
+  parser.add_argument('--nodes-per-asg', type=int, default=10, help='nodes per synthetic ASG, when no --plan is given')
+  parser.add_argument('--durations', help='JSON lines of recorded phase timings')
+  parser.add_argument('--surge', type=int, nargs='+', default=[1, 2, 4])
+  parser.add_argument('--max-unavailable', type=int, nargs='+', default=[1, 2, 4, 8])
+  parser.add_argument('--max-parallel-asgs', type=int, nargs='+', default=[1, 2, 4])
+  parser.add_argument('--trials', type=int, default=200)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  if args.plan:
+    node_counts = [asg.node_count for asg in RotationPlan.load(args.plan).asgs]
+  else:
+    node_counts = [args.nodes_per_asg] * args.asgs
+  durations = PhaseDurations.load(args.durations) if args.durations else PhaseDurations()
+  recorded = ', '.join(f"{phase}: {len(samples)}" for phase, samples in durations.samples.items()) or 'none, using defaults'
+  print(f"{sum(node_counts)} node(s) in {len(node_counts)} ASG(s), {args.trials} trials per setting, recorded samples: {recorded}")
+
+  results = []
+  for surge, max_unavailable, max_parallel_asgs in itertools.product(args.surge, args.max_unavailable, args.max_parallel_asgs):
+    if surge > max_unavailable:
+      # The scheduler clamps surge to max_unavailable, this is the same as surge == max_unavailable
+      continue
+    rng = random.Random(args.seed)
+    totals = sorted(simulate(node_counts, durations, surge, max_unavailable, max_parallel_asgs, rng) for _ in range(args.trials))
+    results.append((statistics.median(totals), totals[int(0.9 * (len(totals) - 1))], surge, max_unavailable, max_parallel_asgs))
+
+  print(f"{'surge':>6} {'max unavailable':>16} {'parallel ASGs':>14} {'median':>9} {'p90':>9}")
+  for median, p90, surge, max_unavailable, max_parallel_asgs in sorted(results):
+    print(f"{surge:>6} {max_unavailable:>16} {max_parallel_asgs:>14} {_format_duration(median):>9} {_format_duration(p90):>9}")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,117 @@
+import contextlib
+import datetime
+import json
+import logging
+import threading
+import time
+import urllib.request
+from collections import defaultdict
+
+from api_calls import ApiCallCounter
+
+
+class RotationTelemetry:
+  """Start/end times of every rotation phase, per node and per ASG, plus API call and retry counts.
+
+  Each finished phase is appended to `jsonl_path` as one JSON line ({"phase", "seconds", "asg", ...}), the
+  format rotation_simulator.py replays. Phases are the simulator's (cordon, surge, drain, replicas,
+  terminate, scale_down) plus whole-batch and whole-ASG records. With jsonl_path=None nothing is written.
+  """
+
+  def __init__(self, jsonl_path=None, api_calls=None, retries=None):
+    self.jsonl_path = jsonl_path
+    self.api_calls = api_calls or ApiCallCounter()
+    # Re-polls, PDB snoozes and blocked evictions, counted like API calls: per kind of retry
+    self.retries = retries or ApiCallCounter()
+    self.run_id = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    self.started = time.monotonic()
+    self.records = []
+    self.lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def phase(self, phase, asg_name, nodes=()):
+    """Time the body as `phase` of the ASG (and of the given nodes), recording whether it raised"""
+    start_wall, start = time.time(), time.monotonic()
+    ok = False
+    try:
+      yield
+      ok = True
+    finally:
+      self.record({
+        'run_id': self.run_id,
+        'phase': phase,
+        'asg': asg_name,
+        'instance_ids': [node.instance_id for node in nodes],
+        'node_names': [node.node_name for node in nodes],
+        'start': datetime.datetime.fromtimestamp(start_wall, datetime.timezone.utc).isoformat(),
+        'seconds': round(time.monotonic() - start, 3),
+        'ok': ok,
+      })
+
+  def record(self, record):
+    with self.lock:
+      self.records.append(record)
+      if self.jsonl_path is not None:
+        with open(self.jsonl_path, 'a') as f:
+          f.write(json.dumps(record) + '\n')
+
+  def by_phase(self):
+    """{(asg, phase): [seconds, ...]} of the phases that finished"""
+    with self.lock:
+      records = list(self.records)
+    grouped = defaultdict(list)
+    for record in records:
+      if record['ok']:
+        grouped[(record['asg'], record['phase'])].append(record['seconds'])
+    return grouped
+
+  def log_summary(self):
+    elapsed = time.monotonic() - self.started
+    logging.info(f"Rotation timings (run {self.run_id}, {elapsed:.0f}s in total){f', written to {self.jsonl_path}' if self.jsonl_path else ''}:")
+    logging.info(f"  {'ASG':<40} {'phase':<11} {'count':>5} {'total (s)':>10} {'mean (s)':>9} {'max (s)':>8}")
+    for (asg_name, phase), seconds in sorted(self.by_phase().items()):
+      logging.info(f"  {asg_name:<40} {phase:<11} {len(seconds):>5} {sum(seconds):>10.0f} {sum(seconds) / len(seconds):>9.1f} {max(seconds):>8.1f}")
+    with self.lock:
+      failed = [record for record in self.records if not record['ok']]
+    for record in failed:
+      logging.info(f"  failed: {record['phase']} in {record['asg']} {record['node_names']} after {record['seconds']:.0f}s")
+    self.api_calls.log_summary("API calls")
+    self.retries.log_summary("Retries")
+
+  def render_prometheus(self):
+    lines = [
+      '# TYPE eks_rotation_phase_seconds summary',
+    ]
+    for (asg_name, phase), seconds in sorted(self.by_phase().items()):
+      labels = f'asg="{asg_name}",phase="{phase}"'
+      lines.append(f'eks_rotation_phase_seconds_sum{{{labels}}} {sum(seconds)}')
+      lines.append(f'eks_rotation_phase_seconds_count{{{labels}}} {len(seconds)}')
+    lines.append('# TYPE eks_rotation_api_calls_total counter')
+    for endpoint, count in sorted(self.api_calls.snapshot().items()):
+      lines.append(f'eks_rotation_api_calls_total{{endpoint="{_escape(endpoint)}"}} {count}')
+    lines.append('# TYPE eks_rotation_retries_total counter')
+    for kind, count in sorted(self.retries.snapshot().items()):
+      lines.append(f'eks_rotation_retries_total{{kind="{_escape(kind)}"}} {count}')
+    lines.append('# TYPE eks_rotation_duration_seconds gauge')
+    lines.append(f'eks_rotation_duration_seconds {time.monotonic() - self.started}')
+    return '\n'.join(lines) + '\n'
+
+  def push(self, gateway_url, job='rotate_eks_nodes'):
+    """Replace this job's metrics on a Prometheus pushgateway"""
+    request = urllib.request.Request(
+      f"{gateway_url.rstrip('/')}/metrics/job/{job}",
+      data=self.render_prometheus().encode(),
+      method='PUT',
+      headers={'Content-Type': 'text/plain; version=0.0.4'}
+    )
+    try:
+      with urllib.request.urlopen(request, timeout=10):
+        pass
+      logging.info(f"Rotation metrics pushed to {gateway_url}")
+    except OSError as e:
+      # Metrics are best effort, never fail a rotation over them
+      logging.warning(f"Could not push rotation metrics to {gateway_url}: {e}")
+
+
+def _escape(value):
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,163 @@
+"""Tests of the Eviction API drain engine against a fake CoreV1Api (pip install kubernetes pytest, then pytest)"""
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('kubernetes')
+
+from kubernetes.client.rest import ApiException
+
+from api_calls import ApiCallCounter
+from drain import MIRROR_POD_ANNOTATION, DrainEngine, DrainError
+
+
+def make_pod(name, namespace='default', owner_kind='ReplicaSet', annotations=None, phase='Running'):
+  owners = [SimpleNamespace(kind=owner_kind, name=f"{name}-owner")] if owner_kind else []
+  return SimpleNamespace(
+    metadata=SimpleNamespace(name=name, namespace=namespace, owner_references=owners, annotations=annotations),
+    status=SimpleNamespace(phase=phase),
+  )
+
+
+class FakeCoreApi:
+  """The CoreV1Api calls DrainEngine makes. evict(namespace, name) decides the outcome of every eviction."""
+
+  def __init__(self, pods, evict=None):
+    self.pods = pods
+    self.evict = evict or (lambda namespace, name: None)
+    self.patches = []
+    self.evictions = []
+    self.lock = threading.Lock()
+
+  def patch_node(self, node_name, body):
+    self.patches.append((node_name, body))
+
+  def list_pod_for_all_namespaces(self, field_selector):
+    return SimpleNamespace(items=self.pods)
+
+  def create_namespaced_pod_eviction(self, name, namespace, body):
+    with self.lock:
+      self.evictions.append((namespace, name))
+    self.evict(namespace, name)
+
+
+class NoBackoff:
+
+  def next_delay(self):
+    return 0.01
+
+
+def make_engine(core_api, **kwargs):
+  return DrainEngine(core_api, backoff_factory=NoBackoff, **kwargs)
+
+
+def test_drain_cordons_and_evicts_managed_pods():
+  core_api = FakeCoreApi([make_pod('web-1'), make_pod('web-2', namespace='other')])
+  results = make_engine(core_api).drain('node-1')
+  assert core_api.patches == [('node-1', {'spec': {'unschedulable': True}})]
+  assert sorted(core_api.evictions) == [('default', 'web-1'), ('other', 'web-2')]
+  assert {result.status for result in results} == {'evicted'}
+
+
+def test_daemonset_and_mirror_pods_are_skipped():
+  core_api = FakeCoreApi([
+    make_pod('fluentd', owner_kind='DaemonSet'),
+    make_pod('kube-proxy', owner_kind=None, annotations={MIRROR_POD_ANNOTATION: 'abc'}),
+    make_pod('web-1'),
+  ])
+  make_engine(core_api).drain('node-1')
+  assert core_api.evictions == [('default', 'web-1')]
+
+
+def test_unmanaged_pods_are_refused():
+  core_api = FakeCoreApi([make_pod('web-1'), make_pod('debug', owner_kind=None)])
+  with pytest.raises(DrainError, match='default/debug'):
+    make_engine(core_api).drain('node-1')
+  assert core_api.evictions == []
+
+
+def test_unmanaged_pods_are_evicted_with_force():
+  core_api = FakeCoreApi([make_pod('debug', owner_kind=None)])
+  make_engine(core_api, force=True).drain('node-1')
+  assert core_api.evictions == [('default', 'debug')]
+
+
+def test_finished_unmanaged_pods_do_not_block_the_drain():
+  core_api = FakeCoreApi([make_pod('job-run', owner_kind=None, phase='Succeeded')])
+  make_engine(core_api).drain('node-1')
+  assert core_api.evictions == [('default', 'job-run')]
+
+
+def test_429_is_retried_until_the_pdb_allows_it():
+  attempts = []
+
+  def evict(namespace, name):
+    attempts.append(name)
+    if len(attempts) < 3:
+      raise ApiException(status=429, reason='Too Many Requests')
+
+  retries = ApiCallCounter()
+  core_api = FakeCoreApi([make_pod('web-1')], evict)
+  results = make_engine(core_api, retries=retries).drain('node-1')
+  assert [(result.status, result.attempts) for result in results] == [('evicted', 3)]
+  assert retries.total() == 2
+
+
+def test_429_gives_up_at_the_eviction_timeout():
+  def evict(namespace, name):
+    raise ApiException(status=429, reason='Too Many Requests')
+
+  core_api = FakeCoreApi([make_pod('web-1')], evict)
+  start = time.monotonic()
+  with pytest.raises(DrainError, match='PodDisruptionBudget still blocking'):
+    make_engine(core_api, eviction_timeout=0.2).drain('node-1')
+  assert time.monotonic() - start < 2
+  assert len(core_api.evictions) > 1
+
+
+def test_404_means_the_pod_is_already_gone():
+  def evict(namespace, name):
+    raise ApiException(status=404, reason='Not Found')
+
+  core_api = FakeCoreApi([make_pod('web-1')], evict)
+  results = make_engine(core_api).drain('node-1')
+  assert [(result.status, result.attempts) for result in results] == [('gone', 1)]
+
+
+def test_other_errors_fail_the_drain_without_retrying():
+  def evict(namespace, name):
+    if name == 'web-2':
+      raise ApiException(status=500, reason='Internal Server Error')
+
+  core_api = FakeCoreApi([make_pod('web-1'), make_pod('web-2')], evict)
+  with pytest.raises(DrainError, match='default/web-2: Internal Server Error'):
+    make_engine(core_api).drain('node-1')
+  assert sorted(core_api.evictions) == [('default', 'web-1'), ('default', 'web-2')]
+
+
+def test_evictions_run_with_bounded_parallelism():
+  in_flight = 0
+  peak = 0
+  lock = threading.Lock()
+
+  def evict(namespace, name):
+    nonlocal in_flight, peak
+    with lock:
+      in_flight += 1
+      peak = max(peak, in_flight)
+    time.sleep(0.05)
+    with lock:
+      in_flight -= 1
+
+  core_api = FakeCoreApi([make_pod(f'web-{i}') for i in range(12)], evict)
+  results = make_engine(core_api, max_parallel_evictions=3).drain('node-1')
+  assert len(results) == 12
+  assert peak == 3
+
+
+def test_uncordon():
+  core_api = FakeCoreApi([])
+  make_engine(core_api).uncordon('node-1')
+  assert core_api.patches == [('node-1', {'spec': {'unschedulable': False}})]
@@ -0,0 +1,183 @@
+"""Tests of the rotation batching, revert and resume logic against a fake ClusterOperations (pip install pytest, then pytest)"""
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from rotation_journal import DRAINED, TERMINATED, RotationJournal
+from rotation_scheduler import NodeTarget, RotationError, RotationScheduler
+
+
+class Stopped(Exception):
+  pass
+
+
+class FakeClusterOperations:
+  """The ClusterOperations calls the scheduler makes, against in-memory ASGs. Every call is logged in `calls`."""
+
+  def __init__(self, asgs, drain_seconds=0, fail_replicas=False):
+    # {asg_name: [desired capacity, max size]}
+    self.asgs = {asg_name: list(capacity) for asg_name, capacity in asgs.items()}
+    self.drain_seconds = drain_seconds
+    self.fail_replicas = fail_replicas
+    self.calls = []
+    self.cordoned = set()
+    self.peak_cordoned = 0
+    self.draining = threading.Event()
+    self.lock = threading.Lock()
+
+  def _call(self, *call):
+    with self.lock:
+      self.calls.append(call)
+
+  def cordon(self, node_name):
+    self._call('cordon', node_name)
+    with self.lock:
+      self.cordoned.add(node_name)
+      self.peak_cordoned = max(self.peak_cordoned, len(self.cordoned))
+
+  def uncordon(self, node_name):
+    self._call('uncordon', node_name)
+    with self.lock:
+      self.cordoned.discard(node_name)
+
+  def drain(self, node_name):
+    self._call('drain', node_name)
+
+  def list_node_pods(self, node_name):
+    return []
+
+  def pod_controllers(self, pods):
+    return []
+
+  def blocking_pdbs(self, node_name):
+    return []
+
+  def snooze(self):
+    pass
+
+  def asg_capacity(self, asg_name):
+    return tuple(self.asgs[asg_name])
+
+  def set_asg_capacity(self, asg_name, desired_capacity, max_size):
+    self._call('set_asg_capacity', asg_name, desired_capacity, max_size)
+    self.asgs[asg_name] = [desired_capacity, max_size]
+
+  def wait_for_in_service(self, asg_name, count, timeout=None, stop=None):
+    self._call('wait_for_in_service', asg_name, count)
+
+  def wait_for_drained(self, node_name, stop=None):
+    self.draining.set()
+    if self.drain_seconds is None:
+      # Blocks like a drain that never finishes, until the rotation is interrupted
+      assert stop.wait(5), "the drain wait was never stopped"
+      raise Stopped(f"Stopped waiting for {node_name} to drain")
+    time.sleep(self.drain_seconds)
+
+  def wait_for_replicas(self, controllers, stop=None):
+    if self.fail_replicas:
+      raise RuntimeError("replicas never became ready")
+
+  def terminate(self, instance_ids):
+    self._call('terminate', instance_ids)
+    with self.lock:
+      self.cordoned -= {f"node-{instance_id}" for instance_id in instance_ids}
+
+  def of(self, name):
+    return [call[1:] for call in self.calls if call[0] == name]
+
+
+def targets(asg_name, *instance_ids):
+  return [NodeTarget(instance_id=instance_id, node_name=f"node-{instance_id}", asg_name=asg_name) for instance_id in instance_ids]
+
+
+def test_nodes_are_rotated_in_batches_of_surge():
+  ops = FakeClusterOperations({'asg-a': (5, 5)})
+  RotationScheduler(ops, surge=2, max_unavailable=2).run(targets('asg-a', 'i-1', 'i-2', 'i-3', 'i-4', 'i-5'))
+  assert ops.of('terminate') == [(['i-1', 'i-2'],), (['i-3', 'i-4'],), (['i-5'],)]
+  # Each batch surges by its own size, raising MaxSize with it, and is reverted to the original capacity
+  assert ops.of('set_asg_capacity') == [
+    ('asg-a', 7, 7), ('asg-a', 5, 5),
+    ('asg-a', 7, 7), ('asg-a', 5, 5),
+    ('asg-a', 6, 6), ('asg-a', 5, 5),
+  ]
+  assert ops.asgs == {'asg-a': [5, 5]}
+
+
+def test_surge_is_capped_by_max_unavailable():
+  ops = FakeClusterOperations({'asg-a': (3, 10)})
+  scheduler = RotationScheduler(ops, surge=3, max_unavailable=1)
+  scheduler.run(targets('asg-a', 'i-1', 'i-2', 'i-3'))
+  assert scheduler.surge == 1
+  assert ops.of('terminate') == [(['i-1'],), (['i-2'],), (['i-3'],)]
+
+
+def test_max_unavailable_holds_across_parallel_asgs():
+  ops = FakeClusterOperations({'asg-a': (2, 4), 'asg-b': (2, 4), 'asg-c': (2, 4)}, drain_seconds=0.05)
+  nodes = targets('asg-a', 'a-1', 'a-2') + targets('asg-b', 'b-1', 'b-2') + targets('asg-c', 'c-1', 'c-2')
+  RotationScheduler(ops, surge=1, max_unavailable=2, max_parallel_asgs=3).run(nodes)
+  assert len(ops.of('terminate')) == 6
+  assert ops.peak_cordoned == 2
+
+
+def test_failed_batch_reverts_its_asg_and_stops_the_rotation():
+  ops = FakeClusterOperations({'asg-a': (3, 3)}, fail_replicas=True)
+  journal = RotationJournal()
+  nodes = targets('asg-a', 'i-1', 'i-2', 'i-3')
+  with pytest.raises(RotationError, match='replicas never became ready'):
+    RotationScheduler(ops, surge=2, max_unavailable=2, journal=journal).run(nodes)
+  assert ops.of('terminate') == []
+  assert ops.of('uncordon') == [('node-i-1',), ('node-i-2',)]
+  assert ops.asgs == {'asg-a': [3, 3]}
+  # The next batch was never started and nothing is left to resume
+  assert ('cordon', 'node-i-3') not in ops.calls
+  assert journal.surged_asgs() == []
+  assert [journal.phase(node) for node in nodes] == ['pending'] * 3
+
+
+def test_half_done_batch_is_resumed_with_its_original_surge():
+  journal = RotationJournal()
+  i_1, i_2, i_3 = targets('asg-a', 'i-1', 'i-2', 'i-3')
+  # An interrupted run surged the ASG from 2 for i-1 and i-2, and got as far as terminating i-1 and draining i-2
+  journal.record_surge('asg-a', 2, 3, [], ['i-1', 'i-2'])
+  journal.set_phase(i_1, TERMINATED)
+  journal.set_phase(i_2, DRAINED)
+  ops = FakeClusterOperations({'asg-a': (4, 4)})
+
+  RotationScheduler(ops, surge=1, max_unavailable=1, journal=journal).run([i_1, i_2, i_3])
+
+  assert ops.of('terminate') == [(['i-2'],), (['i-3'],)]
+  # The resumed batch is sized by both instances it was surged for, not by the one left of it
+  assert ops.of('set_asg_capacity') == [('asg-a', 4, 4), ('asg-a', 2, 3), ('asg-a', 3, 3), ('asg-a', 2, 3)]
+  assert ('drain', 'node-i-2') not in ops.calls
+  assert ('cordon', 'node-i-1') not in ops.calls
+  assert journal.surged_asgs() == []
+
+
+def test_interrupt_stops_the_waits_and_reverts_the_batch_in_flight():
+  ops = FakeClusterOperations({'asg-a': (2, 2)}, drain_seconds=None)
+  journal = RotationJournal()
+
+  def interrupt():
+    ops.draining.wait(5)
+    # Give run() time to finish submitting and settle in its wait for the batches
+    time.sleep(0.2)
+    # A real SIGINT, like Ctrl-C, so that it also wakes the main thread blocked on the batches
+    os.kill(os.getpid(), signal.SIGINT)
+
+  interrupter = threading.Thread(target=interrupt)
+  interrupter.start()
+  start = time.monotonic()
+  try:
+    with pytest.raises(KeyboardInterrupt):
+      RotationScheduler(ops, surge=1, max_unavailable=1, journal=journal).run(targets('asg-a', 'i-1', 'i-2'))
+  finally:
+    interrupter.join()
+  assert time.monotonic() - start < 5
+  assert ops.of('terminate') == []
+  assert ops.of('uncordon') == [('node-i-1',)]
+  assert ('cordon', 'node-i-2') not in ops.calls
+  assert ops.asgs == {'asg-a': [2, 2]}
+  assert journal.surged_asgs() == []
@@ -0,0 +1,133 @@
+import datetime
+import logging
+import random
+import time
+
+import kubernetes
+from kubernetes.client.rest import ApiException
+
+# The API server closes watches after this long at the latest, we then watch again from where it ended
+WATCH_TIMEOUT_SECONDS = 300
+
+# How soon a wait given a stop Event notices it was set
+STOP_CHECK_SECONDS = 5
+
+
+class WaitStopped(Exception):
+  """Raised by a wait whose stop Event was set, e.g. because the rotation was interrupted"""
+
+
+class Backoff:
+  """Exponential backoff with jitter, for the AWS describe calls that have no watch API"""
+
+  def __init__(self, initial=1.0, maximum=30.0, factor=2.0):
+    self.initial = initial
+    self.maximum = maximum
+    self.factor = factor
+    self.attempt = 0
+
+  def next_delay(self):
+    delay = min(self.maximum, self.initial * (self.factor ** self.attempt))
+    self.attempt += 1
+    # "Equal jitter": never less than half the nominal delay, so polls don't bunch up at the start
+    return delay / 2 + random.uniform(0, delay / 2)
+
+  def reset(self):
+    self.attempt = 0
+
+
+def _remaining(deadline):
+  return None if deadline is None else deadline - time.monotonic()
+
+
+def _check_stop(stop, description):
+  if stop is not None and stop.is_set():
+    raise WaitStopped(f"Stopped waiting for {description}")
+
+
+def _deadline(timeout):
+  if timeout is None:
+    return None
+  if isinstance(timeout, datetime.timedelta):
+    timeout = timeout.total_seconds()
+  return time.monotonic() + timeout
+
+
+def poll_until(check, backoff=None, timeout=None, description='condition', stop=None):
+  """Call check() until it returns something truthy, sleeping with jittered backoff in between.
+
+  Setting the stop Event (a threading.Event) ends the wait with WaitStopped, without sleeping out the delay.
+  """
+  backoff = backoff or Backoff()
+  deadline = _deadline(timeout)
+  while True:
+    _check_stop(stop, description)
+    result = check()
+    if result:
+      return result
+    remaining = _remaining(deadline)
+    if remaining is not None and remaining <= 0:
+      raise TimeoutError(f"Timed out waiting for {description}")
+    delay = backoff.next_delay()
+    delay = delay if remaining is None else min(delay, remaining)
+    if stop is None:
+      time.sleep(delay)
+    else:
+      stop.wait(delay)
+
+
+def object_key(obj):
+  return (obj.metadata.namespace, obj.metadata.name)
+
+
+def watch_until(list_func, predicate, timeout=None, description='condition', watch_factory=None, stop=None, **list_kwargs):
+  """List objects with list_func, then follow a watch on them until predicate(objects) holds.
+
+  objects maps (namespace, name) to the latest version of every object, and predicate is evaluated
+  after the initial list and after every event, so the wait ends as soon as the condition is true.
+  With a stop Event, watches are opened for STOP_CHECK_SECONDS at a time and the wait ends with
+  WaitStopped once it is set.
+  """
+  watch_factory = watch_factory or kubernetes.watch.Watch
+  deadline = _deadline(timeout)
+  window = WATCH_TIMEOUT_SECONDS if stop is None else STOP_CHECK_SECONDS
+  while True:
+    listing = list_func(**list_kwargs)
+    objects = {object_key(obj): obj for obj in listing.items}
+    if predicate(objects):
+      return objects
+
+    # Every watch resumes from the last event the previous one saw, only an expired resourceVersion needs a new list
+    resource_version = listing.metadata.resource_version
+    while resource_version is not None:
+      _check_stop(stop, description)
+      remaining = _remaining(deadline)
+      if remaining is not None and remaining <= 0:
+        raise TimeoutError(f"Timed out waiting for {description}")
+      timeout_seconds = window if remaining is None else max(1, int(min(remaining, window)))
+
+      watcher = watch_factory()
+      try:
+        for event in watcher.stream(list_func, resource_version=resource_version, timeout_seconds=timeout_seconds, **list_kwargs):
+          if event['type'] == 'ERROR':
+            # Typically 410 Gone: our resourceVersion is too old, start over from a fresh list
+            resource_version = None
+            break
+          obj = event['object']
+          if event['type'] == 'DELETED':
+            objects.pop(object_key(obj), None)
+          else:
+            objects[object_key(obj)] = obj
+          if predicate(objects):
+            return objects
+          _check_stop(stop, description)
+        else:
+          # kubernetes.watch.Watch keeps track of the resourceVersion of the events it has seen
+          resource_version = getattr(watcher, 'resource_version', None) or resource_version
+      except ApiException as e:
+        if e.status != 410:
+          raise
+        logging.info(f"Watch for {description} expired, re-listing")
+        resource_version = None
+      finally:
+        watcher.stop()